@@ -4,5 +4,5 @@ __author__ = 'Matthew Vincent'
 __email__ = 'mvincent@jax.org'
 __version__ = '0.1.0'
 
-__all__ = ['app', 'commands', 'ec_file', 'emase_file', 'util']
+__all__ = ['app', 'bitfield', 'builder', 'commands', 'ec_file', 'em', 'emase_file', 'kallisto_file', 'profiling', 'result_cache', 'salmon_file', 'sam_text', 'server', 'spill', 'synthetic', 'telemetry', 'trace', 'transcriptome', 'umi', 'util']
 
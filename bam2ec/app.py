@@ -1,15 +1,35 @@
 #!/usr/bin/env python
 
 import argparse
-import importlib
 import os
+import pkgutil
 import sys
 
 from . import __version__ as version
-from . import commands
 
-ext_modules = ['pysam', 'emase', 'numpy']
-failed_modules = []
+# the third party modules each subcommand needs, subcommands are only
+# imported when they run so --version and light commands start quickly
+required_modules = {
+    'batch': ['pysam', 'numpy', 'emase'],
+    'cache': ['numpy'],
+    'collapse': ['numpy'],
+    'convert': ['pysam', 'numpy', 'emase'],
+    'downsample': ['numpy'],
+    'dump': ['numpy'],
+    'ec2emase': ['numpy', 'emase'],
+    'ec2kallisto': ['numpy'],
+    'ec2salmon': ['numpy'],
+    'emase2ec': ['numpy', 'emase'],
+    'info': ['numpy'],
+    'kallisto2ec': ['numpy'],
+    'plan': ['pysam', 'numpy'],
+    'prune': ['numpy'],
+    'quantify': ['numpy', 'scipy'],
+    'remap': ['numpy'],
+    'salmon2ec': ['numpy'],
+    'serve': ['pysam', 'numpy', 'emase'],
+    'subset': ['numpy'],
+}
 
 logo_text = """
 
@@ -26,25 +46,48 @@ logo_text = """
 
 """
 
-for dependency in ext_modules:
-    try:
-        importlib.import_module(dependency)
-    except ImportError, ie:
-        failed_modules.append(dependency)
+def check_modules(command):
+    """
+    Exit if a module the command needs is not installed, without importing it.
+    """
+    failed_modules = [m for m in required_modules.get(command, []) if pkgutil.find_loader(m) is None]
+
+    if len(failed_modules) > 0:
+        sys.stderr.write('Error: The following modules need to be installed: ')
+        sys.stderr.write('\t' + ', '.join(failed_modules))
+        sys.exit(1)
 
-if len(failed_modules) > 0:
-    sys.stderr.write('Error: The following modules need to be installed: ')
-    sys.stderr.write('\t' + ', '.join(failed_modules))
-    sys.exit(1)
+
+def run_command(command, script_name):
+    check_modules(command)
+
+    from . import commands
+    getattr(commands, 'command_' + command)(sys.argv[2:], script_name + ' ' + command)
 
 
 class BAM2ECToolsApp(object):
     """
     The most commonly used commands are:
+       batch         convert files listed in a manifest
+       cache         summarize and prune a result cache
+       client        run a command on a bam2ec server
+       collapse      replace targets by groups, i.e. genes
        convert       convert file
+       downsample    downsample binary file counts
        dump          view file
        ec2emase      convert binary file to EMASE format
+       ec2kallisto   convert binary file to kallisto ECs
+       ec2salmon     convert binary file to salmon ECs
        emase2ec      convert EMASE format to binary file
+       info          summarize binary file
+       kallisto2ec   convert kallisto ECs to binary file
+       plan          estimate the resources convert needs
+       prune         remove rare and oversized equivalence classes
+       quantify      estimate expected read counts from binary file
+       remap         merge or drop haplotypes
+       salmon2ec     convert salmon ECs to binary file
+       serve         run commands sent by client in a warm process
+       subset        keep the alignments of a list of targets
 
     """
 
@@ -94,17 +137,67 @@ class BAM2ECToolsApp(object):
         # use dispatch pattern to invoke method with same name
         getattr(self, args.command)()
 
+    def batch(self):
+        run_command('batch', self.script_name)
+
+    def cache(self):
+        run_command('cache', self.script_name)
+
+    def client(self):
+        # only the standard library, not commands, so the client starts fast
+        from . import server
+        server.command_client(sys.argv[2:], self.script_name + ' client')
+
+    def collapse(self):
+        run_command('collapse', self.script_name)
+
     def convert(self):
-        commands.command_convert(sys.argv[2:], self.script_name + ' convert')
+        run_command('convert', self.script_name)
+
+    def downsample(self):
+        run_command('downsample', self.script_name)
 
     def dump(self):
-        commands.command_dump(sys.argv[2:], self.script_name + ' dump')
+        run_command('dump', self.script_name)
 
     def ec2emase(self):
-        commands.command_ec2emase(sys.argv[2:], self.script_name + ' ec2emase')
+        run_command('ec2emase', self.script_name)
+
+    def ec2kallisto(self):
+        run_command('ec2kallisto', self.script_name)
+
+    def ec2salmon(self):
+        run_command('ec2salmon', self.script_name)
 
     def emase2ec(self):
-        commands.command_emase2ec(sys.argv[2:], self.script_name + ' emase2ec')
+        run_command('emase2ec', self.script_name)
+
+    def info(self):
+        run_command('info', self.script_name)
+
+    def kallisto2ec(self):
+        run_command('kallisto2ec', self.script_name)
+
+    def plan(self):
+        run_command('plan', self.script_name)
+
+    def prune(self):
+        run_command('prune', self.script_name)
+
+    def quantify(self):
+        run_command('quantify', self.script_name)
+
+    def remap(self):
+        run_command('remap', self.script_name)
+
+    def salmon2ec(self):
+        run_command('salmon2ec', self.script_name)
+
+    def serve(self):
+        run_command('serve', self.script_name)
+
+    def subset(self):
+        run_command('subset', self.script_name)
 
     def logo(self):
         print logo_text
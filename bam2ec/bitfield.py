@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Haplotype bitfields of alignment rows.
+
+Bit h of the bitfield of an alignment row is set when the reads of the
+equivalence class align to haplotype h of the main target.  The bitfields
+are int32 in EC files, so there are at most 32 haplotypes.
+
+The functions work on whole arrays of bitfields, a byte at a time through
+256 entry lookup tables, instead of a bit at a time in Python:
+
+    on = bitfield.decode(alignments[:, 2], num_haplotypes)   # rows x haplotypes booleans
+    rows, haplotypes = np.nonzero(on)
+    bits = bitfield.encode(on)
+
+to_list and from_list convert one bitfield for trace output.
+"""
+
+import numpy as np
+
+# haplotypes that fit in the int32 bitfield of an EC file
+MAX_HAPLOTYPES = 32
+
+_BYTE_VALUES = np.arange(256, dtype=np.uint8)
+
+# bits of every byte value, least significant first
+_BYTE_BITS = ((_BYTE_VALUES[:, None] >> np.arange(8, dtype=np.uint8)) & 1).astype(bool)
+
+# bit order of every byte value reversed, np.packbits puts the first column in the most significant bit
+_BYTE_REVERSED = np.packbits(_BYTE_BITS, axis=1).ravel()
+
+_BYTE_POPCOUNT = _BYTE_BITS.sum(axis=1).astype(np.uint8)
+
+
+def _check_haplotypes(num_haplotypes):
+    if num_haplotypes > MAX_HAPLOTYPES:
+        raise ValueError("At most {} haplotypes fit in a bitfield, not {:,}".format(MAX_HAPLOTYPES, num_haplotypes))
+
+
+def _bytes(bitfields, num_bytes=4):
+    """
+    :return: the first num_bytes bytes of the bitfields, least significant first, one row per bitfield
+    """
+    bitfields = np.ascontiguousarray(np.asarray(bitfields).ravel().astype('<u4'))
+    return bitfields.view(np.uint8).reshape(-1, 4)[:, :num_bytes]
+
+
+def to_list(value, num_haplotypes):
+    """
+    :return: list of 0/1 per haplotype of one bitfield
+    """
+    return [(value >> i) & 1 for i in xrange(num_haplotypes)]
+
+
+def from_list(bits):
+    """
+    :param bits: 0/1 or booleans per haplotype
+    :return: the bitfield of one list
+    """
+    value = 0
+    for i, bit in enumerate(bits):
+        if bit:
+            value |= 1 << i
+    return value
+
+
+def decode(bitfields, num_haplotypes):
+    """
+    :param bitfields: array of bitfields, int32 values with bit 31 set are negative
+    :param num_haplotypes: number of haplotypes
+    :return: boolean matrix of rows x haplotypes
+    """
+    _check_haplotypes(num_haplotypes)
+    num_bytes = (num_haplotypes + 7) // 8
+    if num_bytes == 0:
+        return np.zeros((len(np.asarray(bitfields).ravel()), 0), dtype=bool)
+
+    data = _bytes(bitfields, num_bytes)
+    return _BYTE_BITS[data].reshape(len(data), num_bytes * 8)[:, :num_haplotypes]
+
+
+def encode(on):
+    """
+    :param on: boolean matrix of rows x haplotypes
+    :return: int64 array of bitfields
+    """
+    on = np.asarray(on, dtype=bool)
+    if on.ndim != 2:
+        raise ValueError("Expected a rows x haplotypes matrix, not {} dimensions".format(on.ndim))
+    _check_haplotypes(on.shape[1])
+
+    num_bytes = (on.shape[1] + 7) // 8
+    data = np.zeros((len(on), 4), dtype=np.uint8)
+    if num_bytes:
+        data[:, :num_bytes] = _BYTE_REVERSED[np.packbits(on, axis=1)]
+
+    return data.view('<u4').ravel().astype(np.int64)
+
+
+def popcount(bitfields):
+    """
+    :return: number of haplotypes set in each bitfield
+    """
+    data = _bytes(bitfields)
+    counts = _BYTE_POPCOUNT[data[:, 0]]
+    for i in xrange(1, 4):
+        counts += _BYTE_POPCOUNT[data[:, i]]
+    return counts.astype(np.int64)
+
+
+def bits(haplotypes):
+    """
+    :param haplotypes: array of haplotype indices, negative for none
+    :return: int64 array of the bitfield of each single haplotype, 0 for negative indices
+    """
+    haplotypes = np.asarray(haplotypes, dtype=np.int64)
+    _check_haplotypes(int(haplotypes.max()) + 1 if haplotypes.size else 0)
+    return np.where(haplotypes >= 0, np.left_shift(1, np.maximum(haplotypes, 0)), 0)
+
+
+def mask(haplotypes):
+    """
+    :param haplotypes: haplotype indices
+    :return: the bitfield with the haplotypes set
+    """
+    value = 0
+    for h in haplotypes:
+        value |= 1 << int(h)
+    return value
+
+
+def remap(bitfields, haplotype_groups):
+    """
+    Replace every haplotype bit by the bit of its group, the groups of a
+    bitfield are OR'ed.
+
+    :param bitfields: array of bitfields
+    :param haplotype_groups: group index of each haplotype, negative to drop the haplotype
+    :return: int64 array of bitfields of groups
+    """
+    haplotype_groups = np.asarray(haplotype_groups, dtype=np.int64)
+    _check_haplotypes(len(haplotype_groups))
+    _check_haplotypes(int(haplotype_groups.max()) + 1 if len(haplotype_groups) else 0)
+
+    num_bytes = (len(haplotype_groups) + 7) // 8
+    data = _bytes(bitfields, max(num_bytes, 1))
+    new_bits = np.zeros(len(data), dtype=np.int64)
+
+    for i in xrange(num_bytes):
+        # group bits of the 8 haplotypes of byte i, OR'ed for every byte value
+        groups = bits(haplotype_groups[8 * i:8 * i + 8])
+        table = np.bitwise_or.reduce(np.where(_BYTE_BITS[:, :len(groups)], groups, 0), axis=1)
+        new_bits |= table[data[:, i]]
+
+    return new_bits
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+"""
+Build equivalence class tables in memory.
+
+    import pysam
+    from bam2ec import builder, em
+
+    sam_file = pysam.AlignmentFile('reads.bam', 'rb')
+    ec = builder.from_alignments(sam_file, sam_file.references)
+    ec.to_file('reads.bin')
+
+    model = em.EM(ec)
+    model.run()
+
+The tables are the same as the ones convert writes: main targets and
+equivalence classes are numbered in the order they are first seen and
+haplotypes are sorted by name.  The alignment rows of an equivalence
+class are in main target order.
+"""
+
+import array
+import logging
+
+from collections import OrderedDict
+
+import numpy as np
+
+from . import bitfield
+from . import ec_file
+from . import transcriptome
+
+LOG = logging.getLogger('BAM2EC')
+
+# records skipped unless exclude_flags is given, unmapped, as convert (util.EXCLUDE_FLAGS)
+EXCLUDE_FLAGS = 0x4
+
+
+def _first_seen_rank(values):
+    """
+    :return: unique values and, per value, its rank by first appearance
+    """
+    unique, first_pos, inverse = np.unique(values, return_index=True, return_inverse=True)
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.argsort(first_pos, kind='mergesort')] = np.arange(len(unique))
+    return unique, first_pos, rank[inverse]
+
+
+def _check_tids(tids, references):
+    if len(tids) and tids.max() >= len(references):
+        raise ValueError("tid {} is not in the {:,} references".format(tids.max(), len(references)))
+
+
+def _main_target_order(tids, lookup, references, haplotypes):
+    """
+    Check the main target and haplotype of every tid used and collect the haplotypes.
+
+    :return: main targets, ordered by their first alignment
+    """
+    used_tids, first_tid_pos, _ = _first_seen_rank(tids)
+
+    first_main_pos = {}
+    for tid, pos in zip(used_tids, first_tid_pos):
+        haplotype = lookup.haplotype(tid)
+        if haplotype is None:
+            raise ValueError("Unable to parse Haplotype from {}".format(references[tid]))
+        haplotypes.add(haplotype)
+
+        main_target = lookup.main_target(tid)
+        first_main_pos[main_target] = min(pos, first_main_pos.get(main_target, pos))
+
+    return sorted(first_main_pos, key=first_main_pos.get)
+
+
+def _check_main_targets(found, main_targets):
+    main_target_names = set(main_targets)
+    for main_target in found:
+        if main_target not in main_target_names:
+            raise ValueError("Unexpected target found in alignments: {}".format(main_target))
+
+
+def _classes(read_ids, tids, num_references):
+    """
+    Group reads with identical tid sets.
+
+    :param read_ids: read of each mapped alignment
+    :param tids: tid of each mapped alignment
+    :param num_references: number of references
+    :return: number of reads, count per equivalence class, numbered by first read, and the
+             equivalence class and tid of every entry, the tids of a class ascending
+    """
+    # distinct (read, tid) pairs, reads numbered in order of appearance
+    _, _, read_rank = _first_seen_rank(read_ids)
+    num_references = max(num_references, 1)
+    pairs = np.unique(read_rank * num_references + tids)
+    pair_read = pairs // num_references
+    pair_tid = pairs % num_references
+
+    num_reads = int(pair_read[-1]) + 1 if len(pairs) else 0
+    read_sizes = np.bincount(pair_read, minlength=num_reads)
+    read_starts = np.concatenate(([0], np.cumsum(read_sizes)[:-1]))
+
+    # reads with identical tid sets, compared as rows of a matrix per set size
+    ec_first_read = [np.zeros(0, dtype=np.int64)]
+    ec_counts = [np.zeros(0, dtype=np.int64)]
+    entry_ec = [np.zeros(0, dtype=np.int64)]
+    entry_tid = [np.zeros(0, dtype=np.int64)]
+    num_ec = 0
+
+    for size in np.unique(read_sizes):
+        reads = np.nonzero(read_sizes == size)[0]
+        rows = pair_tid[read_starts[reads][:, None] + np.arange(size)]
+        unique_rows, first, counts = np.unique(rows, axis=0, return_index=True, return_counts=True)
+
+        ec_first_read.append(reads[first])
+        ec_counts.append(counts)
+        entry_ec.append(np.repeat(np.arange(num_ec, num_ec + len(unique_rows)), size))
+        entry_tid.append(unique_rows.ravel())
+        num_ec += len(unique_rows)
+
+    # number the equivalence classes by their first read
+    order = np.argsort(np.concatenate(ec_first_read), kind='mergesort')
+    new_ec_id = np.empty(num_ec, dtype=np.int64)
+    new_ec_id[order] = np.arange(num_ec)
+
+    return num_reads, np.concatenate(ec_counts)[order], new_ec_id[np.concatenate(entry_ec)], np.concatenate(entry_tid)
+
+
+def _to_ec(references, lookup, main_targets, haplotypes, ec_counts, entry_ec, entry_tid):
+    """
+    :return: ec_file.EC object (version 1) of the equivalence classes given as (class, tid) entries
+    """
+    haplotype_idx = {h: i for i, h in enumerate(haplotypes)}
+    main_target_idx = {m: i for i, m in enumerate(main_targets)}
+
+    tid_main = np.full(len(references), -1, dtype=np.int64)
+    tid_haplotype = np.full(len(references), -1, dtype=np.int64)
+    for tid in np.unique(entry_tid):
+        tid_main[tid] = main_target_idx[lookup.main_target(tid)]
+        tid_haplotype[tid] = haplotype_idx[lookup.haplotype(tid)]
+    tid_bit = bitfield.bits(tid_haplotype)
+
+    # one row per (equivalence class, main target), OR of the haplotype bits
+    num_main_targets = max(len(main_targets), 1)
+    row_keys, row_inverse = np.unique(entry_ec * num_main_targets + tid_main[entry_tid], return_inverse=True)
+    bitfields = np.zeros(len(row_keys), dtype=np.int64)
+    np.bitwise_or.at(bitfields, row_inverse, tid_bit[entry_tid])
+
+    ec = ec_file.EC()
+    ec.version = 1
+    ec._targets_list = main_targets
+    ec._targets_dict = OrderedDict((m, i) for i, m in enumerate(main_targets))
+    ec._haplotypes_list = haplotypes
+    ec._haplotypes_dict = OrderedDict((h, i) for i, h in enumerate(haplotypes))
+    ec._ec_list = range(len(ec_counts))
+    ec._ec_counts_list = np.asarray(ec_counts).astype(np.dtype('i'))
+    ec._alignments = np.column_stack((row_keys // num_main_targets, row_keys % num_main_targets,
+                                      bitfields)).astype(np.dtype('i'))
+
+    LOG.debug("{:,} equivalence classes, {:,} alignment rows".format(len(ec_counts), len(row_keys)))
+
+    return ec
+
+
+def from_arrays(read_ids, tids, references, main_targets=None, lookup=None):
+    """
+    Build an equivalence class table from arrays of alignments.
+
+    :param read_ids: integers, one per alignment, the alignments of a read (or template) share an id;
+                     the ids do not need to be sorted or grouped
+    :param tids: integers, one per alignment, the tid in references, negative for unmapped
+    :param references: reference names of the header, <main target>_<haplotype>, in tid order
+    :param main_targets: None to number main targets as first seen, otherwise the main targets in order,
+                         like the target file of convert
+    :param lookup: transcriptome.Transcriptome of references, built when not given
+    :return: ec_file.EC object (version 1)
+    """
+    read_ids = np.asarray(read_ids).ravel()
+    tids = np.asarray(tids, dtype=np.int64).ravel()
+
+    if len(read_ids) != len(tids):
+        raise ValueError("read_ids and tids have different lengths, {:,} and {:,}".format(len(read_ids), len(tids)))
+
+    mapped = tids >= 0
+    read_ids = read_ids[mapped]
+    tids = tids[mapped]
+
+    _check_tids(tids, references)
+
+    if lookup is None:
+        lookup = transcriptome.build(references)
+
+    haplotypes = set()
+    found = _main_target_order(tids, lookup, references, haplotypes)
+
+    if main_targets is None:
+        main_targets = found
+    else:
+        main_targets = list(main_targets)
+        _check_main_targets(found, main_targets)
+
+    num_reads, ec_counts, entry_ec, entry_tid = _classes(read_ids, tids, len(references))
+
+    LOG.debug("{:,} reads".format(num_reads))
+
+    return _to_ec(references, lookup, main_targets, sorted(haplotypes), ec_counts, entry_ec, entry_tid)
+
+
+class ECBuilder:
+    """
+    Build an equivalence class table a block of alignments at a time.
+
+        table = builder.ECBuilder(sam.references)
+        for read_ids, tids, num_skipped in sam.blocks(exclude_flags):
+            table.add(read_ids, tids)
+        ec = table.ec()
+
+    Only the tid set and count of each equivalence class are kept between
+    blocks, plus the alignments of the last read of a block, which may
+    continue in the next one.  The table is the same as from_arrays of all
+    the blocks.
+    """
+
+    def __init__(self, references, main_targets=None, lookup=None):
+        """
+
+        :param references: reference names of the header, <main target>_<haplotype>, in tid order
+        :param main_targets: None to number main targets as first seen, otherwise the main targets in order
+        :param lookup: transcriptome.Transcriptome of references, built when not given
+        """
+        self.references = references
+        self.lookup = transcriptome.build(references) if lookup is None else lookup
+        self.main_targets = None if main_targets is None else list(main_targets)
+
+        self.num_reads = 0
+
+        # tid set (int32 bytes) -> count, in order of first read
+        self._counts = OrderedDict()
+        self._found = OrderedDict()
+        self._haplotypes = set()
+
+        # alignments of the last read added
+        self._read_ids = np.zeros(0, dtype=np.int64)
+        self._tids = np.zeros(0, dtype=np.int64)
+
+    def _add_reads(self, read_ids, tids):
+        for main_target in _main_target_order(tids, self.lookup, self.references, self._haplotypes):
+            self._found.setdefault(main_target)
+
+        num_reads, ec_counts, entry_ec, entry_tid = _classes(read_ids, tids, len(self.references))
+        self.num_reads += num_reads
+
+        entry_tid = entry_tid[np.argsort(entry_ec, kind='mergesort')].astype(np.int32)
+        ends = np.cumsum(np.bincount(entry_ec, minlength=len(ec_counts)))
+
+        counts = self._counts
+        start = 0
+        for end, count in zip(ends, ec_counts):
+            key = entry_tid[start:end].tostring()
+            counts[key] = counts.get(key, 0) + int(count)
+            start = end
+
+    def add(self, read_ids, tids):
+        """
+        :param read_ids: integers, one per alignment, non decreasing across all the blocks added
+        :param tids: integers, one per alignment, the tid in references, negative for unmapped
+        """
+        read_ids = np.asarray(read_ids, dtype=np.int64).ravel()
+        tids = np.asarray(tids, dtype=np.int64).ravel()
+
+        if len(read_ids) != len(tids):
+            raise ValueError("read_ids and tids have different lengths, {:,} and {:,}".format(len(read_ids),
+                                                                                             len(tids)))
+
+        mapped = tids >= 0
+        read_ids = np.concatenate((self._read_ids, read_ids[mapped]))
+        tids = np.concatenate((self._tids, tids[mapped]))
+
+        _check_tids(tids, self.references)
+
+        if len(read_ids) == 0:
+            return
+
+        done = read_ids < read_ids[-1]
+        self._read_ids = read_ids[~done]
+        self._tids = tids[~done]
+
+        if done.any():
+            self._add_reads(read_ids[done], tids[done])
+
+    def num_ecs(self):
+        return len(self._counts)
+
+    def ec(self):
+        """
+        :return: ec_file.EC object (version 1) of the alignments added
+        """
+        if len(self._tids):
+            self._add_reads(self._read_ids, self._tids)
+            self._read_ids = self._read_ids[0:0]
+            self._tids = self._tids[0:0]
+
+        if self.main_targets is None:
+            main_targets = list(self._found)
+        else:
+            main_targets = self.main_targets
+            _check_main_targets(self._found, main_targets)
+
+        sizes = np.array([len(key) / 4 for key in self._counts], dtype=np.int64)
+        entry_ec = np.repeat(np.arange(len(sizes)), sizes)
+        entry_tid = np.frombuffer(''.join(self._counts), dtype=np.int32).astype(np.int64) if self._counts \
+            else np.zeros(0, dtype=np.int64)
+
+        LOG.debug("{:,} reads".format(self.num_reads))
+
+        return _to_ec(self.references, self.lookup, main_targets, sorted(self._haplotypes),
+                      np.array(self._counts.values(), dtype=np.int64), entry_ec, entry_tid)
+
+
+def from_alignments(alignments, references, main_targets=None, exclude_flags=EXCLUDE_FLAGS):
+    """
+    Build an equivalence class table from alignments grouped by read name.
+
+    Only the (read, tid) of each alignment is kept while the alignments are
+    read, so any iterable can be used: an open pysam file, a generator or a
+    list of AlignedSegments.
+
+    :param alignments: iterable of pysam AlignedSegment, the alignments of a read are consecutive
+    :param references: reference names of the header, in tid order, i.e. sam_file.references
+    :param main_targets: None to number main targets as first seen, otherwise the main targets in order
+    :param exclude_flags: skip alignments with any of these flag bits, like convert
+    :return: ec_file.EC object (version 1)
+    """
+    read_ids = array.array('i')
+    tids = array.array('i')
+
+    read_id = -1
+    qname = None
+
+    for alignment in alignments:
+        if alignment.flag & exclude_flags:
+            continue
+
+        if alignment.query_name != qname:
+            qname = alignment.query_name
+            read_id += 1
+
+        read_ids.append(read_id)
+        tids.append(alignment.reference_id)
+
+    return from_arrays(np.frombuffer(read_ids, dtype=np.dtype('i')), np.frombuffer(tids, dtype=np.dtype('i')),
+                       references, main_targets)
+
+
+def from_file(file_in, main_targets=None, exclude_flags=EXCLUDE_FLAGS):
+    """
+    Build an equivalence class table from a BAM/SAM file grouped by read name.
+
+    :param file_in: BAM/SAM file name
+    :param main_targets: None to number main targets as first seen, otherwise the main targets in order
+    :param exclude_flags: skip alignments with any of these flag bits, like convert
+    :return: ec_file.EC object (version 1)
+    """
+    import pysam
+
+    sam_file = pysam.AlignmentFile(file_in, 'rb' if file_in.endswith('.bam') else 'r')
+    try:
+        return from_alignments(sam_file, sam_file.references, main_targets, exclude_flags)
+    finally:
+        sam_file.close()
@@ -3,11 +3,180 @@
 import argparse
 import sys
 
+from . import profiling
 from . import util
 
 LOG = util.get_logger()
 
 
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", dest="profile", metavar="Report_File")
+    parser.add_argument("--cprofile", dest="cprofile", action='store_true')
+    parser.add_argument("--tracemalloc", dest="tracemalloc", action='store_true')
+
+
+def start_profile(args, command):
+    if args.profile:
+        profiling.enable(args.profile, command, args.cprofile, args.tracemalloc)
+
+
+def command_batch(raw_args, prog=None):
+    """
+    Convert many BAM/SAM files listed in a manifest
+
+    Usage: batch [-options] -m <Manifest file>
+
+    Required Parameters:
+        -m, --manifest <Manifest file>   one job per line: <BAM file> <output file> [<Target file>]
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+        -o, --output <Summary file>      job summary, default <Manifest file>.summary.tsv
+        --cache <directory>              link unchanged results from a result cache, see convert
+        --index <directory>              reuse transcriptome indexes of headers and target files from directory
+        -p, --processes <number>         number of conversions to run at once, default 1
+        -s, --sort <count|target>        number equivalence classes by descending count or lowest target
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_batch.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-m", "--manifest", dest="manifest", metavar="Manifest_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+    parser.add_argument("-o", "--output", dest="output", metavar="Summary_File")
+    parser.add_argument("-p", "--processes", dest="processes", type=int, default=1)
+    parser.add_argument("-s", "--sort", dest="sort", choices=util.ORDERS)
+    parser.add_argument("--cache", dest="cache", metavar="Cache_Directory")
+    parser.add_argument("--index", dest="index", metavar="Index_Directory")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.manifest:
+        LOG.error("No manifest file was specified.")
+        print_message()
+
+    start_profile(args, 'batch')
+
+    try:
+        util.batch(args.manifest, args.output, args.processes, args.emase, args.sort, args.index, args.cache)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_cache(raw_args, prog=None):
+    """
+    Summarize and prune a result cache of convert and ec2emase
+
+    Usage: cache [-options] -c <Cache directory>
+
+    Required Parameters:
+        -c, --cache <directory>          result cache directory
+
+    Optional Parameters:
+        -l, --list                       list the results, least recently used first
+        --max-size <MB>                  remove the least recently used results past MB
+        --clear                          remove every result
+        --verify                         hash every result and remove those that changed, results are
+                                         otherwise only hashed when their size, mtime or inode changed
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_cache.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-c", "--cache", dest="cache", metavar="Cache_Directory")
+
+    # optional
+    parser.add_argument("-l", "--list", dest="list", action='store_true')
+    parser.add_argument("--max-size", dest="max_size", type=float, metavar="MB")
+    parser.add_argument("--clear", dest="clear", action='store_true')
+    parser.add_argument("--verify", dest="verify", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.cache:
+        LOG.error("No cache directory was specified.")
+        print_message()
+
+    if args.max_size is not None and args.max_size < 0:
+        LOG.error("--max-size cannot be negative.")
+        print_message()
+
+    try:
+        util.cache(args.cache, args.max_size, args.clear, args.list, args.verify)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
 def command_convert(raw_args, prog=None):
     """
     Convert a BAM/SAM file
@@ -19,8 +188,40 @@ def command_convert(raw_args, prog=None):
         -o, --output <output file>       file to create
 
     Optional Parameters:
+        -c, --cell <tag>                 cell barcode tag for --umi, default CB
         -e, --emase                      Emase file format
+        -F, --exclude-flags <flags>      skip records with any of these flag bits, default 0x4,
+                                         0xa04 with --paired (unmapped, QC fail, supplementary)
+        -g, --group <tag>                write one file per value of tag, i.e. RG or CB
+        -m, --umi-mismatch               with --umi, also collapse UMIs one mismatch apart
+        -p, --paired                     intersect the targets of read 1 and read 2 of each template
+        -s, --sort <count|target>        number equivalence classes by descending count or lowest target
         -t, --target <Target file>       target file name
+        -u, --umi <tag>                  count each (cell, UMI, equivalence class) once, i.e. UB
+        --cell-sorted                    with --umi, the input is sorted by cell so only the UMIs of
+                                         one cell are kept in memory
+        --index <directory>              reuse the transcriptome index of the header and target file
+                                         from directory, writing it there on first use
+        --min-mapq <MAPQ>                skip records with a lower mapping quality
+        --max-nm <NM>                    skip records with a larger NM tag
+        --min-count <number>             remove equivalence classes with fewer reads
+        --max-targets <number>           remove equivalence classes with more targets
+        --redistribute                   move the reads of removed equivalence classes, see prune
+        --max-memory <MB>                spill the equivalence class table to disk past MB and merge
+                                         at the end, not with -e, -g, -s or -u; --min-count and
+                                         --max-targets prune the merged table as it is written
+        --temp-dir <directory>           directory for spilled tables, default the system temp directory
+        --telemetry <file>               write progress as JSON lines to file, - for stderr
+        --telemetry-interval <seconds>   seconds between progress lines, default 10
+        --cache <directory>              link the output from a result cache when the input, target
+                                         file and options are unchanged, not with -g or standard input
+        --cache-size <MB>                remove the least recently used cached results past MB,
+                                         default 10240
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
 
     Help Parameters:
         -h, --help                       print the help and exit
@@ -48,13 +249,36 @@ def command_convert(raw_args, prog=None):
     parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
 
     # optional
+    parser.add_argument("-c", "--cell", dest="cell", metavar="Tag", default='CB')
     parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+    parser.add_argument("-g", "--group", dest="group", metavar="Tag")
+    parser.add_argument("-m", "--umi-mismatch", dest="umi_mismatch", action='store_true')
+    parser.add_argument("-p", "--paired", dest="paired", action='store_true')
+    parser.add_argument("-F", "--exclude-flags", dest="exclude_flags", type=lambda x: int(x, 0), metavar="Flags")
+    parser.add_argument("-s", "--sort", dest="sort", choices=util.ORDERS)
     parser.add_argument("-t", "--target", dest="target", metavar="Target_File")
+    parser.add_argument("-u", "--umi", dest="umi", metavar="Tag")
+    parser.add_argument("--cell-sorted", dest="cell_sorted", action='store_true')
+    parser.add_argument("--index", dest="index", metavar="Index_Directory")
+    parser.add_argument("--min-mapq", dest="min_mapq", type=int, metavar="MAPQ")
+    parser.add_argument("--max-nm", dest="max_nm", type=int, metavar="NM")
+    parser.add_argument("--min-count", dest="min_count", type=int)
+    parser.add_argument("--max-targets", dest="max_targets", type=int)
+    parser.add_argument("--redistribute", dest="redistribute", action='store_true')
+    parser.add_argument("--max-memory", dest="max_memory", type=float, metavar="MB")
+    parser.add_argument("--temp-dir", dest="temp_dir", metavar="Directory")
+    parser.add_argument("--telemetry", dest="telemetry", metavar="Telemetry_File")
+    parser.add_argument("--telemetry-interval", dest="telemetry_interval", type=float, default=10.0)
+    parser.add_argument("--cache", dest="cache", metavar="Cache_Directory")
+    parser.add_argument("--cache-size", dest="cache_size", type=float, metavar="MB")
 
     # debugging and help
     parser.add_argument("-h", "--help", dest="help", action='store_true')
     parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
 
+    # profiling
+    add_profile_arguments(parser)
+
     args = parser.parse_args(raw_args)
 
     util.configure_logging(args.debug)
@@ -70,8 +294,23 @@ def command_convert(raw_args, prog=None):
         LOG.error("No output file was specified.")
         print_message()
 
+    if args.max_memory is not None:
+        if args.max_memory <= 0:
+            LOG.error("--max-memory must be positive.")
+            print_message()
+
+        if args.emase or args.group or args.sort or args.umi:
+            LOG.error("--max-memory cannot be combined with -e, -g, -s or -u.")
+            print_message()
+
+    start_profile(args, 'convert')
+
     try:
-        util.convert(args.input, args.output, args.target, args.emase)
+        util.convert(args.input, args.output, args.target, args.emase, args.sort, args.group,
+                     args.umi, args.cell, args.umi_mismatch, args.telemetry, args.telemetry_interval,
+                     args.max_memory, args.temp_dir, args.paired, args.exclude_flags, args.min_mapq,
+                     args.max_nm, args.index, args.min_count, args.max_targets, args.redistribute,
+                     args.cache, args.cache_size, args.cell_sorted)
     except KeyboardInterrupt, ki:
         LOG.debug(ki)
     except Exception, e:
@@ -91,6 +330,11 @@ def command_dump(raw_args, prog=None):
     Optional Parameters:
         -v, --verbose                    verbose output
 
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
     Help Parameters:
         -h, --help                       print the help and exit
         -d, --debug                      turn debugging on, list multiple times for more messages
@@ -122,6 +366,9 @@ def command_dump(raw_args, prog=None):
     parser.add_argument("-h", "--help", dest="help", action='store_true')
     parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
 
+    # profiling
+    add_profile_arguments(parser)
+
     args = parser.parse_args(raw_args)
 
     util.configure_logging(args.debug)
@@ -133,6 +380,8 @@ def command_dump(raw_args, prog=None):
         LOG.error("No input file was specified.")
         print_message()
 
+    start_profile(args, 'dump')
+
     try:
         util.dump(args.input, args.verbose)
     except KeyboardInterrupt, ki:
@@ -152,7 +401,14 @@ def command_ec2emase(raw_args, prog=None):
         -o, --output <EMASE file>        file to create
 
     Optional Parameters:
-        None
+        --cache <directory>              link the output from a result cache when the input is unchanged
+        --cache-size <MB>                remove the least recently used cached results past MB,
+                                         default 10240
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
 
     Help Parameters:
         -h, --help                       print the help and exit
@@ -180,11 +436,16 @@ def command_ec2emase(raw_args, prog=None):
     parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
 
     # optional
+    parser.add_argument("--cache", dest="cache", metavar="Cache_Directory")
+    parser.add_argument("--cache-size", dest="cache_size", type=float, metavar="MB")
 
     # debugging and help
     parser.add_argument("-h", "--help", dest="help", action='store_true')
     parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
 
+    # profiling
+    add_profile_arguments(parser)
+
     args = parser.parse_args(raw_args)
 
     util.configure_logging(args.debug)
@@ -200,8 +461,10 @@ def command_ec2emase(raw_args, prog=None):
         LOG.error("No output file was specified.")
         print_message()
 
+    start_profile(args, 'ec2emase')
+
     try:
-        util.ec2emase(args.input, args.output)
+        util.ec2emase(args.input, args.output, cache_dir=args.cache, cache_size=args.cache_size)
     except KeyboardInterrupt, ki:
         LOG.debug(ki)
     except Exception, e:
@@ -222,6 +485,11 @@ def command_emase2ec(raw_args, prog=None):
     Optional Parameters:
         None
 
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
     Help Parameters:
         -h, --help                       print the help and exit
         -d, --debug                      turn debugging on, list multiple times for more messages
@@ -253,6 +521,9 @@ def command_emase2ec(raw_args, prog=None):
     parser.add_argument("-h", "--help", dest="help", action='store_true')
     parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
 
+    # profiling
+    add_profile_arguments(parser)
+
     args = parser.parse_args(raw_args)
 
     util.configure_logging(args.debug)
@@ -268,6 +539,8 @@ def command_emase2ec(raw_args, prog=None):
         LOG.error("No output file was specified.")
         print_message()
 
+    start_profile(args, 'emase2ec')
+
     try:
         util.emase2ec(args.input, args.output)
     except KeyboardInterrupt, ki:
@@ -275,3 +548,1085 @@ def command_emase2ec(raw_args, prog=None):
     except Exception, e:
         util._show_error()
         LOG.error(e)
+
+
+def command_quantify(raw_args, prog=None):
+    """
+    Estimate expected read counts from an EC file
+
+    Usage: quantify [-options] -i <EC file> -o <Output file>
+
+    Required Parameters:
+        -i, --input <EC file>            input file to quantify
+        -o, --output <Output file>       tab delimited expected counts per target and haplotype
+
+    Optional Parameters:
+        -m, --max-iters <number>         maximum number of iterations, default 1000
+        -p, --threads <number>           number of threads, default 1
+        -t, --tolerance <number>         relative change to stop iterating, default 0.0001
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_quantify.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+
+    # optional
+    parser.add_argument("-m", "--max-iters", dest="max_iters", type=int, default=1000)
+    parser.add_argument("-p", "--threads", dest="threads", type=int, default=1)
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=float, default=0.0001)
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    start_profile(args, 'quantify')
+
+    try:
+        util.quantify(args.input, args.output, args.tolerance, args.max_iters, args.threads)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_downsample(raw_args, prog=None):
+    """
+    Downsample the equivalence class counts of an EC file
+
+    Usage: downsample [-options] -i <EC file> -o <Output prefix> -f <fractions>
+
+    Required Parameters:
+        -i, --input <EC file>            input file to downsample
+        -o, --output <Output prefix>     files are written to <Output prefix>_<fraction>.bin
+        -f, --fractions <fractions>      comma separated fractions, i.e. 0.1,0.25,0.5
+
+    Optional Parameters:
+        -m, --method <method>            binomial (default) or multinomial, exact size without replacement
+        -s, --seed <number>              random seed
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_downsample.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_Prefix")
+    parser.add_argument("-f", "--fractions", dest="fractions", metavar="Fractions")
+
+    # optional
+    parser.add_argument("-m", "--method", dest="method", choices=util.SAMPLE_METHODS, default=util.SAMPLE_BINOMIAL)
+    parser.add_argument("-s", "--seed", dest="seed", type=int)
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output prefix was specified.")
+        print_message()
+
+    if not args.fractions:
+        LOG.error("No fractions were specified.")
+        print_message()
+
+    try:
+        fractions = [float(x) for x in args.fractions.split(',')]
+    except ValueError:
+        LOG.error("Unable to parse fractions: {}".format(args.fractions))
+        print_message()
+
+    start_profile(args, 'downsample')
+
+    try:
+        util.downsample(args.input, args.output, fractions, args.method, args.seed)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_prune(raw_args, prog=None):
+    """
+    Remove rare and oversized equivalence classes from a BIN file
+
+    Usage: prune [-options] -i <BIN file> -o <output file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file to prune
+        -o, --output <output file>       file to create
+
+    Optional Parameters:
+        -c, --min-count <number>         remove equivalence classes with fewer reads
+        -e, --emase                      Emase file format
+        -m, --max-targets <number>       remove equivalence classes with more targets
+        -r, --redistribute               move the reads of removed equivalence classes to the surviving
+                                         equivalence class with the most reads sharing a target
+        --report <file>                  list the removed equivalence classes in file
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_prune.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+
+    # optional
+    parser.add_argument("-c", "--min-count", dest="min_count", type=int)
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+    parser.add_argument("-m", "--max-targets", dest="max_targets", type=int)
+    parser.add_argument("-r", "--redistribute", dest="redistribute", action='store_true')
+    parser.add_argument("--report", dest="report", metavar="Report_File")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.min_count and not args.max_targets:
+        LOG.error("Specify --min-count, --max-targets or both.")
+        print_message()
+
+    start_profile(args, 'prune')
+
+    try:
+        util.prune(args.input, args.output, args.min_count, args.max_targets, args.redistribute, args.emase,
+                   args.report)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_subset(raw_args, prog=None):
+    """
+    Keep the alignments of a list of targets in a BIN file
+
+    Usage: subset [-options] -i <BIN file> -t <Target file> -o <output file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+        -o, --output <output file>       file to create
+        -t, --target <Target file>       targets to keep, one per line
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_subset.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+    parser.add_argument("-t", "--target", dest="target", metavar="Target_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.target:
+        LOG.error("No target file was specified.")
+        print_message()
+
+    start_profile(args, 'subset')
+
+    try:
+        util.subset(args.input, args.output, args.target, args.emase)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_collapse(raw_args, prog=None):
+    """
+    Replace the targets of a BIN file by groups, i.e. transcripts by genes
+
+    Usage: collapse [-options] -i <BIN file> -m <Mapping file> -o <output file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+        -o, --output <output file>       file to create
+        -m, --mapping <Mapping file>     target and group per line, targets not listed are kept
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_collapse.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+    parser.add_argument("-m", "--mapping", dest="mapping", metavar="Mapping_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.mapping:
+        LOG.error("No mapping file was specified.")
+        print_message()
+
+    start_profile(args, 'collapse')
+
+    try:
+        util.collapse(args.input, args.output, args.mapping, args.emase)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_remap(raw_args, prog=None):
+    """
+    Replace the haplotypes of a BIN file by groups, i.e. founders by founder groups
+
+    Usage: remap [-options] -i <BIN file> -m <Mapping file> -o <output file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+        -o, --output <output file>       file to create
+        -m, --mapping <Mapping file>     haplotype and group per line, group - drops the haplotype,
+                                         haplotypes not listed are kept
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_remap.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+    parser.add_argument("-m", "--mapping", dest="mapping", metavar="Mapping_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.mapping:
+        LOG.error("No mapping file was specified.")
+        print_message()
+
+    start_profile(args, 'remap')
+
+    try:
+        util.remap(args.input, args.output, args.mapping, args.emase)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_salmon2ec(raw_args, prog=None):
+    """
+    Convert salmon equivalence classes (eq_classes.txt of salmon --dumpEq) to a BIN file
+
+    Usage: salmon2ec [-options] -i <eq_classes.txt> -o <output file>
+
+    Required Parameters:
+        -i, --input <eq_classes.txt>     input file
+        -o, --output <output file>       file to create
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_salmon2ec.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    start_profile(args, 'salmon2ec')
+
+    try:
+        util.salmon2ec(args.input, args.output, args.emase)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_ec2salmon(raw_args, prog=None):
+    """
+    Convert a BIN file to salmon equivalence classes, like the eq_classes.txt of salmon --dumpEq
+
+    Usage: ec2salmon [-options] -i <BIN file> -o <eq_classes.txt>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+        -o, --output <eq_classes.txt>    file to create
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_ec2salmon.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    start_profile(args, 'ec2salmon')
+
+    try:
+        util.ec2salmon(args.input, args.output)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_kallisto2ec(raw_args, prog=None):
+    """
+    Convert kallisto equivalence classes to a BIN file
+
+    Usage: kallisto2ec [-options] -i <matrix.ec> -t <transcripts.txt> -c <Counts file> -o <output file>
+
+    Required Parameters:
+        -i, --input <matrix.ec>          equivalence classes
+        -o, --output <output file>       file to create
+        -t, --transcripts <transcripts.txt>
+                                         transcript names
+        -c, --counts <Counts file>       counts, pseudoalignments.tsv or matrix.tsv
+
+    Optional Parameters:
+        -e, --emase                      Emase file format
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_kallisto2ec.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+    parser.add_argument("-t", "--transcripts", dest="transcripts", metavar="Transcripts_File")
+    parser.add_argument("-c", "--counts", dest="counts", metavar="Counts_File")
+
+    # optional
+    parser.add_argument("-e", "--emase", dest="emase", action='store_true')
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.transcripts:
+        LOG.error("No transcripts file was specified.")
+        print_message()
+
+    if not args.counts:
+        LOG.error("No counts file was specified.")
+        print_message()
+
+    start_profile(args, 'kallisto2ec')
+
+    try:
+        util.kallisto2ec(args.input, args.transcripts, args.counts, args.output, args.emase)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_ec2kallisto(raw_args, prog=None):
+    """
+    Convert a BIN file to kallisto equivalence classes
+
+    Usage: ec2kallisto [-options] -i <BIN file> -o <matrix.ec> -t <transcripts.txt> -c <Counts file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+        -o, --output <matrix.ec>         equivalence classes to create
+        -t, --transcripts <transcripts.txt>
+                                         transcript names to create
+        -c, --counts <Counts file>       counts to create, like pseudoalignments.tsv
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_ec2kallisto.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File")
+    parser.add_argument("-t", "--transcripts", dest="transcripts", metavar="Transcripts_File")
+    parser.add_argument("-c", "--counts", dest="counts", metavar="Counts_File")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if not args.output:
+        LOG.error("No output file was specified.")
+        print_message()
+
+    if not args.transcripts:
+        LOG.error("No transcripts file was specified.")
+        print_message()
+
+    if not args.counts:
+        LOG.error("No counts file was specified.")
+        print_message()
+
+    start_profile(args, 'ec2kallisto')
+
+    try:
+        util.ec2kallisto(args.input, args.output, args.transcripts, args.counts)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_info(raw_args, prog=None):
+    """
+    Summarize a BIN file
+
+    Usage: info [-options] -i <BIN file>
+
+    Required Parameters:
+        -i, --input <BIN file>           input file
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_info.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    start_profile(args, 'info')
+
+    try:
+        util.info(args.input)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_plan(raw_args, prog=None):
+    """
+    Estimate the resources convert needs from the first reads of a BAM/SAM file
+
+    Reports, as JSON, the expected number of reads, equivalence classes and
+    alignment rows, the peak memory of convert and the size of the BIN file,
+    with the memory, --max-memory, --min-count and batch processes to use.
+
+    Usage: plan [-options] -i <BAM file>
+
+    Required Parameters:
+        -i, --input <BAM file>           input file, grouped by read name
+
+    Optional Parameters:
+        -n, --sample-reads <number>      number of reads to sample, default 200,000
+        -o, --output <JSON file>         write the report to a file, default standard output
+        --memory-limit <MB>              memory of a node, default the physical memory of this machine
+
+    Profiling Parameters:
+        --profile <Report file>          write per phase wall/CPU times and record counts as JSON
+        --cprofile                       also run cProfile, stats saved to <Report file>.pstats
+        --tracemalloc                    also take tracemalloc snapshots per phase, if available
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_plan.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # required
+    parser.add_argument("-i", "--input", dest="input", metavar="Input_File")
+
+    # optional
+    parser.add_argument("-n", "--sample-reads", dest="sample_reads", type=int, default=200000)
+    parser.add_argument("-o", "--output", dest="output", metavar="Output_File", default='-')
+    parser.add_argument("--memory-limit", dest="memory_limit", type=float, metavar="MB")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    # profiling
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if not args.input:
+        LOG.error("No input file was specified.")
+        print_message()
+
+    if args.sample_reads < 1:
+        LOG.error("--sample-reads must be positive.")
+        print_message()
+
+    if args.memory_limit is not None and args.memory_limit <= 0:
+        LOG.error("--memory-limit must be positive.")
+        print_message()
+
+    start_profile(args, 'plan')
+
+    try:
+        util.plan(args.input, args.sample_reads, memory_limit=args.memory_limit, report_file=args.output)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
+
+
+def command_serve(raw_args, prog=None):
+    """
+    Run commands sent by bam2ec client in a warm process
+
+    The server keeps pysam, numpy and emase imported, the transcriptome of
+    every header it has seen and the last EC files it has read, and runs
+    the commands on a pool of worker processes.
+
+    Usage: serve [-options]
+
+    Optional Parameters:
+        -s, --socket <Socket file>       Unix socket to listen on, default bam2ec-<uid>.sock in the temp directory
+        -p, --processes <number>         number of worker processes, default the number of CPUs
+        --ec-cache <number>              number of EC files each worker keeps in memory, default 8
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+        -d, --debug                      turn debugging on, list multiple times for more messages
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_serve.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # optional
+    parser.add_argument("-s", "--socket", dest="socket", metavar="Socket_File")
+    parser.add_argument("-p", "--processes", type=int, dest="processes", metavar="Processes")
+    parser.add_argument("--ec-cache", type=int, dest="ec_cache", default=8, metavar="EC_Cache")
+
+    # debugging and help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+    parser.add_argument("-d", "--debug", dest="debug", action="count", default=0)
+
+    args = parser.parse_args(raw_args)
+
+    util.configure_logging(args.debug)
+
+    if args.help:
+        print_message()
+
+    if args.processes is not None and args.processes < 1:
+        LOG.error("--processes needs to be at least 1.")
+        print_message()
+
+    if args.ec_cache < 0:
+        LOG.error("--ec-cache cannot be negative.")
+        print_message()
+
+    from . import server
+
+    try:
+        server.serve(args.socket, args.processes, args.ec_cache)
+    except KeyboardInterrupt, ki:
+        LOG.debug(ki)
+    except Exception, e:
+        util._show_error()
+        LOG.error(e)
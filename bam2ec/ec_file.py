@@ -1,28 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 import sys
 import numpy as np
 from collections import OrderedDict
+from struct import pack
 
+from . import bitfield
+from . import profiling
+from . import transcriptome
 
-LOG = logging.getLogger('BAM2EC')
-
-
-def int_to_list(c, size):
-    ret = [0]*size
-    for i in xrange(0, size):
-        if (c & (1 << i)) != 0:
-            ret[i] = 1
-    return ret
 
+LOG = logging.getLogger('BAM2EC')
 
-def list_to_int(l):
-    c = 0
-    for i, onoff in enumerate(l):
-        if onoff == 1:
-            c |= 1 << i
-    return c
+# EC objects parsed earlier in this process, most recently used last, keyed
+# by (path, size, modification time); off unless set_cache_size is called
+_CACHE = OrderedDict()
+_CACHE_SIZE = 0
 
 
 class EC:
@@ -46,15 +41,82 @@ class EC:
         self._ec_list = []
         self._ec_counts_list = []
 
-        self._alignments = []
+        # rows of (index, target_index, bit_flag)
+        self._alignments = np.zeros((0, 3), dtype=np.dtype('i'))
+
+    @property
+    def targets(self):
+        return self._targets_list
+
+    @property
+    def haplotypes(self):
+        return self._haplotypes_list
+
+    @property
+    def counts(self):
+        return np.asarray(self._ec_counts_list)
+
+    @property
+    def alignments(self):
+        return np.asarray(self._alignments)
+
+    def to_file(self, file_out):
+        write(self, file_out)
+
+    def to_emase(self, file_out):
+        write_emase(self, file_out)
+
+
+def set_cache_size(max_files):
+    """
+    Keep the last max_files parsed EC files in memory, see parse.
+
+    :param max_files: number of files to keep, 0 to turn the cache off
+    """
+    global _CACHE_SIZE
+    _CACHE_SIZE = max_files
+
+    while len(_CACHE) > max_files:
+        _CACHE.popitem(last=False)
 
 
 def parse(file_in):
+    """
+    Parse an EC file.
+
+    With set_cache_size, a file that has not changed since it was last
+    parsed is not read again and the same EC object is returned, callers
+    must not modify it.
+
+    :param file_in: EC file
+    :return: EC object
+    """
+    if not file_in or not _CACHE_SIZE:
+        return _parse(file_in)
+
+    st = os.stat(file_in)
+    key = (os.path.realpath(file_in), st.st_size, st.st_mtime)
+
+    try:
+        ec = _CACHE.pop(key)
+        LOG.info("EC File: {0} (cached)".format(file_in))
+    except KeyError:
+        ec = _parse(file_in)
+
+    _CACHE[key] = ec
+    while len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+    return ec
+
+
+def _parse(file_in):
 
     if not file_in:
         raise ValueError("empty file name, cannot load")
 
     LOG.info("EC File: {0}".format(file_in))
+    profiling.start_phase('Reading EC file')
 
     f = open(file_in, 'rb')
 
@@ -125,14 +187,9 @@ def parse(file_in):
         num_alignments = np.fromfile(f, dtype=np.dtype('i'), count=1)[0]
         LOG.info("Alignment Count: {0:,}".format(num_alignments))
 
-        temp_alignments = np.fromfile(f, dtype = np.dtype('i'), count=num_alignments*3)
-        ec._alignments = []
-
-        for i in xrange(0, num_alignments*3, 3):
-            read_index = temp_alignments[i]
-            target_index = temp_alignments[i+1]
-            bit_flag = temp_alignments[i+2]
-            ec._alignments.append((read_index, target_index, bit_flag))
+        # rows of (read_index, target_index, bit_flag)
+        temp_alignments = np.fromfile(f, dtype=np.dtype('i'), count=num_alignments*3)
+        ec._alignments = temp_alignments.reshape((num_alignments, 3))
     else:
 
 
@@ -147,18 +204,470 @@ def parse(file_in):
         num_alignments = np.fromfile(f, dtype=np.dtype('i'), count=1)[0]
         LOG.info("Alignment Count: {0:,}".format(num_alignments))
 
+        # rows of (ec_index, target_index, bit_flag)
         temp_alignments = np.fromfile(f, dtype=np.dtype('i'), count=num_alignments*3)
-        ec._alignments = []
+        ec._alignments = temp_alignments.reshape((num_alignments, 3))
 
-        for i in xrange(0, num_alignments*3, 3):
-            ec_index = temp_alignments[i]
-            target_index = temp_alignments[i+1]
-            bit_flag = temp_alignments[i+2]
-            ec._alignments.append((ec_index, target_index, bit_flag))
+    profiling.end_phase(num_alignments)
 
     return ec
 
 
+def write(ec, file_out):
+    """
+    Write an equivalence class (version 1) file.
+
+    :param ec: EC object
+    :param file_out: output file name
+    """
+    profiling.start_phase('Writing EC file')
+
+    with open(file_out, 'wb') as f:
+        # version
+        f.write(pack('<i', 1))
+
+        # targets
+        f.write(pack('<i', len(ec._targets_list)))
+        for target in ec._targets_list:
+            f.write(pack('<i', len(target)))
+            f.write(pack('<{}s'.format(len(target)), target))
+
+        # haplotypes
+        f.write(pack('<i', len(ec._haplotypes_list)))
+        for hap in ec._haplotypes_list:
+            f.write(pack('<i', len(hap)))
+            f.write(pack('<{}s'.format(len(hap)), hap))
+
+        # equivalence classes
+        f.write(pack('<i', len(ec._ec_counts_list)))
+        np.asarray(ec._ec_counts_list, dtype='<i4').tofile(f)
+
+        # equivalence class mappings
+        f.write(pack('<i', len(ec._alignments)))
+        np.ascontiguousarray(ec._alignments, dtype='<i4').tofile(f)
+
+    profiling.end_phase(len(ec._alignments))
+
+
+def write_emase(ec, file_out):
+    """
+    Write an equivalence class (version 1) object as an EMASE file.
+
+    :param ec: EC object
+    :param file_out: output file name
+    """
+    from emase import AlignmentPropertyMatrix as APM
+
+    new_shape = (len(ec._targets_list), len(ec._haplotypes_list), len(ec._ec_list))
+
+    LOG.info('Creating APM...')
+    profiling.start_phase('Creating APM')
+    LOG.debug('Shape={}'.format(new_shape))
+
+    apm = APM(shape=new_shape, haplotype_names=ec._haplotypes_list, locus_names=ec._targets_list, read_names=ec._ec_list)
+
+    LOG.debug('ec._haplotypes_list={}'.format(str(ec._haplotypes_list)))
+    LOG.debug('ec._targets_list[0:10]={}'.format(str(ec._targets_list[0:10])))
+    LOG.debug('ec._ec_list[0:10]={}'.format(str(ec._ec_list[0:10])))
+
+    # counts -> the number of times this equivalence class has appeared
+    apm.count = ec._ec_counts_list
+
+    fill_apm(apm, ec._alignments)
+
+    profiling.end_phase(len(ec._alignments))
+
+    LOG.info("Finalizing...")
+    profiling.start_phase('Finalizing')
+    apm.finalize()
+    apm.save(file_out, title='bam2ec')
+    profiling.end_phase()
+
+
+def fill_apm(apm, alignments):
+    """
+    Set the alignments of a new AlignmentPropertyMatrix, a whole sparse
+    matrix per haplotype instead of one value at a time.
+
+    :param apm: emase AlignmentPropertyMatrix created with a shape, it is finalized
+    :param alignments: array of (equivalence class, main target, bitfield) rows
+    """
+    from scipy import sparse
+
+    num_targets, num_haplotypes, num_ecs = apm.shape
+    alignments = np.asarray(alignments).reshape(-1, 3)
+    on = bitfield.decode(alignments[:, 2], num_haplotypes)
+
+    for hid in xrange(num_haplotypes):
+        rows = alignments[on[:, hid]]
+        matrix = sparse.csc_matrix((np.ones(len(rows), dtype=apm.data[hid].dtype), (rows[:, 0], rows[:, 1])),
+                                   shape=(num_ecs, num_targets))
+        # rows repeating an (equivalence class, main target) were summed
+        matrix.data[:] = 1
+        apm.data[hid] = matrix
+
+    apm.finalized = True
+
+
+def select_ecs(ec, keep):
+    """
+    Create a new EC object with only the equivalence classes in keep, renumbered in their original order.
+
+    :param ec: EC object (version 1)
+    :param keep: boolean mask with one entry per equivalence class
+    :return: new EC object
+    """
+    keep = np.asarray(keep, dtype=bool)
+    new_index = np.cumsum(keep) - 1
+
+    alignments = np.asarray(ec._alignments)
+    alignments = alignments[keep[alignments[:, 0]]]
+    alignments[:, 0] = new_index[alignments[:, 0]]
+
+    new_ec = EC(ec.filename)
+    new_ec.version = 1
+    new_ec._targets_list = list(ec._targets_list)
+    new_ec._targets_dict = OrderedDict(ec._targets_dict)
+    new_ec._haplotypes_list = list(ec._haplotypes_list)
+    new_ec._haplotypes_dict = OrderedDict(ec._haplotypes_dict)
+    new_ec._ec_counts_list = np.asarray(ec._ec_counts_list)[keep]
+    new_ec._ec_list = range(len(new_ec._ec_counts_list))
+    new_ec._alignments = alignments
+
+    return new_ec
+
+
+def select_targets(ec, keep_targets):
+    """
+    Create a new EC object with only the alignment rows of the targets in keep_targets.
+
+    Equivalence classes left without rows are removed, targets and equivalence
+    classes are renumbered in their original order.
+
+    :param ec: EC object (version 1)
+    :param keep_targets: boolean mask with one entry per target
+    :return: new EC object
+    """
+    keep_targets = np.asarray(keep_targets, dtype=bool)
+    alignments = np.asarray(ec._alignments)
+
+    rows = alignments[keep_targets[alignments[:, 1]]]
+    keep_ecs = np.bincount(rows[:, 0], minlength=len(ec._ec_counts_list)) > 0
+
+    new_target_index = np.cumsum(keep_targets) - 1
+    new_ec_index = np.cumsum(keep_ecs) - 1
+
+    new_ec = EC(ec.filename)
+    new_ec.version = 1
+    new_ec._targets_list = [t for t, keep in zip(ec._targets_list, keep_targets) if keep]
+    new_ec._targets_dict = OrderedDict((t, i) for i, t in enumerate(new_ec._targets_list))
+    new_ec._haplotypes_list = list(ec._haplotypes_list)
+    new_ec._haplotypes_dict = OrderedDict(ec._haplotypes_dict)
+    new_ec._ec_counts_list = np.asarray(ec._ec_counts_list)[keep_ecs]
+    new_ec._ec_list = range(len(new_ec._ec_counts_list))
+    new_ec._alignments = np.column_stack((new_ec_index[rows[:, 0]], new_target_index[rows[:, 1]],
+                                          rows[:, 2])).astype(np.dtype('i'))
+
+    return new_ec
+
+
+# multipliers of the row hashes, odd 64 bit constants
+_HASH_GROUP = np.uint64(0x9e3779b97f4a7c15)
+_HASH_BITS = np.uint64(0xc2b2ae3d27d4eb4f)
+_HASH_MIX = np.uint64(0x94d049bb133111eb)
+
+
+def _row_hashes(targets, bits):
+    """
+    :return: 64 bit hash of each (target, bitfield) row
+    """
+    with np.errstate(over='ignore'):
+        h = targets.astype(np.uint64) * _HASH_GROUP ^ bits.astype(np.uint32).astype(np.uint64) * _HASH_BITS
+        h ^= h >> np.uint64(31)
+        h *= _HASH_MIX
+        h ^= h >> np.uint64(29)
+    return h
+
+
+def _exact_ec_ids(ec_rows, targets, bits, num_ec):
+    """
+    Number the distinct equivalence classes by comparing their rows, one matrix per number of rows.
+
+    :return: per equivalence class, the smallest index of an identical equivalence class
+    """
+    sizes = np.bincount(ec_rows, minlength=num_ec)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    first = np.arange(num_ec)
+
+    for size in np.unique(sizes[sizes > 0]):
+        ecs = np.nonzero(sizes == size)[0]
+        positions = starts[ecs][:, None] + np.arange(size)
+        signature = np.hstack((targets[positions], bits[positions]))
+        _, inverse = np.unique(signature, axis=0, return_inverse=True)
+        smallest = np.full(inverse.max() + 1, num_ec, dtype=np.int64)
+        np.minimum.at(smallest, inverse, ecs)
+        first[ecs] = smallest[inverse]
+
+    return first
+
+
+def _merge_rows(counts, ec_rows, targets, bits, targets_list, haplotypes_list, filename=None):
+    """
+    Build an EC object from remapped alignment rows.
+
+    Rows that fall on the same (equivalence class, target) have their
+    bitfields OR'ed, rows without bits are dropped and equivalence classes
+    that end up with the same rows are merged, summing their counts.  The
+    equivalence classes are compared with a hash of their rows, checked
+    against the rows themselves.  The equivalence classes keep the order of
+    the first one of each merged set.
+
+    :param counts: count of each original equivalence class
+    :param ec_rows: equivalence class of each row
+    :param targets: new target index of each row
+    :param bits: new bitfield of each row
+    :param targets_list: new target names
+    :param haplotypes_list: new haplotype names
+    :param filename: file name of the new EC object
+    :return: new EC object
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    num_ec = len(counts)
+    num_targets = max(len(targets_list), 1)
+
+    keep = bits != 0
+    keys, inverse = np.unique(ec_rows[keep].astype(np.int64) * num_targets + targets[keep], return_inverse=True)
+    row_bits = np.zeros(len(keys), dtype=np.int64)
+    np.bitwise_or.at(row_bits, inverse, bits[keep])
+
+    row_ec = keys // num_targets
+    row_target = keys % num_targets
+    has_rows = np.bincount(row_ec, minlength=num_ec) > 0
+
+    # equivalence classes with the same number of rows and sum of row hashes
+    ec_hash = np.zeros(num_ec, dtype=np.uint64)
+    np.add.at(ec_hash, row_ec, _row_hashes(row_target, row_bits))
+    ec_size = np.bincount(row_ec, minlength=num_ec)
+
+    order = np.lexsort((np.arange(num_ec), ec_hash, ec_size))
+    new_set = np.ones(num_ec, dtype=bool)
+    new_set[1:] = (ec_hash[order][1:] != ec_hash[order][:-1]) | (ec_size[order][1:] != ec_size[order][:-1])
+    first = np.empty(num_ec, dtype=np.int64)
+    first[order] = order[np.nonzero(new_set)[0][np.cumsum(new_set) - 1]]
+
+    # rows are in (ec, target) order, so identical equivalence classes have identical row sequences
+    ec_start = np.concatenate(([0], np.cumsum(ec_size)[:-1]))
+    offsets = np.arange(len(keys)) - ec_start[row_ec]
+    other = ec_start[first[row_ec]] + offsets
+    if (row_target[other] != row_target).any() or (row_bits[other] != row_bits).any():
+        LOG.debug("Hash collision between equivalence classes, comparing rows")
+        first = _exact_ec_ids(row_ec, row_target, row_bits, num_ec)
+
+    representative = has_rows & (first == np.arange(num_ec))
+    new_index = np.cumsum(representative) - 1
+    new_counts = np.bincount(new_index[first[has_rows]], weights=counts[has_rows],
+                             minlength=representative.sum()).astype(np.int64)
+
+    rows = representative[row_ec]
+
+    new_ec = EC(filename)
+    new_ec.version = 1
+    new_ec._targets_list = list(targets_list)
+    new_ec._targets_dict = OrderedDict((t, i) for i, t in enumerate(new_ec._targets_list))
+    new_ec._haplotypes_list = list(haplotypes_list)
+    new_ec._haplotypes_dict = OrderedDict((h, i) for i, h in enumerate(new_ec._haplotypes_list))
+    new_ec._ec_counts_list = new_counts.astype(np.dtype('i'))
+    new_ec._ec_list = range(len(new_counts))
+    new_ec._alignments = np.column_stack((new_index[row_ec[rows]], row_target[rows],
+                                          row_bits[rows])).astype(np.dtype('i'))
+
+    return new_ec
+
+
+def collapse_targets(ec, target_groups, group_names):
+    """
+    Create a new EC object with the targets replaced by groups, i.e. transcripts by genes.
+
+    :param ec: EC object (version 1)
+    :param target_groups: group index of each target
+    :param group_names: names of the groups
+    :return: new EC object
+    """
+    target_groups = np.asarray(target_groups, dtype=np.int64)
+    alignments = np.asarray(ec._alignments)
+
+    return _merge_rows(ec._ec_counts_list, alignments[:, 0], target_groups[alignments[:, 1]],
+                       alignments[:, 2].astype(np.int64), group_names, ec._haplotypes_list, ec.filename)
+
+
+def remap_haplotypes(ec, haplotype_groups, group_names):
+    """
+    Create a new EC object with the haplotypes replaced by groups, i.e. founders by founder groups.
+
+    The bitfields are remapped by bitfield.remap, a byte at a time.
+
+    :param ec: EC object (version 1)
+    :param haplotype_groups: group index of each haplotype, negative to drop the haplotype
+    :param group_names: names of the groups
+    :return: new EC object
+    """
+    if len(group_names) > bitfield.MAX_HAPLOTYPES:
+        raise ValueError("At most {} haplotype groups fit in a bitfield, not {:,}".format(bitfield.MAX_HAPLOTYPES,
+                                                                                          len(group_names)))
+
+    alignments = np.asarray(ec._alignments)
+    new_bits = bitfield.remap(alignments[:, 2], haplotype_groups)
+
+    return _merge_rows(ec._ec_counts_list, alignments[:, 0], alignments[:, 1].astype(np.int64), new_bits,
+                       ec._targets_list, group_names, ec.filename)
+
+
+def from_transcript_sets(transcripts, ec_sizes, tids, counts, filename=None):
+    """
+    Create an EC object from equivalence classes of transcripts, i.e. kallisto or salmon ones.
+
+    Transcript names are split into main target and haplotype like the
+    reference names of convert.  Main targets are in transcript order,
+    haplotypes are sorted.  Equivalence classes without reads are dropped.
+
+    :param transcripts: transcript names, <main target>_<haplotype>
+    :param ec_sizes: number of transcripts of each equivalence class
+    :param tids: transcript indices of all the equivalence classes, one after the other
+    :param counts: number of reads of each equivalence class
+    :param filename: file name of the new EC object
+    :return: EC object (version 1)
+    """
+    lookup = transcriptome.build(transcripts)
+
+    missing = np.nonzero(lookup._tid_haplotype < 0)[0]
+    if len(missing):
+        raise ValueError("Unable to parse Haplotype from {}".format(transcripts[missing[0]]))
+
+    haplotypes = sorted(lookup._haplotype_names)
+    sorted_index = np.array([haplotypes.index(h) for h in lookup._haplotype_names], dtype=np.int64)
+    tid_bit = bitfield.bits(sorted_index)[lookup._tid_haplotype]
+    tid_main = lookup._tid_main.astype(np.int64)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    tids = np.asarray(tids, dtype=np.int64)
+    ec_rows = np.repeat(np.arange(len(counts)), ec_sizes)
+
+    bits = tid_bit[tids]
+    bits[counts[ec_rows] == 0] = 0
+
+    return _merge_rows(counts, ec_rows, tid_main[tids], bits, lookup._main_names, haplotypes, filename)
+
+
+def to_transcript_sets(ec):
+    """
+    Expand the bitfields of an EC object into equivalence classes of transcripts.
+
+    Only the (main target, haplotype) pairs with alignments become
+    transcripts, named <main target>_<haplotype> in target then haplotype
+    order.
+
+    :param ec: EC object (version 1)
+    :return: transcript names, number of transcripts of each equivalence class and
+             the transcript indices of the equivalence classes, one after the other
+    """
+    alignments = np.asarray(ec._alignments)
+    num_haplotypes = len(ec._haplotypes_list)
+
+    rows, haplotypes = np.nonzero(bitfield.decode(alignments[:, 2], num_haplotypes))
+    pairs = alignments[rows, 1].astype(np.int64) * num_haplotypes + haplotypes
+
+    used, tids = np.unique(pairs, return_inverse=True)
+    transcripts = ['{}_{}'.format(ec._targets_list[p // num_haplotypes], ec._haplotypes_list[p % num_haplotypes])
+                   for p in used.tolist()]
+
+    ec_rows = alignments[rows, 0]
+    order = np.lexsort((tids, ec_rows))
+    ec_sizes = np.bincount(ec_rows, minlength=len(ec._ec_counts_list))
+
+    return transcripts, ec_sizes, tids[order]
+
+
+def _group_last(sorted_keys):
+    """
+    :return: boolean mask of the last entry of each run of equal keys
+    """
+    last = np.ones(len(sorted_keys), dtype=bool)
+    last[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+    return last
+
+
+def filter_ecs(ec, min_count=None, max_targets=None, redistribute=False):
+    """
+    Remove rare and oversized equivalence classes.
+
+    With redistribute, the reads of a removed equivalence class are added to
+    the surviving equivalence class with the most reads among those sharing
+    a target with it; reads with no such equivalence class are dropped.
+    The counts used to choose are the ones before redistribution.  The
+    survivors keep their relative order.
+
+    :param ec: EC object (version 1)
+    :param min_count: remove equivalence classes with fewer reads
+    :param max_targets: remove equivalence classes with more targets (alignment rows)
+    :param redistribute: move the reads of removed equivalence classes instead of dropping them
+    :return: tuple of (new EC object, dict describing what was removed: 'ec' original indexes,
+             'count', 'targets', 'rare' and 'oversized' masks and 'redistributed_to' new indexes
+             or -1, all aligned with 'ec')
+    """
+    counts = np.asarray(ec._ec_counts_list, dtype=np.int64)
+    alignments = np.asarray(ec._alignments)
+    ec_index = alignments[:, 0]
+    target_index = alignments[:, 1]
+
+    num_targets = np.bincount(ec_index, minlength=len(counts))
+
+    rare = counts < min_count if min_count else np.zeros(len(counts), dtype=bool)
+    oversized = num_targets > max_targets if max_targets else np.zeros(len(counts), dtype=bool)
+    keep = ~(rare | oversized)
+
+    new_index = np.cumsum(keep) - 1
+    new_counts = counts[keep]
+    redistributed_to = np.full(len(counts), -1, dtype=np.int64)
+
+    if redistribute and not keep.all() and keep.any():
+        kept_row = keep[ec_index]
+
+        # the surviving equivalence class with the most reads on each target, lowest index on ties
+        best_ec = np.full(len(ec._targets_list), -1, dtype=np.int64)
+        best_count = np.full(len(ec._targets_list), -1, dtype=np.int64)
+        rows = np.nonzero(kept_row)[0]
+        rows = rows[np.lexsort((-ec_index[rows], counts[ec_index[rows]], target_index[rows]))]
+        rows = rows[_group_last(target_index[rows])]
+        best_ec[target_index[rows]] = ec_index[rows]
+        best_count[target_index[rows]] = counts[ec_index[rows]]
+
+        # for each removed equivalence class, the best of the candidates of its targets
+        rows = np.nonzero(~kept_row & (best_ec[target_index] >= 0))[0]
+        candidate = best_ec[target_index[rows]]
+        rows = rows[np.lexsort((-candidate, best_count[target_index[rows]], ec_index[rows]))]
+        rows = rows[_group_last(ec_index[rows])]
+        redistributed_to[ec_index[rows]] = best_ec[target_index[rows]]
+
+        moved = np.nonzero(redistributed_to >= 0)[0]
+        redistributed_to[moved] = new_index[redistributed_to[moved]]
+        np.add.at(new_counts, redistributed_to[moved], counts[moved])
+
+    new_ec = select_ecs(ec, keep)
+    new_ec._ec_counts_list = new_counts.astype(np.dtype('i'))
+
+    removed = np.nonzero(~keep)[0]
+    report = {
+        'ec': removed,
+        'count': counts[removed],
+        'targets': num_targets[removed],
+        'rare': rare[removed],
+        'oversized': oversized[removed],
+        'redistributed_to': redistributed_to[removed],
+    }
+
+    return new_ec, report
+
+
 def dump(binary_file_name, detail=False):
     """
 
@@ -250,9 +759,8 @@ def dump(binary_file_name, detail=False):
                 if temp_bits == 0:
                     continue
 
-                bits = int_to_list(temp_bits, num_haplotypes)
                 if detail:
-                    LOG.info("{}\t{}\t{}".format(rid, target_ids[lid], bits))
+                    LOG.info("{}\t{}\t{}".format(rid, target_ids[lid], bitfield.to_list(temp_bits, num_haplotypes)))
 
         else:
 
@@ -283,8 +791,7 @@ def dump(binary_file_name, detail=False):
                     if temp_bits == 0:
                         continue
 
-                    bits = int_to_list(temp_bits, num_haplotypes)
-                    LOG.info("{}\t{}\t{}\t".format(rid, target_ids[lid], bits))
+                    LOG.info("{}\t{}\t{}\t".format(rid, target_ids[lid], bitfield.to_list(temp_bits, num_haplotypes)))
     except:
         util._show_error()
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy import sparse
+
+from . import bitfield
+
+LOG = logging.getLogger('BAM2EC')
+
+
+class EM:
+    """
+    Expectation maximization over an equivalence class file.
+
+    The compatibility structure is a sparse matrix with one row per
+    equivalence class and one column per (target, haplotype) pair.  The
+    rows are split into batches so the sparse matrix-vector products can
+    run on a thread pool, scipy releases the GIL inside its sparse kernels.
+    """
+
+    def __init__(self, ec, num_threads=1):
+        """
+
+        :param ec: an ec_file.EC object (version 1)
+        :param num_threads: number of threads used for the matrix-vector products
+        """
+        self.num_targets = len(ec._targets_list)
+        self.num_haplotypes = len(ec._haplotypes_list)
+        self.num_ecs = len(ec._ec_list)
+        self.num_threads = max(1, num_threads)
+
+        self.counts = np.asarray(ec._ec_counts_list, dtype=np.float64)
+        self.total = self.counts.sum()
+
+        alignments = np.asarray(ec._alignments)
+
+        # (row, haplotype) pairs that are turned on in the bitfield
+        row_idx, hap_idx = np.nonzero(bitfield.decode(alignments[:, 2], self.num_haplotypes))
+
+        rows = alignments[row_idx, 0]
+        cols = alignments[row_idx, 1] * self.num_haplotypes + hap_idx
+
+        shape = (self.num_ecs, self.num_targets * self.num_haplotypes)
+        compat = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        compat.sum_duplicates()
+        compat.data[:] = 1.0
+
+        LOG.debug('Compatibility matrix shape={}, nnz={:,}'.format(shape, compat.nnz))
+
+        # batches of rows, each with its own transpose for the M step
+        bounds = np.linspace(0, self.num_ecs, self.num_threads + 1).astype(int)
+        self._batches = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            block = compat[start:end]
+            self._batches.append((block, block.T.tocsr(), self.counts[start:end]))
+
+        self.theta = np.zeros(shape[1])
+        self.expected = np.zeros(shape[1])
+
+        # whether the last run reached tolerance before max_iters
+        self.converged = False
+
+    def _responsibility(self, batch):
+        block, block_t, counts = batch
+        denom = block.dot(self.theta)
+        weights = np.zeros(len(counts))
+        nonzero = denom > 0
+        weights[nonzero] = counts[nonzero] / denom[nonzero]
+        return block_t.dot(weights)
+
+    def step(self, pool=None):
+        """
+        Perform one EM iteration.
+
+        :param pool: optional thread pool to run the batches on
+        :return: the total absolute change in expected counts
+        """
+        if pool:
+            partials = pool.map(self._responsibility, self._batches)
+        else:
+            partials = [self._responsibility(batch) for batch in self._batches]
+
+        expected = self.theta * np.sum(partials, axis=0)
+        change = np.abs(expected - self.expected).sum()
+
+        self.expected = expected
+        self.theta = expected / self.total
+
+        return change
+
+    def run(self, tolerance=0.0001, max_iters=1000):
+        """
+        Iterate until the relative change in expected counts drops below tolerance.
+
+        :param tolerance: relative change (change / total count) that signals convergence
+        :param max_iters: maximum number of iterations
+        :return: the number of iterations performed
+        """
+        if self.total == 0:
+            LOG.info("No counts, nothing to quantify")
+            self.converged = True
+            return 0
+
+        self.theta = np.ones(len(self.theta)) / len(self.theta)
+        self.expected = np.zeros(len(self.theta))
+
+        pool = ThreadPool(self.num_threads) if self.num_threads > 1 else None
+
+        self.converged = False
+        try:
+            num_iters = 0
+            while num_iters < max_iters:
+                num_iters += 1
+                err = self.step(pool) / self.total
+                LOG.debug('Iteration {:,}, relative change={}'.format(num_iters, err))
+                if err < tolerance:
+                    self.converged = True
+                    break
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if not self.converged:
+            LOG.info("Reached {:,} iterations without converging".format(max_iters))
+
+        return num_iters
+
+    def get_expected_counts(self):
+        """
+        :return: array of shape (num_targets, num_haplotypes) with the expected read counts
+        """
+        return self.expected.reshape((self.num_targets, self.num_haplotypes))
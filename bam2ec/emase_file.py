@@ -4,24 +4,12 @@ import logging
 from collections import OrderedDict
 
 import emase
+import numpy as np
 
-LOG = logging.getLogger('BAM2EC')
-
-
-def int_to_list(c, size):
-    ret = [0]*size
-    for i in xrange(0, size):
-        if (c & (1 << i)) != 0:
-            ret[i] = 1
-    return ret
-
+from . import bitfield
+from . import profiling
 
-def list_to_int(l):
-    c = 0
-    for i, onoff in enumerate(l):
-        if onoff == 1:
-            c |= 1 << i
-    return c
+LOG = logging.getLogger('BAM2EC')
 
 
 class EMASE:
@@ -53,6 +41,7 @@ def parse(file_in):
         raise ValueError("empty file name, cannot load")
 
     LOG.info("Emase File: {0}".format(file_in))
+    profiling.start_phase('Reading EMASE file')
 
     #f = open(file_in, 'rb')
 
@@ -69,14 +58,23 @@ def parse(file_in):
     em._ec_list = list(apm.rname)
     em._ec_counts_list = list(apm.count)
 
-    for ec_idx, ec in enumerate(em._ec_list):
-        for target, target_idx in em._target_dict.iteritems():
-            bits = []
+    # the (equivalence class, target) entries of every haplotype matrix, one row per pair in that order
+    num_targets = max(len(em._target_list), 1)
+    matrices = [apm.data[hap_idx].tocoo() for hap_idx in xrange(len(em._haplotypes_list))]
+    matrices = [(m.row[m.data != 0], m.col[m.data != 0]) for m in matrices]
+
+    pairs = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                           [rows.astype(np.int64) * num_targets + cols for rows, cols in matrices])
+    haplotypes = np.repeat(np.arange(len(matrices)), [len(rows) for rows, _ in matrices])
+    pairs, inverse = np.unique(pairs, return_inverse=True)
+
+    on = np.zeros((len(pairs), len(matrices)), dtype=bool)
+    on[inverse, haplotypes] = True
 
-            for hap, hap_idx in em._haplotypes_dict.iteritems():
-                bits.append(apm.data[hap_idx][ec_idx, target_idx])
+    em._alignments = np.column_stack((pairs // num_targets, pairs % num_targets,
+                                      bitfield.encode(on))).astype(np.dtype('i'))
 
-            em._alignments.append((ec_idx, target_idx, list_to_int(bits)))
+    profiling.end_phase(len(em._alignments))
 
     return em
 
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+kallisto equivalence classes.
+
+    transcripts.txt    one transcript name per line, in transcript index order
+    matrix.ec          <ec id>\t<transcript index>,<transcript index>,...
+    counts             <ec id>\t<count>, or <ec id>\t<cell>\t<count> (summed over cells)
+
+The counts are the pseudoalignments.tsv of kallisto pseudo or the
+matrix.tsv of kallisto pseudo --batch.  The first equivalence classes of
+matrix.ec are the single transcripts, in transcript order.
+"""
+
+import array
+import itertools
+import logging
+
+import numpy as np
+
+from . import ec_file
+
+LOG = logging.getLogger('BAM2EC')
+
+# matrix.ec lines parsed at once
+BLOCK_LINES = 65536
+
+
+def _parse_block(lines):
+    """
+    :return: ids, number of transcripts and transcript indices of the equivalence classes in lines
+    """
+    num_fields = np.array([line.count(',') + 2 for line in lines], dtype=np.int64)
+    values = np.fromstring(' '.join(lines).replace(',', ' '), dtype=np.int64, sep=' ')
+
+    if len(values) != num_fields.sum():
+        raise ValueError("Unable to parse matrix.ec line")
+
+    starts = np.concatenate(([0], np.cumsum(num_fields)[:-1]))
+    is_id = np.zeros(len(values), dtype=bool)
+    is_id[starts] = True
+
+    return values[starts], num_fields - 1, values[~is_id]
+
+
+def _read_transcripts(transcripts_file):
+    with open(transcripts_file, 'r') as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def parse(matrix_file, transcripts_file, counts_file):
+    """
+    :param matrix_file: matrix.ec
+    :param transcripts_file: transcripts.txt
+    :param counts_file: equivalence class counts
+    :return: ec_file.EC object (version 1)
+    """
+    transcripts = _read_transcripts(transcripts_file)
+
+    blocks = []
+
+    with open(matrix_file, 'r') as f:
+        while True:
+            lines = [line for line in itertools.islice(f, BLOCK_LINES) if line.strip()]
+            if not lines:
+                break
+            blocks.append(_parse_block(lines))
+
+    ec_ids, ec_sizes, tids = [np.concatenate([b[i] for b in blocks]) if blocks else np.zeros(0, dtype=np.int64)
+                              for i in xrange(3)]
+
+    misplaced = np.nonzero(ec_ids != np.arange(len(ec_ids)))[0]
+    if len(misplaced):
+        raise ValueError("Equivalence class {} is on line {:,} of {}".format(ec_ids[misplaced[0]], misplaced[0] + 1,
+                                                                           matrix_file))
+
+    ec_ids = array.array('i')
+    counts = array.array('d')
+
+    with open(counts_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            ec_ids.append(int(fields[0]))
+            counts.append(float(fields[-1]))
+
+    ec_ids = np.frombuffer(ec_ids, dtype=np.dtype('i'))
+    if len(ec_ids) and ec_ids.max() >= len(ec_sizes):
+        raise ValueError("Equivalence class {} of {} is not in {}".format(ec_ids.max(), counts_file, matrix_file))
+
+    counts = np.bincount(ec_ids, weights=np.frombuffer(counts, dtype=np.float64), minlength=len(ec_sizes))
+
+    LOG.info("{:,} transcripts, {:,} equivalence classes, {:,} reads".format(len(transcripts), len(ec_sizes),
+                                                                         int(counts.sum())))
+
+    return ec_file.from_transcript_sets(transcripts, ec_sizes, tids, np.rint(counts), matrix_file)
+
+
+def write(ec, matrix_file, transcripts_file, counts_file):
+    """
+    :param ec: ec_file.EC object (version 1)
+    :param matrix_file: matrix.ec to create
+    :param transcripts_file: transcripts.txt to create
+    :param counts_file: equivalence class counts to create
+    """
+    transcripts, ec_sizes, tids = ec_file.to_transcript_sets(ec)
+    counts = np.asarray(ec._ec_counts_list, dtype=np.int64)
+
+    with open(transcripts_file, 'w') as f:
+        for transcript in transcripts:
+            f.write(transcript)
+            f.write('\n')
+
+    # single transcript equivalence classes first, numbered by their transcript
+    num_transcripts = len(transcripts)
+    single = ec_sizes == 1
+    starts = np.concatenate(([0], np.cumsum(ec_sizes)[:-1]))
+
+    single_counts = np.bincount(tids[starts[single]], weights=counts[single], minlength=num_transcripts)
+
+    kallisto_ids = np.empty(len(ec_sizes), dtype=np.int64)
+    kallisto_ids[single] = tids[starts[single]]
+    kallisto_ids[~single] = num_transcripts + np.arange((~single).sum())
+
+    with open(matrix_file, 'w') as f:
+        for tid in xrange(num_transcripts):
+            f.write('{}\t{}\n'.format(tid, tid))
+        tid_strings = tids.astype(str)
+        for i in np.nonzero(~single)[0].tolist():
+            f.write('{}\t{}\n'.format(kallisto_ids[i], ','.join(tid_strings[starts[i]:starts[i] + ec_sizes[i]])))
+
+    with open(counts_file, 'w') as f:
+        for tid, count in enumerate(single_counts.astype(np.int64).tolist()):
+            f.write('{}\t{}\n'.format(tid, count))
+        for i in np.nonzero(~single)[0].tolist():
+            f.write('{}\t{}\n'.format(kallisto_ids[i], counts[i]))
+
+    LOG.info("{:,} transcripts, {:,} equivalence classes".format(num_transcripts,
+                                                                  num_transcripts + (~single).sum()))
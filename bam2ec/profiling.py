@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+# standard in Python 3, available for Python 2 as the pytracemalloc backport
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger('BAM2EC')
+
+
+def _cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _max_rss_kb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, KB on Linux
+    return max_rss / 1024 if sys.platform == 'darwin' else max_rss
+
+
+class Profiler:
+    """
+    Wall time, CPU time and record counts of the phases of a command.
+
+    Phases are sequential, starting a phase ends the one before it, so a
+    command only has to mark where each phase begins.  Every call returns
+    immediately when profiling is not enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.report_file = None
+        self.command = None
+
+        self.phases = []
+        self._current = None
+
+        self._cprofile = None
+        self._tracemalloc = False
+
+        self._wall_start = None
+        self._cpu_start = None
+
+    def enable(self, report_file, command=None, cprofile=False, trace_memory=False):
+        self.enabled = True
+        self.report_file = report_file
+        self.command = command
+
+        self._wall_start = time.time()
+        self._cpu_start = _cpu_time()
+
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+        if trace_memory:
+            if tracemalloc:
+                tracemalloc.start()
+                self._tracemalloc = True
+            else:
+                LOG.info("tracemalloc is not available, only peak RSS will be reported")
+
+    def start_phase(self, name):
+        if not self.enabled:
+            return
+
+        self.end_phase()
+
+        self._current = {
+            'name': name,
+            'records': 0,
+            'wall_start': time.time(),
+            'cpu_start': _cpu_time(),
+        }
+
+    def add_records(self, num_records):
+        if self._current:
+            self._current['records'] += num_records
+
+    def end_phase(self, num_records=0):
+        if not self._current:
+            return
+
+        phase = self._current
+        self._current = None
+
+        phase['records'] += num_records
+        phase['wall_seconds'] = round(time.time() - phase.pop('wall_start'), 6)
+        phase['cpu_seconds'] = round(_cpu_time() - phase.pop('cpu_start'), 6)
+        phase['max_rss_kb'] = _max_rss_kb()
+
+        if phase['wall_seconds'] > 0 and phase['records']:
+            phase['records_per_second'] = round(phase['records'] / phase['wall_seconds'], 1)
+
+        if self._tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            phase['traced_memory_kb'] = current / 1024
+            phase['traced_peak_kb'] = peak / 1024
+            phase['top_allocations'] = [str(stat) for stat in
+                                        tracemalloc.take_snapshot().statistics('lineno')[0:10]]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        self.phases.append(phase)
+
+    def write(self):
+        if not self.enabled:
+            return
+
+        self.end_phase()
+        self.enabled = False
+
+        report = {
+            'command': self.command,
+            'wall_seconds': round(time.time() - self._wall_start, 6),
+            'cpu_seconds': round(_cpu_time() - self._cpu_start, 6),
+            'max_rss_kb': _max_rss_kb(),
+            'phases': self.phases,
+        }
+
+        if self._cprofile:
+            import pstats
+            self._cprofile.disable()
+
+            stats_file = self.report_file + '.pstats'
+            self._cprofile.dump_stats(stats_file)
+            report['cprofile_stats'] = stats_file
+
+            stats = pstats.Stats(self._cprofile)
+            top = sorted(stats.stats.iteritems(), key=lambda item: item[1][3], reverse=True)[0:25]
+            report['cprofile_top_cumulative'] = [
+                {'function': '{}:{}({})'.format(*func), 'calls': nc, 'total_seconds': round(tt, 6),
+                 'cumulative_seconds': round(ct, 6)}
+                for func, (cc, nc, tt, ct, callers) in top]
+
+        with open(self.report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        LOG.info("Profile written to {}".format(self.report_file))
+
+
+PROFILER = Profiler()
+
+
+def _write_at_exit():
+    # registered once, writes whichever profiler is current at exit
+    PROFILER.write()
+
+
+atexit.register(_write_at_exit)
+
+
+def reset():
+    """
+    Write the report of the current profiler, if enabled, and replace it with a new one.
+    """
+    global PROFILER
+    PROFILER.write()
+    PROFILER = Profiler()
+
+
+def enable(report_file, command=None, cprofile=False, trace_memory=False):
+    """
+    Start profiling, the report is written to report_file at exit.
+
+    :param report_file: JSON report file
+    :param command: name of the command being profiled
+    :param cprofile: run cProfile, the stats are written to <report_file>.pstats
+    :param trace_memory: take tracemalloc snapshots at the end of each phase (Python 3)
+    """
+    PROFILER.enable(report_file, command, cprofile, trace_memory)
+
+
+def start_phase(name):
+    PROFILER.start_phase(name)
+
+
+def add_records(num_records):
+    PROFILER.add_records(num_records)
+
+
+def end_phase(num_records=0):
+    PROFILER.end_phase(num_records)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content addressed cache of the output files of convert and ec2emase.
+
+    bam2ec convert --cache /scratch/bam2ec-cache -i sample.bam -o sample.bin
+
+A result is keyed by the SHA-1 of the content of its input files, the
+options that change the output and the cache format version.  On a hit
+the cached file is hard linked to the output file, or copied when the
+cache is on another file system, and nothing is recomputed.
+
+The digest of an input file is kept in the cache under its path, size,
+modification time and inode, so an unchanged file is only read once.
+Every entry has a JSON file with its size, modification time, inode, the
+SHA-1 of its content and when it was last used.  An entry is only hashed
+again before it is used when its size, modification time or inode changed,
+or when asked to verify it; the least recently used entries are removed
+past the size limit.
+
+This module only imports the standard library.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from . import __version__
+
+LOG = logging.getLogger('BAM2EC')
+
+# changes when a cached result of the same input and options would differ
+FORMAT_VERSION = 1
+
+# default size limit of a cache in MB
+DEFAULT_MAX_MB = 10240
+
+# bytes read at once when hashing a file
+READ_BYTES = 1 << 20
+
+META_EXTENSION = '.json'
+
+
+def file_digest(file_name):
+    """
+    :return: hex SHA-1 of the content of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        while True:
+            data = f.read(READ_BYTES)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def _write_atomic(file_name, text):
+    fd, temp_file = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(file_name))
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.rename(temp_file, file_name)
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src to dst, replacing dst, or copy it across file systems.
+    """
+    temp_file = '{}.tmp{}'.format(dst, os.getpid())
+    try:
+        os.link(src, temp_file)
+    except OSError:
+        shutil.copyfile(src, temp_file)
+    os.rename(temp_file, dst)
+
+
+class ResultCache:
+    """
+    A cache directory of command outputs.
+
+        cache = ResultCache('/scratch/bam2ec-cache')
+        key = cache.key('convert', ['sample.bam'], {'order': None})
+        if not cache.fetch(key, 'sample.bin'):
+            ...  # write sample.bin
+            cache.store(key, 'sample.bin', 'convert', ['sample.bam'])
+    """
+
+    def __init__(self, cache_dir, max_mb=DEFAULT_MAX_MB):
+        """
+
+        :param cache_dir: cache directory, created when missing
+        :param max_mb: size limit in MB, least recently used entries are removed past it
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._inputs_dir = os.path.join(cache_dir, 'inputs')
+
+        for directory in (self._objects_dir, self._inputs_dir):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process in the meantime
+                    if not os.path.isdir(directory):
+                        raise
+
+    def _entry(self, key):
+        return os.path.join(self._objects_dir, key)
+
+    def _read_meta(self, key):
+        try:
+            with open(self._entry(key) + META_EXTENSION) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def input_digest(self, file_name):
+        """
+        :return: hex SHA-1 of the content of an input file, read only when the file changed
+        """
+        st = os.stat(file_name)
+        identity = '{}\t{}\t{}\t{}\t{}'.format(os.path.realpath(file_name), st.st_size, st.st_mtime,
+                                               st.st_dev, st.st_ino)
+        memo_file = os.path.join(self._inputs_dir, hashlib.sha1(identity).hexdigest())
+
+        try:
+            with open(memo_file) as f:
+                return f.read().strip()
+        except IOError:
+            pass
+
+        digest = file_digest(file_name)
+        _write_atomic(memo_file, digest + '\n')
+        return digest
+
+    def key(self, command, input_files, options):
+        """
+        :param command: command name, i.e. convert
+        :param input_files: files the output is computed from, None for a missing optional file
+        :param options: dictionary of the options that change the output, values are JSON types
+        :return: hex key of the result
+        """
+        identity = {
+            'format': FORMAT_VERSION,
+            'version': __version__,
+            'command': command,
+            'inputs': [self.input_digest(f) if f else None for f in input_files],
+            'options': options,
+        }
+        return hashlib.sha1(json.dumps(identity, sort_keys=True)).hexdigest()
+
+    def _check(self, key, meta, verify=False):
+        """
+        :return: True when the entry of key still has the content it was stored with
+        """
+        entry = self._entry(key)
+        try:
+            st = os.stat(entry)
+        except OSError:
+            return False
+
+        if st.st_size != meta['size']:
+            return False
+
+        # an output linked to the entry may have been written over in place, which changes its mtime
+        if not verify and (st.st_mtime, st.st_ino) == (meta.get('mtime'), meta.get('inode')):
+            return True
+
+        if file_digest(entry) != meta['sha1']:
+            return False
+
+        meta['mtime'] = st.st_mtime
+        meta['inode'] = st.st_ino
+        return True
+
+    def fetch(self, key, file_out, verify=False):
+        """
+        Link the cached result of key to file_out.
+
+        :param verify: hash the entry even when its size, modification time and inode are unchanged
+        :return: True on a hit, False when key is not cached or its entry changed
+        """
+        entry = self._entry(key)
+        meta = self._read_meta(key)
+        if meta is None or not os.path.exists(entry):
+            return False
+
+        if not self._check(key, meta, verify):
+            LOG.info("Cached result {} changed, removing it".format(key))
+            self.remove(key)
+            return False
+
+        if not (os.path.exists(file_out) and os.path.samefile(entry, file_out)):
+            _link_or_copy(entry, file_out)
+
+        meta['last_used'] = time.time()
+        _write_atomic(entry + META_EXTENSION, json.dumps(meta, sort_keys=True))
+
+        return True
+
+    def verify(self):
+        """
+        Hash every entry and remove those whose content changed.
+
+        :return: number of entries removed
+        """
+        num_removed = 0
+        for key, meta in self.entries():
+            if self._check(key, meta, verify=True):
+                _write_atomic(self._entry(key) + META_EXTENSION, json.dumps(meta, sort_keys=True))
+            else:
+                LOG.info("Cached result {} changed, removing it".format(key))
+                self.remove(key)
+                num_removed += 1
+
+        return num_removed
+
+    def store(self, key, file_out, command, input_files):
+        """
+        Add file_out as the result of key and remove old entries past the size limit.
+        """
+        entry = self._entry(key)
+        _link_or_copy(file_out, entry)
+
+        now = time.time()
+        st = os.stat(entry)
+        meta = {
+            'command': command,
+            'inputs': [os.path.abspath(f) if f else None for f in input_files],
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'inode': st.st_ino,
+            'sha1': file_digest(entry),
+            'created': now,
+            'last_used': now,
+        }
+        _write_atomic(entry + META_EXTENSION, json.dumps(meta, sort_keys=True))
+
+        self.prune()
+
+    def remove(self, key):
+        entry = self._entry(key)
+        for file_name in (entry + META_EXTENSION, entry):
+            try:
+                os.remove(file_name)
+            except OSError:
+                # removed by another process
+                pass
+
+    def entries(self):
+        """
+        :return: list of (key, metadata), least recently used first
+        """
+        entries = []
+        for name in os.listdir(self._objects_dir):
+            if name.endswith(META_EXTENSION):
+                key = name[:-len(META_EXTENSION)]
+                meta = self._read_meta(key)
+                if meta is not None:
+                    entries.append((key, meta))
+
+        entries.sort(key=lambda entry: entry[1]['last_used'])
+        return entries
+
+    def size(self):
+        """
+        :return: total size of the entries in bytes
+        """
+        return sum(meta['size'] for _, meta in self.entries())
+
+    def prune(self, max_bytes=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+
+        :param max_bytes: size to prune to, default the size limit of the cache
+        :return: number of entries and bytes removed
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        entries = self.entries()
+        total = sum(meta['size'] for _, meta in entries)
+        num_removed = 0
+        bytes_removed = 0
+
+        for key, meta in entries:
+            if total <= max_bytes:
+                break
+            self.remove(key)
+            total -= meta['size']
+            num_removed += 1
+            bytes_removed += meta['size']
+
+        if num_removed:
+            LOG.debug("Removed {:,} cached results, {:,} bytes".format(num_removed, bytes_removed))
+
+        return num_removed, bytes_removed
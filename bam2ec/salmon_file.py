@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+salmon equivalence classes, the eq_classes.txt of salmon --dumpEq.
+
+    <number of transcripts>
+    <number of equivalence classes>
+    <transcript name>                 one line per transcript
+    <k> <tid 1> ... <tid k> <count>   one line per equivalence class
+
+With --dumpEqWeights the k weights come before the count, they are ignored.
+"""
+
+import itertools
+import logging
+
+import numpy as np
+
+from . import ec_file
+
+LOG = logging.getLogger('BAM2EC')
+
+# equivalence class lines parsed at once
+BLOCK_LINES = 65536
+
+
+def _parse_block(lines):
+    """
+    :return: number of transcripts, transcript indices and count of the equivalence classes in lines
+    """
+    num_fields = np.array([len(line.split()) for line in lines], dtype=np.int64)
+    values = np.fromstring(' '.join(lines), dtype=np.float64, sep=' ')
+
+    if len(values) != num_fields.sum():
+        raise ValueError("Unable to parse equivalence class line")
+
+    starts = np.concatenate(([0], np.cumsum(num_fields)[:-1]))
+    sizes = values[starts].astype(np.int64)
+
+    first_tid = np.repeat(starts + 1 - np.concatenate(([0], np.cumsum(sizes)[:-1])), sizes)
+    tids = values[first_tid + np.arange(sizes.sum())].astype(np.int64)
+
+    return sizes, tids, values[starts + num_fields - 1]
+
+
+def parse(file_in):
+    """
+    :param file_in: eq_classes.txt
+    :return: ec_file.EC object (version 1)
+    """
+    blocks = []
+
+    with open(file_in, 'r') as f:
+        num_transcripts = int(f.readline())
+        num_ecs = int(f.readline())
+        transcripts = [f.readline().split()[0] for _ in xrange(num_transcripts)]
+
+        while True:
+            lines = [line for line in itertools.islice(f, BLOCK_LINES) if line.strip()]
+            if not lines:
+                break
+            blocks.append(_parse_block(lines))
+
+    ec_sizes, tids, counts = [np.concatenate([b[i] for b in blocks]) if blocks else np.zeros(0)
+                              for i in xrange(3)]
+
+    if len(ec_sizes) != num_ecs:
+        raise ValueError("{} has {:,} equivalence classes, expected {:,}".format(file_in, len(ec_sizes), num_ecs))
+
+    LOG.info("{:,} transcripts, {:,} equivalence classes, {:,} reads".format(num_transcripts, num_ecs,
+                                                                         int(counts.sum())))
+
+    return ec_file.from_transcript_sets(transcripts, ec_sizes.astype(np.int64), tids.astype(np.int64),
+                                        np.rint(counts), file_in)
+
+
+def write(ec, file_out):
+    """
+    :param ec: ec_file.EC object (version 1)
+    :param file_out: eq_classes.txt to create
+    """
+    transcripts, ec_sizes, tids = ec_file.to_transcript_sets(ec)
+    counts = np.asarray(ec._ec_counts_list, dtype=np.int64).tolist()
+
+    starts = np.concatenate(([0], np.cumsum(ec_sizes))).tolist()
+    tid_strings = tids.astype(str)
+
+    with open(file_out, 'w') as f:
+        f.write('{}\n{}\n'.format(len(transcripts), len(counts)))
+        for transcript in transcripts:
+            f.write(transcript)
+            f.write('\n')
+        for i, count in enumerate(counts):
+            f.write('{} {} {}\n'.format(starts[i + 1] - starts[i], ' '.join(tid_strings[starts[i]:starts[i + 1]]),
+                                        count))
+
+    LOG.info("{:,} transcripts, {:,} equivalence classes".format(len(transcripts), len(counts)))
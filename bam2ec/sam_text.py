@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lean reader of uncompressed SAM text for convert.
+
+Only the first three columns, QNAME, FLAG and RNAME, are looked at.  The
+text is read in large buffers and every buffer becomes numpy arrays of read
+numbers and tids, so there is no per record object as with pysam.
+"""
+
+import logging
+import sys
+
+import numpy as np
+
+LOG = logging.getLogger('BAM2EC')
+
+# bytes read at once
+BUFFER_BYTES = 1 << 24
+
+# first bytes of a gzip (BGZF, so BAM or compressed SAM) file
+GZIP_MAGIC = '\x1f\x8b'
+
+NEWLINE = ord('\n')
+TAB = ord('\t')
+
+_HASH_MULTIPLIER = np.uint64(1099511628211)
+
+
+def _columns(buf, starts, ends):
+    """
+    :return: the bytes from starts to ends, one zero padded row per record
+    """
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    offsets = np.arange(width)
+    inside = offsets < lengths[:, None]
+    columns = buf[np.where(inside, starts[:, None] + offsets, 0)]
+    columns[~inside] = 0
+    return columns
+
+
+def _parse_ints(columns):
+    """
+    :return: the decimal numbers in zero padded rows of digits
+    """
+    values = np.zeros(len(columns), dtype=np.int64)
+    for j in xrange(columns.shape[1]):
+        digit = columns[:, j]
+        is_digit = digit != 0
+        values[is_digit] = values[is_digit] * 10 + (digit[is_digit] - ord('0'))
+    return values
+
+
+class SAMText:
+    """
+    The header and the alignments of a SAM text file or standard input.
+
+        sam = SAMText('reads.sam')
+        for read_ids, tids, num_skipped in sam.blocks(exclude_flags):
+            ...
+
+    references and lengths are the @SQ lines of the header, like those of a
+    pysam AlignmentFile, so the object can be given to transcriptome.from_header.
+    """
+
+    def __init__(self, file_in, buffer_bytes=BUFFER_BYTES):
+        """
+
+        :param file_in: SAM file name, '-' for standard input
+        :param buffer_bytes: bytes read at once
+        """
+        self.file_name = file_in
+        self.buffer_bytes = buffer_bytes
+        self._f = sys.stdin if file_in == '-' else open(file_in, 'rb')
+
+        # bytes read so far
+        self.position = 0
+
+        self.references = []
+        self.lengths = []
+
+        self._rest = ''
+        self._first_data = self._read_header()
+        self._tids = {name: tid for tid, name in enumerate(self.references)}
+        self._tids['*'] = -1
+
+    def _read(self):
+        data = self._f.read(self.buffer_bytes)
+        self.position += len(data)
+        return data
+
+    def _buffer(self):
+        """
+        :return: the next buffer cut after its last newline, '' at the end of the file
+        """
+        while True:
+            data = self._read()
+            if not data:
+                data, self._rest = self._rest, ''
+                return data + '\n' if data else ''
+
+            cut = data.rfind('\n') + 1
+            if cut:
+                data, self._rest = self._rest + data[:cut], data[cut:]
+                return data
+
+            self._rest += data
+
+    def _read_header(self):
+        data = self._buffer()
+        if data.startswith(GZIP_MAGIC):
+            raise ValueError("{} is compressed, not SAM text".format(self.file_name))
+
+        while data:
+            start = 0
+            while start < len(data) and data[start] == '@':
+                end = data.index('\n', start)
+                line = data[start:end].rstrip('\r')
+                start = end + 1
+
+                if line.startswith('@SQ'):
+                    tags = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+                    self.references.append(tags['SN'])
+                    self.lengths.append(int(tags.get('LN', 0)))
+
+            if start < len(data):
+                return data[start:]
+
+            data = self._buffer()
+
+        return ''
+
+    def _rnames_to_tids(self, rnames):
+        """
+        :param rnames: zero padded RNAME bytes, one row per record
+        :return: tids
+        """
+        width = rnames.shape[1]
+        hashes = np.zeros(len(rnames), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for j in xrange(width):
+                hashes = hashes * _HASH_MULTIPLIER + rnames[:, j]
+
+        unique_hashes, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+
+        # only one RNAME per hash, compared byte for byte
+        if (rnames != rnames[first[inverse]]).any():
+            LOG.debug("RNAME hash collision, looking up every record")
+            first = np.arange(len(rnames))
+            inverse = first
+
+        try:
+            unique_tids = np.array([self._tids[name] for name in rnames[first].view('S{}'.format(width)).ravel()],
+                                   dtype=np.int32)
+        except KeyError, e:
+            raise ValueError("Reference {} is not in the header of {}".format(e, self.file_name))
+
+        return unique_tids[inverse]
+
+    def blocks(self, exclude_flags=0):
+        """
+        Read the alignments a buffer at a time.
+
+        Reads are numbered from 0 in the order they appear, a new read starts
+        when QNAME changes, so the alignments of a read need to be consecutive.
+
+        :param exclude_flags: skip records with any of these flag bits
+        :return: generator of (read numbers, tids, number of records skipped), tids are -1 for unmapped
+        """
+        last_qname = None
+        num_reads = 0
+
+        data = self._first_data
+        self._first_data = None
+
+        while data:
+            buf = np.frombuffer(data, dtype=np.uint8)
+
+            ends = np.flatnonzero(buf == NEWLINE)
+            starts = np.concatenate(([0], ends[:-1] + 1))
+            not_empty = ends > starts
+            starts = starts[not_empty]
+            ends = ends[not_empty]
+
+            # the first three tabs of every line
+            tabs = np.flatnonzero(buf == TAB)
+            first_tab = np.searchsorted(tabs, starts)
+            if len(starts) and (first_tab[-1] + 2 >= len(tabs) or (tabs[np.minimum(first_tab + 2, len(tabs) - 1)]
+                                                                   > ends).any()):
+                raise ValueError("SAM record with fewer than 4 columns in {}".format(self.file_name))
+
+            tab1 = tabs[first_tab]
+            tab2 = tabs[first_tab + 1]
+            tab3 = tabs[first_tab + 2]
+
+            flags = _parse_ints(_columns(buf, tab1 + 1, tab2))
+            keep = flags & exclude_flags == 0
+
+            qnames = _columns(buf, starts[keep], tab1[keep])
+            tids = self._rnames_to_tids(_columns(buf, tab2[keep] + 1, tab3[keep]))
+
+            if len(qnames):
+                new_read = np.empty(len(qnames), dtype=bool)
+                # rows are zero padded to the longest QNAME of the buffer
+                new_read[0] = qnames[0].tostring().rstrip('\0') != last_qname
+                new_read[1:] = (qnames[1:] != qnames[:-1]).any(axis=1)
+
+                read_ids = num_reads - 1 + np.cumsum(new_read, dtype=np.int64)
+                num_reads = int(read_ids[-1]) + 1
+                last_qname = qnames[-1].tostring().rstrip('\0')
+
+                yield read_ids, tids, len(keep) - len(qnames)
+            else:
+                yield np.zeros(0, dtype=np.int64), tids, len(keep)
+
+            data = self._buffer()
+
+    def close(self):
+        if self._f is not sys.stdin:
+            self._f.close()
+
+
+def is_sam_text(file_in):
+    """
+    :return: True for standard input and files that are not gzip/BGZF compressed, i.e. not BAM
+    """
+    if file_in == '-':
+        return True
+
+    with open(file_in, 'rb') as f:
+        return f.read(2) != GZIP_MAGIC
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""
+A warm bam2ec process that runs commands sent over a local Unix socket.
+
+    bam2ec serve -p 4 &
+    bam2ec client convert -i sample.bam -o sample.bin
+
+The server imports pysam, numpy and emase once and forks a pool of worker
+processes.  The workers live as long as the server, so the transcriptomes
+of the headers they have seen and the last EC files they have read stay in
+memory between requests.  A request is the argument list of a command, it
+is run in a worker by the same function the command line uses and its
+output is sent back to the client.
+
+This module only imports the standard library so the client starts fast.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+
+from cStringIO import StringIO
+
+LOG = logging.getLogger('BAM2EC')
+
+# commands a server runs, their results do not depend on state kept between requests
+SERVED_COMMANDS = ('convert', 'ec2emase', 'info', 'subset')
+
+# longest request line accepted
+MAX_REQUEST_BYTES = 1 << 20
+
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(), 'bam2ec-{}.sock'.format(os.getuid()))
+
+
+def _init_worker(ec_cache):
+    # the server handles ^C and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from . import ec_file
+    ec_file.set_cache_size(ec_cache)
+
+
+def _run(argv, cwd, prog):
+    """
+    Run a command in a worker with its output captured.
+
+    :return: exit status, standard output and standard error of the command
+    """
+    from . import commands
+    from . import profiling
+
+    log = logging.getLogger('BAM2EC')
+    handlers = list(log.handlers)
+    level = log.level
+
+    stdout, stderr = sys.stdout, sys.stderr
+    out, err = StringIO(), StringIO()
+    status = 0
+
+    try:
+        os.chdir(cwd)
+        sys.stdout, sys.stderr = out, err
+        # the command adds its own handler writing to err
+        log.handlers = []
+        getattr(commands, 'command_' + argv[0])(argv[1:], prog)
+    except SystemExit, e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception, e:
+        err.write('Error: {}\n'.format(e))
+        status = 1
+    finally:
+        # atexit does not run between requests, write the --profile report now
+        profiling.reset()
+
+        sys.stdout, sys.stderr = stdout, stderr
+        log.handlers = handlers
+        log.setLevel(level)
+
+    return status, out.getvalue(), err.getvalue()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def _reply(self, status, stdout='', stderr=''):
+        self.wfile.write(json.dumps({'status': status, 'stdout': stdout, 'stderr': stderr}))
+        self.wfile.write('\n')
+
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        if not line:
+            # closed without a request, i.e. _socket_in_use
+            return
+
+        try:
+            request = json.loads(line)
+            argv = [str(arg) for arg in request['argv']]
+            cwd = str(request['cwd'])
+            prog = request.get('prog')
+        except (ValueError, KeyError, TypeError), e:
+            self._reply(2, stderr='Invalid request: {}\n'.format(e))
+            return
+
+        if not argv or argv[0] not in SERVED_COMMANDS:
+            self._reply(2, stderr='The server runs these commands: {}\n'.format(', '.join(SERVED_COMMANDS)))
+            return
+
+        LOG.info("{} (in {})".format(' '.join(argv), cwd))
+
+        status, stdout, stderr = self.server.pool.apply_async(_run, (argv, cwd, prog)).get()
+
+        LOG.debug("{} exited with {}".format(argv[0], status))
+
+        self._reply(status, stdout, stderr)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def _socket_in_use(socket_file):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(socket_file=None, processes=None, ec_cache=8):
+    """
+    Serve requests until interrupted or terminated.
+
+    :param socket_file: Unix socket to listen on, default see default_socket
+    :param processes: number of worker processes, default the number of CPUs
+    :param ec_cache: number of EC files each worker keeps, see ec_file.set_cache_size
+    """
+    import multiprocessing
+
+    # imported before the workers are forked so requests do not pay for them
+    import emase
+    import numpy
+    import pysam
+    from . import commands
+    from . import util
+
+    socket_file = socket_file or default_socket()
+
+    if os.path.exists(socket_file):
+        if _socket_in_use(socket_file):
+            raise ValueError("A server is already listening on {}".format(socket_file))
+        os.remove(socket_file)
+
+    pool = multiprocessing.Pool(processes, _init_worker, (ec_cache,))
+
+    server = _Server(socket_file, _Handler, bind_and_activate=False)
+    server.pool = pool
+
+    def stop(signum, frame):
+        # serve_forever swallows an exception raised while it starts a request
+        # thread, shut down from another thread instead
+        LOG.debug("Received signal {}".format(signum))
+        threading.Thread(target=server.shutdown).start()
+
+    # before listening, a client can signal the server once it connects
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    old_umask = os.umask(0177)
+    try:
+        server.server_bind()
+        server.server_activate()
+    finally:
+        os.umask(old_umask)
+
+    LOG.info("Listening on {} with {} worker processes".format(socket_file, processes or multiprocessing.cpu_count()))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        os.remove(socket_file)
+        LOG.info("Stopped")
+
+
+def request(argv, socket_file=None, prog=None):
+    """
+    Run a command on a server.
+
+    :param argv: command and its arguments, i.e. ['convert', '-i', 'sample.bam', '-o', 'sample.bin']
+    :param socket_file: Unix socket of the server, default see default_socket
+    :param prog: program name used in the usage messages of the command
+    :return: exit status, standard output and standard error of the command
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file or default_socket())
+        sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd(), 'prog': prog}) + '\n')
+
+        f = sock.makefile('rb')
+        try:
+            reply = json.loads(f.readline())
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+    return reply['status'], reply['stdout'], reply['stderr']
+
+
+def command_client(raw_args, prog=None):
+    """
+    Run a command on a bam2ec server, see bam2ec serve
+
+    The command is one of convert, ec2emase, info and subset, with the same
+    parameters as on the command line.  Relative paths are resolved in the
+    current directory.
+
+    Usage: client [-options] <command> [command options]
+
+    Optional Parameters:
+        -s, --socket <Socket file>       Unix socket of the server, default bam2ec-<uid>.sock in the temp directory
+
+    Help Parameters:
+        -h, --help                       print the help and exit
+
+    """
+
+    if prog:
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    else:
+        parser = argparse.ArgumentParser(add_help=False)
+
+    def print_message(message=None):
+        if message:
+            sys.stderr.write(message)
+        else:
+            sys.stderr.write(command_client.__doc__)
+        sys.stderr.write('\n')
+        sys.exit(1)
+
+    parser.error = print_message
+
+    # optional
+    parser.add_argument("-s", "--socket", dest="socket", metavar="Socket_File")
+
+    # help
+    parser.add_argument("-h", "--help", dest="help", action='store_true')
+
+    parser.add_argument("command", nargs='?')
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args(raw_args)
+
+    if args.help or not args.command:
+        print_message()
+
+    if args.command not in SERVED_COMMANDS:
+        print_message("The server runs these commands: {}\n".format(', '.join(SERVED_COMMANDS)))
+
+    command_prog = (prog.rsplit(' ', 1)[0] + ' ' if prog else '') + args.command
+
+    try:
+        status, stdout, stderr = request([args.command] + args.args, args.socket, command_prog)
+    except socket.error, e:
+        print_message("Unable to reach a bam2ec server at {}: {}\n".format(args.socket or default_socket(), e))
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+
+LOG = logging.getLogger('BAM2EC')
+
+# estimated bytes held per equivalence class by convert, on top of the length
+# of its key: the key string and the entries in the ec, ec_idx and OrderedDict
+EC_ENTRY_BYTES = 250
+
+# most runs merged at once, more runs are merged in several passes
+MAX_MERGE_FILES = 64
+
+
+def _read_run(file_name):
+    with open(file_name, 'r') as f:
+        for line in f:
+            key, count = line.rstrip('\n').split('\t')
+            yield key, int(count)
+
+
+def _merge_sum(iterables):
+    """
+    Merge sorted (key, count) streams, summing the counts of equal keys.
+    """
+    current_key = None
+    current_count = 0
+
+    for key, count in heapq.merge(*iterables):
+        if key == current_key:
+            current_count += count
+        else:
+            if current_key is not None:
+                yield current_key, current_count
+            current_key = key
+            current_count = count
+
+    if current_key is not None:
+        yield current_key, current_count
+
+
+class ECSpill:
+    """
+    Sorted runs of (equivalence class key, count) spilled to temporary files
+    when the equivalence class table of convert reaches a memory budget.
+
+    The runs are merged at the end into a single run sorted by key, so the
+    equivalence classes are numbered in key order and the output does not
+    depend on when, or whether, the table was spilled.
+    """
+
+    def __init__(self, max_bytes, temp_dir=None):
+        """
+
+        :param max_bytes: estimated size of the table that triggers a spill
+        :param temp_dir: directory for the runs, default the system temporary directory
+        """
+        self.max_bytes = max_bytes
+        self.work_dir = tempfile.mkdtemp(prefix='bam2ec_spill_', dir=temp_dir)
+
+        self.size = 0
+        self.runs = []
+        self.merged = None
+        self.num_ec = 0
+
+    def add(self, ec_key):
+        """
+        Account for a new key in the table.
+        """
+        self.size += EC_ENTRY_BYTES + len(ec_key)
+
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def write_run(self, ec):
+        """
+        Write the table as a sorted run and empty it.
+
+        :param ec: dictionary of ec key -> count
+        """
+        if not ec:
+            return
+
+        run_file = os.path.join(self.work_dir, 'run_{:06d}.tsv'.format(len(self.runs)))
+        with open(run_file, 'w') as f:
+            for key in sorted(ec):
+                f.write('{}\t{}\n'.format(key, ec[key]))
+
+        LOG.debug("Spilled {:,} equivalence classes to {}".format(len(ec), run_file))
+
+        self.runs.append(run_file)
+        ec.clear()
+        self.size = 0
+
+    def _merge_files(self, run_files, merged_file):
+        with open(merged_file, 'w') as f:
+            num_ec = 0
+            for key, count in _merge_sum([_read_run(r) for r in run_files]):
+                f.write('{}\t{}\n'.format(key, count))
+                num_ec += 1
+
+        for run_file in run_files:
+            os.remove(run_file)
+
+        return num_ec
+
+    def merge(self, ec):
+        """
+        Spill what is left of the table and merge all the runs into one.
+
+        :param ec: dictionary of ec key -> count
+        :return: number of distinct equivalence classes
+        """
+        self.write_run(ec)
+
+        runs = self.runs
+        passes = 0
+
+        while len(runs) > MAX_MERGE_FILES:
+            passes += 1
+            next_runs = []
+            for i in xrange(0, len(runs), MAX_MERGE_FILES):
+                merged_file = os.path.join(self.work_dir, 'pass_{}_{:06d}.tsv'.format(passes, len(next_runs)))
+                self._merge_files(runs[i:i + MAX_MERGE_FILES], merged_file)
+                next_runs.append(merged_file)
+            runs = next_runs
+
+        self.merged = os.path.join(self.work_dir, 'merged.tsv')
+        self.num_ec = self._merge_files(runs, self.merged)
+
+        LOG.info("Merged {:,} spilled runs into {:,} equivalence classes".format(len(self.runs), self.num_ec))
+
+        return self.num_ec
+
+    def __iter__(self):
+        """
+        Iterate over the merged (key, count) in key order.
+        """
+        return _read_run(self.merged)
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import string
+
+import pysam
+
+LOG = logging.getLogger('BAM2EC')
+
+READ_LENGTH = 50
+TARGET_LENGTH = 1000
+
+FLAG_PAIRED = 0x1
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+
+
+def target_names(num_targets):
+    return ['ENMUST{:011d}'.format(i) for i in xrange(0, num_targets)]
+
+
+def haplotype_names(num_haplotypes):
+    if num_haplotypes <= len(string.ascii_uppercase):
+        return list(string.ascii_uppercase[0:num_haplotypes])
+    return ['H{}'.format(i) for i in xrange(0, num_haplotypes)]
+
+
+def generate(file_out, num_targets=100, num_haplotypes=8, num_reads=10000, multimap_rate=0.5,
+             max_targets=3, seed=None, paired=False):
+    """
+    Write a name grouped BAM/SAM file of synthetic reads aligned to <target>_<haplotype> references.
+
+    Every read aligns to one target, a multimapping read also aligns to other
+    haplotypes of that target and to up to max_targets - 1 other targets.
+    With paired, read 2 of a template aligns to a random subset of the
+    references of read 1, always including the first, plus one reference
+    read 1 does not align to for half of the multimapping templates.
+
+    :param file_out: output file name, SAM text when it ends with .sam, otherwise BAM
+    :param num_targets: number of main targets
+    :param num_haplotypes: number of haplotypes, every target has one reference per haplotype
+    :param num_reads: number of reads
+    :param multimap_rate: fraction of reads with more than one alignment
+    :param max_targets: maximum number of main targets per read
+    :param seed: random seed
+    :param paired: write read 1 and read 2 of every template
+    :return: number of alignments written
+    """
+    rng = random.Random(seed)
+
+    targets = target_names(num_targets)
+    haplotypes = haplotype_names(num_haplotypes)
+
+    references = ['{}_{}'.format(t, h) for t in targets for h in haplotypes]
+    header = {'HD': {'VN': '1.0', 'SO': 'queryname'},
+              'SQ': [{'SN': name, 'LN': TARGET_LENGTH} for name in references]}
+
+    mode = 'w' if file_out.endswith('.sam') else 'wb'
+    out = pysam.AlignmentFile(file_out, mode, header=header)
+
+    sequence = 'A' * READ_LENGTH
+    qualities = pysam.qualitystring_to_array('I' * READ_LENGTH)
+
+    num_alignments = 0
+
+    for read_idx in xrange(0, num_reads):
+        target_idx = rng.randrange(num_targets)
+        tids = {target_idx * num_haplotypes + rng.randrange(num_haplotypes)}
+
+        if rng.random() < multimap_rate:
+            read_targets = [target_idx]
+            for _ in xrange(1, rng.randint(1, max_targets)):
+                read_targets.append(rng.randrange(num_targets))
+
+            for t in read_targets:
+                for h in rng.sample(xrange(num_haplotypes), rng.randint(1, num_haplotypes)):
+                    tids.add(t * num_haplotypes + h)
+
+        mates = [(0, sorted(tids))]
+
+        if paired:
+            tids = sorted(tids)
+            mate_tids = set([tids[0]] + rng.sample(tids, rng.randint(0, len(tids) - 1)))
+            if len(tids) > 1 and rng.random() < 0.5:
+                mate_tids.add(rng.randrange(num_targets * num_haplotypes))
+            mates = [(FLAG_PAIRED | FLAG_READ1, tids), (FLAG_PAIRED | FLAG_READ2, sorted(mate_tids))]
+
+        for mate_flag, mate_tids in mates:
+            for i, tid in enumerate(mate_tids):
+                alignment = pysam.AlignedSegment()
+                alignment.query_name = 'read{:010d}'.format(read_idx)
+                alignment.flag = mate_flag | (0 if i == 0 else FLAG_SECONDARY)
+                alignment.reference_id = tid
+                alignment.reference_start = rng.randrange(TARGET_LENGTH - READ_LENGTH)
+                alignment.mapping_quality = 255
+                alignment.cigartuples = [(0, READ_LENGTH)]
+                alignment.query_sequence = sequence
+                alignment.query_qualities = qualities
+                out.write(alignment)
+                num_alignments += 1
+
+    out.close()
+
+    LOG.debug("{:,} reads, {:,} alignments written to {}".format(num_reads, num_alignments, file_out))
+
+    return num_alignments
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+LOG = logging.getLogger('BAM2EC')
+
+# the clock is only read once every CHECK_EVERY + 1 records, must be 2^n - 1
+CHECK_EVERY = 0x3ff
+
+
+def current_rss_kb():
+    """
+    :return: current resident set size in KB, peak RSS where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 if sys.platform == 'darwin' else max_rss
+
+
+class Telemetry:
+    """
+    Progress of a conversion as JSON lines, written at most once per interval.
+
+    The caller tests (records & CHECK_EVERY) == 0 before calling check, so the
+    cost per record is a single bit test and nothing is formatted until an
+    interval has passed.
+    """
+
+    def __init__(self, out, interval=10.0, file_size=None):
+        """
+
+        :param out: file object to write the JSON lines to
+        :param interval: seconds between lines
+        :param file_size: size of the input file, used for the estimated time remaining
+        """
+        self.out = out
+        self.interval = interval
+        self.file_size = file_size
+
+        self.start = time.time()
+        self._next = self.start + interval
+
+        self._last_time = self.start
+        self._last_alignments = 0
+        self._last_reads = 0
+        self._last_ecs = 0
+
+    def check(self, alignments, reads, num_ecs, position=None):
+        """
+        Emit a line if the interval has passed.
+
+        :param alignments: alignments processed so far
+        :param reads: reads processed so far
+        :param num_ecs: size of the equivalence class table
+        :param position: bytes of the input file read so far
+        """
+        now = time.time()
+        if now < self._next:
+            return
+
+        self._next = now + self.interval
+        self.emit('progress', now, alignments, reads, num_ecs, position)
+
+    def emit(self, event, now, alignments, reads, num_ecs, position=None):
+        elapsed = now - self.start
+        since = now - self._last_time or 1e-9
+
+        record = {
+            'event': event,
+            'time': round(now, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'alignments': alignments,
+            'reads': reads,
+            'equivalence_classes': num_ecs,
+            'alignments_per_second': round((alignments - self._last_alignments) / since, 1),
+            'reads_per_second': round((reads - self._last_reads) / since, 1),
+            'equivalence_classes_per_second': round((num_ecs - self._last_ecs) / since, 1),
+            'rss_kb': current_rss_kb(),
+        }
+
+        if position is not None and self.file_size:
+            fraction = min(1.0, float(position) / self.file_size)
+            record['fraction_done'] = round(fraction, 4)
+            if fraction > 0:
+                record['eta_seconds'] = round(elapsed * (1 - fraction) / fraction, 1)
+
+        self.out.write(json.dumps(record, sort_keys=True))
+        self.out.write('\n')
+        self.out.flush()
+
+        self._last_time = now
+        self._last_alignments = alignments
+        self._last_reads = reads
+        self._last_ecs = num_ecs
+
+    def done(self, alignments, reads, num_ecs):
+        self.emit('done', time.time(), alignments, reads, num_ecs, self.file_size)
+        self.close()
+
+    def close(self):
+        """
+        Close the output file, the lines are already flushed; safe to call more than once.
+        """
+        if self.out is not sys.stderr and not self.out.closed:
+            self.out.close()
+
+
+def open_telemetry(telemetry_file, interval, file_in):
+    """
+    :param telemetry_file: file name for the JSON lines, '-' for stderr
+    :param interval: seconds between lines
+    :param file_in: the input file being converted
+    :return: Telemetry object
+    """
+    out = sys.stderr if telemetry_file == '-' else open(telemetry_file, 'w')
+
+    try:
+        file_size = os.path.getsize(file_in)
+    except OSError:
+        file_size = None
+
+    return Telemetry(out, interval, file_size)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+# number of rows held before they are passed to the logging handlers
+BUFFER_ROWS = 4096
+
+
+class Tracer:
+    """
+    Buffered per-row trace output for one phase of a command.
+
+    Whether tracing is on is decided once, when the tracer is created.  The
+    tracer is false when it is off, so a loop tests a local boolean and does
+    not build the row at all:
+
+        tracer = util.get_tracer()
+        tracing = bool(tracer)
+        for ...:
+            if tracing:
+                tracer.write('{}\t{}'.format(a, b))
+        tracer.flush()
+
+    Rows are collected and passed to the handlers of the logger in blocks,
+    one log record per block instead of one per row.  The record has the
+    rows in its rows attribute; util.BAM2ECFormatter writes every row the
+    way it writes a record of its own, other formatters get the rows as one
+    message of several lines.
+    """
+
+    def __init__(self, enabled, logger=None, level=logging.INFO, buffer_rows=BUFFER_ROWS):
+        """
+
+        :param enabled: trace rows are only written when True
+        :param logger: logger whose handlers write the rows, default the BAM2EC logger
+        :param level: logging level of the rows, decides their format
+        :param buffer_rows: number of rows to buffer before writing
+        """
+        self.enabled = enabled
+        self.logger = logger or logging.getLogger('BAM2EC')
+        self.level = level
+        self.buffer_rows = buffer_rows
+        self._rows = []
+
+    def __nonzero__(self):
+        return self.enabled
+
+    def write(self, row):
+        """
+        Add a row, the caller checks that the tracer is enabled first.
+
+        :param row: formatted row without the trailing newline
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        record = self.logger.makeRecord(self.logger.name, self.level, __file__, 0, '\n'.join(self._rows), None,
+                                        None)
+        record.rows = self._rows
+        self.logger.handle(record)
+        self._rows = []
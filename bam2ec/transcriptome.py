@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from collections import OrderedDict
+from struct import error as struct_error, pack, unpack
+
+import numpy as np
+
+LOG = logging.getLogger('BAM2EC')
+
+# Transcriptome objects already built in this process, keyed by header hash
+_CACHE = {}
+
+# version and file extension of the index files written to an index directory
+INDEX_VERSION = 1
+INDEX_EXTENSION = '.b2ei'
+
+
+class Transcriptome:
+    """
+    Lookups between tids in a BAM/SAM header and (main target, haplotype).
+
+    Reference names are expected to be <main target>_<haplotype>, i.e.
+    ENMUST..001_A.  A reference name without a haplotype has None as its
+    haplotype.  With a target file, targets holds its main targets.
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+
+        # distinct names and, indexed by tid, the index of the name of the tid (-1 for no haplotype)
+        self._main_names = []
+        self._haplotype_names = []
+        self._tid_main = np.zeros(0, dtype=np.int32)
+        self._tid_haplotype = np.zeros(0, dtype=np.int32)
+
+        # indexed by tid
+        self._main_targets = []
+        self._haplotypes = []
+
+        # main target index * number of haplotypes + haplotype index -> tid, built on first use
+        self._tid_table = None
+        self._main_index = None
+        self._haplotype_index = None
+
+        # tid as a string, the form convert keys equivalence classes with
+        self._tid_strings = None
+
+        # OrderedDict of main target -> index from the target file, None without one
+        self.targets = None
+
+    def __len__(self):
+        return len(self._main_targets)
+
+    def _set_tables(self, main_names, haplotype_names, tid_main, tid_haplotype):
+        self._main_names = main_names
+        self._haplotype_names = haplotype_names
+        self._tid_main = tid_main
+        self._tid_haplotype = tid_haplotype
+
+        names = haplotype_names + [None]
+        self._main_targets = [main_names[i] for i in tid_main.tolist()]
+        self._haplotypes = [names[i] for i in tid_haplotype.tolist()]
+
+    def main_target(self, tid):
+        return self._main_targets[tid]
+
+    def haplotype(self, tid):
+        return self._haplotypes[tid]
+
+    def get_tid(self, main_target, haplotype):
+        """
+        :return: the tid of main_target_haplotype or -1 when the header does not have it
+        """
+        if self._tid_table is None:
+            num_haplotypes = len(self._haplotype_names)
+            table = np.full(len(self._main_names) * num_haplotypes, -1, dtype=np.int64)
+            tids = np.nonzero(self._tid_haplotype >= 0)[0]
+            table[self._tid_main[tids].astype(np.int64) * num_haplotypes + self._tid_haplotype[tids]] = tids
+
+            self._tid_table = table.tolist()
+            self._main_index = {name: idx for idx, name in enumerate(self._main_names)}
+            self._haplotype_index = {name: idx for idx, name in enumerate(self._haplotype_names)}
+
+        try:
+            return self._tid_table[self._main_index[main_target] * len(self._haplotype_index) +
+                                   self._haplotype_index[haplotype]]
+        except KeyError:
+            return -1
+
+    @property
+    def tid_strings(self):
+        if self._tid_strings is None:
+            self._tid_strings = [str(tid) for tid in xrange(len(self._main_targets))]
+        return self._tid_strings
+
+
+def parse_target_file(target_file):
+    targets = OrderedDict()
+    with open(target_file, 'r') as f:
+        for line in f:
+            if line and line[0] == '#':
+                continue
+            _id = line.strip().split()[0]
+            targets[_id] = len(targets)
+    return targets
+
+
+def parse_mapping_file(mapping_file):
+    """
+    :param mapping_file: two whitespace separated columns, name and group, lines starting with # are skipped
+    :return: OrderedDict of name -> group
+    """
+    mapping = OrderedDict()
+    with open(mapping_file, 'r') as f:
+        for line in f:
+            if line and line[0] == '#':
+                continue
+            fields = line.strip().split()
+            if len(fields) < 2:
+                continue
+            mapping[fields[0]] = fields[1]
+    return mapping
+
+
+def header_key(references, lengths):
+    """
+    Hash of the sequence dictionary of a header.
+
+    :param references: reference names, in tid order
+    :param lengths: reference lengths, in tid order
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update('\n'.join(references))
+    sha.update(np.asarray(lengths, dtype='<i8').tostring())
+    return sha.hexdigest()
+
+
+def index_key(references, lengths, target_file=None):
+    """
+    Key of the transcriptome of a header and target file, the target file
+    is identified by its path, size and modification time.
+
+    :return: hex digest
+    """
+    key = header_key(references, lengths)
+
+    if not target_file:
+        return key
+
+    stat = os.stat(target_file)
+    sha = hashlib.sha1(key)
+    sha.update('{}\t{}\t{}'.format(os.path.abspath(target_file), stat.st_size, stat.st_mtime))
+    return sha.hexdigest()
+
+
+def build(references, key=None, target_file=None):
+    """
+    Build the lookups from the reference names.
+
+    :param references: reference names, in tid order
+    :param key: the header hash
+    :param target_file: optional target file, see parse_target_file
+    :return: Transcriptome object
+    """
+    main_names = OrderedDict()
+    haplotype_names = OrderedDict()
+
+    tid_main = np.empty(len(references), dtype=np.int32)
+    tid_haplotype = np.empty(len(references), dtype=np.int32)
+
+    for tid, name in enumerate(references):
+        parts = name.split('_')
+        tid_main[tid] = main_names.setdefault(parts[0], len(main_names))
+        tid_haplotype[tid] = haplotype_names.setdefault(parts[1], len(haplotype_names)) if len(parts) > 1 else -1
+
+    transcriptome = Transcriptome(key)
+    transcriptome._set_tables(main_names.keys(), haplotype_names.keys(), tid_main, tid_haplotype)
+
+    if target_file:
+        transcriptome.targets = parse_target_file(target_file)
+
+    return transcriptome
+
+
+def _write_names(f, names):
+    blob = '\n'.join(names)
+    f.write(pack('<ii', len(names), len(blob)))
+    f.write(blob)
+
+
+def _read_names(f):
+    num_names, blob_len = unpack('<ii', f.read(8))
+    blob = f.read(blob_len)
+    return blob.split('\n') if num_names else []
+
+
+def save(transcriptome, file_name):
+    """
+    Write a Transcriptome as an index file, replacing file_name atomically.
+
+    Layout, little endian int32: version, then the distinct main targets and
+    distinct haplotypes as (count, length, names joined by newlines), the
+    number of tids, the main target and haplotype index of every tid (-1 for
+    no haplotype) and the target file as names and indexes (count -1 for no
+    target file).
+    """
+    fd, temp_file = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(os.path.abspath(file_name)))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pack('<i', INDEX_VERSION))
+        _write_names(f, transcriptome._main_names)
+        _write_names(f, transcriptome._haplotype_names)
+        f.write(pack('<i', len(transcriptome)))
+        np.asarray(transcriptome._tid_main, dtype='<i4').tofile(f)
+        np.asarray(transcriptome._tid_haplotype, dtype='<i4').tofile(f)
+
+        if transcriptome.targets is None:
+            f.write(pack('<i', -1))
+        else:
+            f.write(pack('<i', len(transcriptome.targets)))
+            _write_names(f, transcriptome.targets.keys())
+            np.array(transcriptome.targets.values(), dtype='<i4').tofile(f)
+
+    # mkstemp creates the file readable by the owner only
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_file, 0o666 & ~umask)
+
+    os.rename(temp_file, file_name)
+
+
+def load(file_name, key=None):
+    """
+    Read an index file written by save.
+
+    :return: Transcriptome object
+    """
+    transcriptome = Transcriptome(key)
+
+    with open(file_name, 'rb') as f:
+        version = unpack('<i', f.read(4))[0]
+        if version != INDEX_VERSION:
+            raise ValueError("Unknown index version {}".format(version))
+
+        main_names = _read_names(f)
+        haplotype_names = _read_names(f)
+
+        num_tids = unpack('<i', f.read(4))[0]
+        tid_main = np.fromfile(f, dtype='<i4', count=num_tids)
+        tid_haplotype = np.fromfile(f, dtype='<i4', count=num_tids)
+        if len(tid_haplotype) != num_tids:
+            raise ValueError("Truncated index file")
+
+        transcriptome._set_tables(main_names, haplotype_names, tid_main, tid_haplotype)
+
+        num_targets = unpack('<i', f.read(4))[0]
+        if num_targets >= 0:
+            names = _read_names(f)
+            indexes = np.fromfile(f, dtype='<i4', count=len(names))
+            transcriptome.targets = OrderedDict(zip(names, indexes.tolist()))
+
+    return transcriptome
+
+
+def from_header(sam_file, target_file=None, index_dir=None):
+    """
+    Get the Transcriptome for an open pysam file, reusing one built earlier
+    in this process for an identical sequence dictionary and target file.
+
+    With index_dir, the transcriptome is loaded from <index_dir>/<key>.b2ei
+    when an earlier run wrote it, otherwise it is built and written there.
+
+    :param sam_file: pysam AlignmentFile
+    :param target_file: optional target file, see parse_target_file
+    :param index_dir: optional directory of index files
+    :return: Transcriptome object
+    """
+    key = index_key(sam_file.references, sam_file.lengths, target_file)
+
+    try:
+        transcriptome = _CACHE[key]
+        LOG.debug("Reusing transcriptome for header {}".format(key))
+        return transcriptome
+    except KeyError:
+        pass
+
+    transcriptome = None
+    index_file = os.path.join(index_dir, key + INDEX_EXTENSION) if index_dir else None
+
+    if index_file and os.path.exists(index_file):
+        try:
+            transcriptome = load(index_file, key)
+            LOG.debug("Loaded transcriptome index {}".format(index_file))
+        except (IOError, ValueError, struct_error), e:
+            LOG.info("Ignoring unreadable transcriptome index {}: {}".format(index_file, e))
+
+    if transcriptome is None:
+        transcriptome = build(sam_file.references, key, target_file)
+
+        if index_file:
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                if not os.path.isdir(index_dir):
+                    raise
+            save(transcriptome, index_file)
+            LOG.debug("Wrote transcriptome index {}".format(index_file))
+
+    _CACHE[key] = transcriptome
+
+    return transcriptome
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+LOG = logging.getLogger('BAM2EC')
+
+_BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+
+def encode_umi(umi):
+    """
+    Pack a UMI into an integer, 2 bits per base behind a leading 1 bit so
+    UMIs of different lengths never share a code.
+
+    :param umi: UMI sequence
+    :return: integer code, or None if the UMI has bases other than ACGT
+    """
+    code = 1
+    try:
+        for base in umi:
+            code = (code << 2) | _BASES[base]
+    except KeyError:
+        return None
+    return code
+
+
+def neighbors(code, length):
+    """
+    All the codes one mismatch away from code.
+
+    :param code: code from encode_umi
+    :param length: length of the UMI
+    :return: generator of codes
+    """
+    for i in xrange(0, length):
+        shift = 2 * i
+        for delta in (1, 2, 3):
+            yield code ^ (delta << shift)
+
+
+class UMICollapser:
+    """
+    Remembers the (UMI, equivalence class) pairs seen for each cell so
+    a read is only counted the first time its pair is seen in its cell.
+
+    Each pair is packed into a single integer and kept in a set per cell,
+    so memory grows with the number of distinct pairs, not reads.  The sets
+    of every cell are kept until the end, the distinct (cell, UMI,
+    equivalence class) triples of the whole input, unless the reads are
+    sorted by cell: with cell_sorted only the set of the current cell is
+    kept, bounded by the distinct pairs of one cell.
+    """
+
+    def __init__(self, mismatch=False, cell_sorted=False):
+        """
+
+        :param mismatch: also treat a UMI one mismatch away from a UMI already
+                         seen with the same cell and equivalence class as a duplicate
+        :param cell_sorted: the reads of a cell are consecutive, the set of a cell
+                            is released when the next cell starts
+        """
+        self.mismatch = mismatch
+        self.cell_sorted = cell_sorted
+
+        # cell -> set of (UMI code << 32 | ec id)
+        self._seen = {}
+
+        # cells whose sets were released, only used with cell_sorted
+        self._finished = set()
+
+        self.duplicates = 0
+        self.invalid = 0
+
+    def _cell_set(self, cell):
+        try:
+            return self._seen[cell]
+        except KeyError:
+            pass
+
+        if self.cell_sorted:
+            if cell in self._finished:
+                raise ValueError("Reads of cell {} are not consecutive, the input is not sorted by cell".format(cell))
+            self._finished.update(self._seen)
+            self._seen.clear()
+
+        seen = self._seen[cell] = set()
+        return seen
+
+    def add(self, cell, umi, ec_id):
+        """
+        Record a read.
+
+        :param cell: cell barcode, None for bulk libraries
+        :param umi: UMI sequence
+        :param ec_id: index of the equivalence class of the read
+        :return: True if the read should be counted
+        """
+        code = encode_umi(umi) if umi else None
+
+        if code is None:
+            self.invalid += 1
+            return False
+
+        seen = self._cell_set(cell)
+
+        key = (code << 32) | ec_id
+
+        if key in seen:
+            self.duplicates += 1
+            return False
+
+        if self.mismatch:
+            for neighbor in neighbors(code, len(umi)):
+                if ((neighbor << 32) | ec_id) in seen:
+                    self.duplicates += 1
+                    return False
+
+        seen.add(key)
+        return True
+
+    def num_cells(self):
+        return len(self._seen) + len(self._finished)
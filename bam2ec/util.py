@@ -1,20 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import array
+import hashlib
 import logging
 import os
+import re
 import sys
+import time
 import traceback
 
 from collections import OrderedDict
-from struct import pack
+from struct import pack, unpack
 
-import pysam
 import numpy as np
 
-from emase import AlignmentPropertyMatrix as APM
+# pysam, emase (PyTables) and scipy are slow to import, the functions that
+# need them import them so the other commands start quickly
 
+from . import bitfield
+from . import builder
 from . import ec_file
-from . import emase_file
+from . import profiling
+from . import result_cache
+from . import sam_text
+from . import spill
+from . import telemetry
+from . import trace
+from . import transcriptome
+from . import umi
 
 VERBOSE_LEVELV_NUM = 9
 
@@ -58,6 +71,21 @@ class BAM2ECFormatter(logging.Formatter):
 
     def format(self, record):
 
+        # a block of rows from trace.Tracer, every row is written like a record of its own
+        rows = getattr(record, 'rows', None)
+        if rows is not None:
+            message = record.msg
+            record.msg = ''
+            try:
+                prefix = self._format(record)
+            finally:
+                record.msg = message
+            return '\n'.join(prefix + row for row in rows)
+
+        return self._format(record)
+
+    def _format(self, record):
+
         # Save the original format configured by the user
         # when the logger formatter was instantiated
         format_orig = self._fmt
@@ -109,20 +137,19 @@ def configure_logging(level):
     LOG.addHandler(handler)
 
 
-def int_to_list(c, size):
-    ret = [0]*size
-    for i in xrange(0, size):
-        if (c & (1 << i)) != 0:
-            ret[i] = 1
-    return ret
+def get_tracer(level=VERBOSE_LEVELV_NUM):
+    """
+    Get a tracer for the rows of one phase, the logging level is checked once.
+
+    :param level: logging level the rows are written at, verbose (-dd) by default
+    :return: trace.Tracer, false when the level is not enabled
+    """
+    return trace.Tracer(LOG.isEnabledFor(level), LOG, level)
 
 
-def list_to_int(l):
-    c = 0
-    for i, onoff in enumerate(l):
-        if onoff == 1:
-            c |= 1 << i
-    return c
+# one bitfield to and from a list of 0/1 per haplotype, see bitfield for arrays
+int_to_list = bitfield.to_list
+list_to_int = bitfield.from_list
 
 
 def _show_error():
@@ -141,15 +168,66 @@ def _show_error():
         tb = tb.tb_next
 
 
-def parse_target_file(target_file):
-    targets = OrderedDict()
-    with open(target_file, 'r') as f:
-        for line in f:
-            if line and line[0] == '#':
-                continue
-            _id = line.strip().split()[0]
-            targets[_id] = len(targets)
-    return targets
+def _remove_file(file_name):
+    """
+    Remove a file if it exists
+    """
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+parse_target_file = transcriptome.parse_target_file
+parse_mapping_file = transcriptome.parse_mapping_file
+
+
+ORDER_COUNT = 'count'
+ORDER_TARGET = 'target'
+ORDERS = [ORDER_COUNT, ORDER_TARGET]
+
+# SAM flags
+FLAG_UNMAPPED = 0x4
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_QC_FAIL = 0x200
+FLAG_SUPPLEMENTARY = 0x800
+
+# records skipped by convert unless exclude_flags is given
+EXCLUDE_FLAGS = FLAG_UNMAPPED
+EXCLUDE_FLAGS_PAIRED = FLAG_UNMAPPED | FLAG_QC_FAIL | FLAG_SUPPLEMENTARY
+
+
+def order_equivalence_classes(ec, order, target_idx_to_main_target, main_targets):
+    """
+    Renumber the equivalence classes into a canonical order.
+
+    Ties are broken by the sorted tids of the equivalence class so the
+    same data always produces the same numbering.
+
+    :param ec: OrderedDict of ec key (comma separated tids) -> count
+    :param order: 'count' for descending count, 'target' for lowest main target index
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param main_targets: OrderedDict of main target -> index
+    :return: tuple of (ec, ec_idx) in the new order
+    """
+    if order not in ORDERS:
+        raise ValueError("Unknown equivalence class order: {}".format(order))
+
+    def sort_key(item):
+        k, count = item
+        tids = sorted(int(tid) for tid in k.split(','))
+        lowest = min(main_targets[target_idx_to_main_target[str(tid)]] for tid in tids)
+
+        if order == ORDER_COUNT:
+            return -count, lowest, tids
+
+        return lowest, -count, tids
+
+    ordered_ec = OrderedDict(sorted(ec.iteritems(), key=sort_key))
+    ordered_ec_idx = {k: idx for idx, k in enumerate(ordered_ec)}
+
+    return ordered_ec, ordered_ec_idx
 
 
 def dump(binary_file_name, detail=False):
@@ -165,6 +243,10 @@ def dump(binary_file_name, detail=False):
             raise ValueError("empty file name, cannot load")
 
         LOG.info("Binary File: {0}".format(binary_file_name))
+        profiling.start_phase('Reading names')
+
+        # the detail rows are written in blocks instead of one log record each
+        tracer = trace.Tracer(detail, LOG, logging.INFO)
 
         f = open(binary_file_name, 'rb')
 
@@ -191,7 +273,9 @@ def dump(binary_file_name, detail=False):
             targets[target] = i
             target_ids.append(target)
             if detail:
-                LOG.info("{}\t{}".format(i, target))
+                tracer.write("{}\t{}".format(i, target))
+
+        tracer.flush()
 
         # HAPLOTYPES
 
@@ -207,7 +291,9 @@ def dump(binary_file_name, detail=False):
             haplotypes[haplotype] = i
             haplotype_ids.append(haplotype)
             if detail:
-                LOG.info("{}\t{}".format(i, haplotype))
+                tracer.write("{}\t{}".format(i, haplotype))
+
+        tracer.flush()
 
         if file_version == 0:
 
@@ -229,6 +315,8 @@ def dump(binary_file_name, detail=False):
 
             num_alignments = np.fromfile(f, dtype=np.dtype('i'), count=1)[0]
             LOG.info("Alignment Count: {0:,}".format(num_alignments))
+            profiling.start_phase('Reading alignments')
+            profiling.add_records(num_alignments)
 
             alignments = np.fromfile(f, dtype = np.dtype('i'), count=num_alignments*3)
 
@@ -243,9 +331,10 @@ def dump(binary_file_name, detail=False):
                 if temp_bits == 0:
                     continue
 
-                bits = int_to_list(temp_bits, num_haplotypes)
                 if detail:
-                    LOG.info("{}\t{}\t{}".format(rid, target_ids[lid], bits))
+                    tracer.write("{}\t{}\t{}".format(rid, target_ids[lid], bitfield.to_list(temp_bits, num_haplotypes)))
+
+            tracer.flush()
 
         else:
 
@@ -263,6 +352,8 @@ def dump(binary_file_name, detail=False):
             LOG.info("Alignment Count: {0:,}".format(num_alignments))
 
             if detail:
+                profiling.start_phase('Reading alignments')
+                profiling.add_records(num_alignments)
                 alignments = np.fromfile(f, dtype=np.dtype('i'), count=num_alignments*3)
 
                 counter = 0
@@ -276,14 +367,18 @@ def dump(binary_file_name, detail=False):
                     if temp_bits == 0:
                         continue
 
-                    bits = int_to_list(temp_bits, num_haplotypes)
-                    LOG.info("{}\t{}\t{}\t# {}".format(rid, target_ids[lid], bits, temp_bits))
+                    tracer.write("{}\t{}\t{}\t# {}".format(rid, target_ids[lid], bitfield.to_list(temp_bits, num_haplotypes),
+                                                             temp_bits))
+
+                tracer.flush()
     except:
         _show_error()
 
 
 
 def bin2emase(binary_file_name, emase_file_name):
+    from emase import AlignmentPropertyMatrix as APM
+
     try:
         if not binary_file_name:
             raise ValueError("empty file name, cannot load")
@@ -311,13 +406,19 @@ def bin2emase(binary_file_name, emase_file_name):
         num_targets = np.fromfile(f, dtype=np.dtype('i'), count=1)[0]
         LOG.info("Target Count: {0:,}".format(num_targets))
 
+        tracer = get_tracer()
+        tracing = bool(tracer)
+
         for i in xrange(0, num_targets):
             str_len = np.fromfile(f, dtype=np.dtype('i'), count=1)[0]
             target = np.fromfile(f, dtype=np.dtype('a' + str(str_len)), count=1)[0]
             targets[target] = i
             target_ids.append(target)
 
-            LOG.verbose("{}\t{}".format(i, target))
+            if tracing:
+                tracer.write("{}\t{}".format(i, target))
+
+        tracer.flush()
 
         # HAPLOTYPES
 
@@ -333,7 +434,10 @@ def bin2emase(binary_file_name, emase_file_name):
             haplotypes[haplotype] = i
             haplotype_ids.append(haplotype)
 
-            LOG.verbose("{}\t{}".format(i, haplotype))
+            if tracing:
+                tracer.write("{}\t{}".format(i, haplotype))
+
+        tracer.flush()
 
         # EQUIVALENCE CLASSES
 
@@ -361,26 +465,9 @@ def bin2emase(binary_file_name, emase_file_name):
         # counts -> the number of times this equivalence class has appeared
         apm.count = counts
 
-        counter = 0
         alignments = np.fromfile(f, dtype=np.dtype('i'), count=num_alignments*3)
 
-        for i in xrange(0, num_alignments*3, 3):
-            rid = alignments[i]
-            lid = alignments[i+1]
-            temp_bits = alignments[i+2]
-
-            counter += 1
-            if temp_bits == 0:
-                continue
-
-            try:
-                bits = int_to_list(temp_bits, num_haplotypes)
-                for i, bit in enumerate(bits):
-                    if bit:
-                        apm.set_value(rid, i, lid, 1)
-            except Exception, e:
-                _show_error()
-                raise e
+        ec_file.fill_apm(apm, alignments.reshape(-1, 3))
 
         LOG.info("Finalizing...")
         apm.finalize()
@@ -390,101 +477,624 @@ def bin2emase(binary_file_name, emase_file_name):
         _show_error()
 
 
-def ec2emase(file_in, file_out, target_file=None):
-    ec = ec_file.parse(file_in)
-    new_shape = (len(ec._targets_list), len(ec._haplotypes_list), len(ec._ec_list))
+def _run_cached(cache_dir, cache_size, command, input_files, options, file_out, run):
+    """
+    Run a command through a result cache, see result_cache.
+
+    :param cache_dir: cache directory
+    :param cache_size: size limit of the cache in MB, None for the default
+    :param command: command name, part of the key
+    :param input_files: files the output is computed from, part of the key
+    :param options: options that change the output, part of the key
+    :param file_out: the output file of the command
+    :param run: function computing file_out
+    """
+    cache = result_cache.ResultCache(cache_dir, cache_size or result_cache.DEFAULT_MAX_MB)
+    key = cache.key(command, input_files, options)
 
-    LOG.info('Creating APM...')
-    LOG.debug('Shape={}'.format(new_shape))
+    if cache.fetch(key, file_out):
+        LOG.info("Cached result {} linked to {}".format(key, file_out))
+        return
 
+    # do not write through a link to another cached result
+    if os.path.exists(file_out) and os.stat(file_out).st_nlink > 1:
+        os.remove(file_out)
 
-    apm = APM(shape=new_shape, haplotype_names=ec._haplotypes_list, locus_names=ec._targets_list, read_names=ec._ec_list)
+    before = os.stat(file_out) if os.path.exists(file_out) else None
 
-    LOG.debug('ec._haplotypes_list={}'.format(str(ec._haplotypes_list)))
-    LOG.debug('ec._targets_list[0:10]={}'.format(str(ec._targets_list[0:10])))
-    LOG.debug('ec._ec_list[0:10]={}'.format(str(ec._ec_list[0:10])))
+    run()
 
-    # counts -> the number of times this equivalence class has appeared
-    apm.count = ec._ec_counts_list
+    if not os.path.exists(file_out):
+        LOG.info("No output file, not caching")
+        return
 
-    counter = 0
-    num_haplotypes = len(ec._haplotypes_list)
+    after = os.stat(file_out)
+    if before and (after.st_mtime, after.st_size) == (before.st_mtime, before.st_size):
+        LOG.info("Output file unchanged, not caching")
+        return
 
-    try:
+    cache.store(key, file_out, command, input_files)
+    LOG.info("Cached result {}".format(key))
 
-        for alignment in ec._alignments:
-            #LOG.verbose(str(alignment))
-            ec_index = alignment[0]
-            target_index = alignment[1]
-            temp_bits = alignment[2]
 
-            if temp_bits == 0:
-                continue
+def ec2emase(file_in, file_out, target_file=None, cache_dir=None, cache_size=None):
+    if cache_dir:
+        return _run_cached(cache_dir, cache_size, 'ec2emase', [file_in], {}, file_out,
+                           lambda: ec2emase(file_in, file_out, target_file))
+
+    ec = ec_file.parse(file_in)
 
-            bits = int_to_list(temp_bits, num_haplotypes)
-            for i, bit in enumerate(bits):
-                if bit:
-                    # lid, hid, rid, value
-                    apm.set_value(target_index, i, ec_index, 1)
+    try:
+        ec_file.write_emase(ec, file_out)
     except Exception, e:
         _show_error()
         raise e
 
-    LOG.info("Finalizing...")
-    apm.finalize()
-    apm.save(file_out, title='bam2ec')
 
+def _write_ec(ec, file_out, emase=False):
+    LOG.info("# Targets: {:,}".format(len(ec._targets_list)))
+    LOG.info("# Haplotypes: {:,}".format(len(ec._haplotypes_list)))
+    LOG.info("# Equivalence Classes: {:,}".format(len(ec._ec_counts_list)))
+    LOG.info("# Alignment Rows: {:,}".format(len(ec._alignments)))
+
+    if emase:
+        ec.to_emase(file_out)
+    else:
+        ec.to_file(file_out)
+
+
+def kallisto2ec(matrix_file, transcripts_file, counts_file, file_out, emase=False):
+    """
+    Convert kallisto equivalence classes to an EC file, see kallisto_file.
+
+    :param matrix_file: matrix.ec
+    :param transcripts_file: transcripts.txt
+    :param counts_file: equivalence class counts
+    :param file_out: output file
+    :param emase: write the output in EMASE format
+    :return: the EC object
+    """
+    from . import kallisto_file
+
+    profiling.start_phase('Parsing kallisto files')
+    ec = kallisto_file.parse(matrix_file, transcripts_file, counts_file)
+    profiling.end_phase(len(ec._alignments))
+
+    _write_ec(ec, file_out, emase)
+
+    return ec
+
+
+def ec2kallisto(file_in, matrix_file, transcripts_file, counts_file):
+    """
+    Convert an EC file to kallisto equivalence classes, see kallisto_file.
+
+    :param file_in: EC file (version 1)
+    :param matrix_file: matrix.ec to create
+    :param transcripts_file: transcripts.txt to create
+    :param counts_file: equivalence class counts to create
+    """
+    from . import kallisto_file
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be converted")
+
+    profiling.start_phase('Writing kallisto files')
+    kallisto_file.write(ec, matrix_file, transcripts_file, counts_file)
+    profiling.end_phase(len(ec._alignments))
+
+
+def salmon2ec(file_in, file_out, emase=False):
+    """
+    Convert salmon equivalence classes to an EC file, see salmon_file.
+
+    :param file_in: eq_classes.txt
+    :param file_out: output file
+    :param emase: write the output in EMASE format
+    :return: the EC object
+    """
+    from . import salmon_file
+
+    profiling.start_phase('Parsing salmon file')
+    ec = salmon_file.parse(file_in)
+    profiling.end_phase(len(ec._alignments))
+
+    _write_ec(ec, file_out, emase)
+
+    return ec
+
+
+def ec2salmon(file_in, file_out):
+    """
+    Convert an EC file to salmon equivalence classes, see salmon_file.
+
+    :param file_in: EC file (version 1)
+    :param file_out: eq_classes.txt to create
+    """
+    from . import salmon_file
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be converted")
+
+    profiling.start_phase('Writing salmon file')
+    salmon_file.write(ec, file_out)
+    profiling.end_phase(len(ec._alignments))
+
+
+def quantify(file_in, file_out, tolerance=0.0001, max_iters=1000, num_threads=1):
+    """
+    Estimate expected read counts directly from an EC file.
+
+    :param file_in: EC file (version 1)
+    :param file_out: tab delimited output, one line per target with a column per haplotype and the total
+    :param tolerance: relative change in expected counts that signals convergence
+    :param max_iters: maximum number of EM iterations
+    :param num_threads: number of threads for the matrix-vector products
+    """
+    from . import em
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be quantified")
+
+    LOG.info("Building compatibility matrix...")
+    profiling.start_phase('Building compatibility matrix')
+    model = em.EM(ec, num_threads)
+
+    LOG.info("Running EM...")
+    profiling.start_phase('Running EM')
+    num_iters = model.run(tolerance, max_iters)
+    profiling.end_phase(num_iters)
+    LOG.info("{:,} iterations".format(num_iters))
+
+    expected = model.get_expected_counts()
+
+    for idx, hap in enumerate(ec._haplotypes_list):
+        LOG.info("{}\t{:,.2f}".format(hap, expected[:, idx].sum()))
+
+    profiling.start_phase('Writing expected counts')
+    with open(file_out, 'w') as f:
+        f.write('locus\t{}\ttotal\n'.format('\t'.join(ec._haplotypes_list)))
+        for idx, target in enumerate(ec._targets_list):
+            values = '\t'.join('{:.2f}'.format(v) for v in expected[idx])
+            f.write('{}\t{}\t{:.2f}\n'.format(target, values, expected[idx].sum()))
+    profiling.end_phase(len(ec._targets_list))
+
+
+SAMPLE_BINOMIAL = 'binomial'
+SAMPLE_MULTINOMIAL = 'multinomial'
+SAMPLE_METHODS = [SAMPLE_BINOMIAL, SAMPLE_MULTINOMIAL]
+
+
+def _draw_without_replacement(random_state, counts, num_reads):
+    """
+    Draw num_reads of the reads of counts without replacement.
+
+    The equivalence classes are halved level by level and the reads drawn
+    from the left half of every range are one vectorized hypergeometric
+    draw, so there are log2(len(counts)) draws instead of one per class.
+
+    :param random_state: numpy RandomState
+    :param counts: array of reads per equivalence class
+    :param num_reads: number of reads to draw, at most counts.sum()
+    :return: array of the reads drawn per equivalence class, each at most its count
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+    sampled = np.zeros(len(counts), dtype=np.int64)
+
+    # ranges of equivalence classes [starts, ends) and the reads drawn from each
+    starts = np.array([0])
+    ends = np.array([len(counts)])
+    drawn = np.array([num_reads], dtype=np.int64)
+
+    while True:
+        # numpy refuses to draw 0 reads, those ranges stay 0
+        keep = drawn > 0
+        starts, ends, drawn = starts[keep], ends[keep], drawn[keep]
+
+        single = ends - starts == 1
+        sampled[starts[single]] = drawn[single]
+        starts, ends, drawn = starts[~single], ends[~single], drawn[~single]
+
+        if not len(starts):
+            return sampled
+
+        middles = (starts + ends) // 2
+        left = random_state.hypergeometric(cumulative[middles] - cumulative[starts],
+                                           cumulative[ends] - cumulative[middles], drawn)
+
+        starts = np.concatenate((starts, middles))
+        ends = np.concatenate((middles, ends))
+        drawn = np.concatenate((left, drawn - left))
+
+
+def downsample(file_in, output_prefix, fractions, method=SAMPLE_BINOMIAL, seed=None):
+    """
+    Thin the equivalence class counts of an EC file to several fractions.
+
+    Binomial thinning keeps each read with probability fraction.  Multinomial
+    thinning keeps exactly round(fraction * total) reads, drawn without
+    replacement (a multivariate hypergeometric draw), so no count grows.  Both
+    draw the fractions nested (largest first) so every smaller sample is a
+    subset of the larger one.
+
+    :param file_in: EC file (version 1)
+    :param output_prefix: each sample is written to <output_prefix>_<fraction>.bin
+    :param fractions: list of fractions between 0 and 1
+    :param method: 'binomial' or 'multinomial'
+    :param seed: random seed for reproducible samples
+    :return: list of the output file names, in the order of fractions
+    """
+    if method not in SAMPLE_METHODS:
+        raise ValueError("Unknown sampling method: {}".format(method))
+
+    for fraction in fractions:
+        if fraction <= 0 or fraction > 1:
+            raise ValueError("Fraction must be > 0 and <= 1: {}".format(fraction))
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be downsampled")
+
+    profiling.start_phase('Sampling')
+    counts = np.asarray(ec._ec_counts_list, dtype=np.int64)
+    total = counts.sum()
+    random_state = np.random.RandomState(seed)
+
+    samples = {}
+
+    if method == SAMPLE_BINOMIAL:
+        previous_counts = counts
+        previous_fraction = 1.0
+        for fraction in sorted(set(fractions), reverse=True):
+            previous_counts = random_state.binomial(previous_counts, fraction / previous_fraction)
+            previous_fraction = fraction
+            samples[fraction] = previous_counts
+    else:
+        previous_counts = counts
+        for fraction in sorted(set(fractions), reverse=True):
+            previous_counts = _draw_without_replacement(random_state, previous_counts, int(round(fraction * total)))
+            samples[fraction] = previous_counts
+
+    profiling.end_phase(len(counts) * len(samples))
+
+    LOG.info("Fraction\tReads\tEquivalence Classes")
+    LOG.info("{:g}\t{:,}\t{:,}".format(1.0, total, np.count_nonzero(counts)))
+
+    outputs = []
+    for fraction in fractions:
+        sample_counts = samples[fraction]
+        keep = sample_counts > 0
+
+        sample_ec = ec_file.select_ecs(ec, keep)
+        sample_ec._ec_counts_list = sample_counts[keep]
+
+        file_out = '{}_{:g}.bin'.format(output_prefix, fraction)
+        ec_file.write(sample_ec, file_out)
+        outputs.append(file_out)
+
+        LOG.info("{:g}\t{:,}\t{:,}".format(fraction, sample_counts.sum(), keep.sum()))
+
+    return outputs
+
+
+def prune(file_in, file_out, min_count=None, max_targets=None, redistribute=False, emase=False,
+          report_file=None):
+    """
+    Remove rare and oversized equivalence classes from an EC file, see ec_file.filter_ecs.
+
+    :param file_in: EC file (version 1)
+    :param file_out: output file
+    :param min_count: remove equivalence classes with fewer reads
+    :param max_targets: remove equivalence classes with more targets
+    :param redistribute: move the reads of removed equivalence classes to a surviving one sharing a target
+    :param emase: write the output in EMASE format
+    :param report_file: optional tab delimited file listing the removed equivalence classes
+    :return: the report of ec_file.filter_ecs
+    """
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be pruned")
+
+    pruned, report = _prune_ec(ec, min_count, max_targets, redistribute)
+
+    if report_file:
+        with open(report_file, 'w') as f:
+            f.write('ec\tcount\ttargets\treason\tredistributed_to\n')
+            for idx, count, targets, rare, to in zip(report['ec'], report['count'], report['targets'],
+                                                     report['rare'], report['redistributed_to']):
+                f.write('{}\t{}\t{}\t{}\t{}\n'.format(idx, count, targets, 'count' if rare else 'targets',
+                                                      to if to >= 0 else ''))
+
+    if emase:
+        pruned.to_emase(file_out)
+    else:
+        pruned.to_file(file_out)
+
+    return report
+
+
+def _prune_ec(ec, min_count=None, max_targets=None, redistribute=False):
+    """
+    ec_file.filter_ecs with a summary of what was removed.
+
+    :return: the new EC object and the report of ec_file.filter_ecs
+    """
+    profiling.start_phase('Pruning')
+    pruned, report = ec_file.filter_ecs(ec, min_count, max_targets, redistribute)
+    profiling.end_phase(len(ec._ec_counts_list))
+
+    moved = report['redistributed_to'] >= 0
+
+    LOG.info("# Equivalence Classes Removed: {:,} of {:,}".format(len(report['ec']), len(ec._ec_counts_list)))
+    if min_count:
+        LOG.info("# Fewer than {:,} reads: {:,}".format(min_count, report['rare'].sum()))
+    if max_targets:
+        LOG.info("# More than {:,} targets: {:,}".format(max_targets, report['oversized'].sum()))
+    LOG.info("# Alignment Rows Removed: {:,}".format(len(ec._alignments) - len(pruned._alignments)))
+    LOG.info("# Reads Redistributed: {:,}".format(report['count'][moved].sum()))
+    LOG.info("# Reads Removed: {:,}".format(report['count'][~moved].sum()))
+
+    return pruned, report
+
+
+def info(file_in):
+    """
+    Summarize an EC file.
+
+    :param file_in: EC file (version 1)
+    :return: dictionary of the sizes of the file
+    """
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be summarized")
+
+    counts = np.asarray(ec._ec_counts_list, dtype=np.int64)
+    alignments = np.asarray(ec._alignments)
+
+    summary = {
+        'targets': len(ec._targets_list),
+        'haplotypes': len(ec._haplotypes_list),
+        'equivalence_classes': len(counts),
+        'alignment_rows': len(alignments),
+        'reads': int(counts.sum()),
+        'targets_with_reads': len(np.unique(alignments[:, 1])),
+        'max_targets_per_ec': int(np.bincount(alignments[:, 0]).max()) if len(alignments) else 0,
+    }
+
+    for key in ('targets', 'haplotypes', 'equivalence_classes', 'alignment_rows', 'reads', 'targets_with_reads',
+                'max_targets_per_ec'):
+        LOG.info("{}: {:,}".format(key, summary[key]))
+
+    return summary
+
+
+def subset(file_in, file_out, target_file, emase=False):
+    """
+    Keep only the alignment rows of the targets in a target file, see ec_file.select_targets.
+
+    :param file_in: EC file (version 1)
+    :param file_out: output file
+    :param target_file: targets to keep, see parse_target_file
+    :param emase: write the output in EMASE format
+    :return: the new EC object
+    """
+    targets = parse_target_file(target_file)
+    if len(targets) == 0:
+        raise ValueError("Unable to parse target file")
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be subset")
+
+    profiling.start_phase('Selecting targets')
+    keep_targets = np.in1d(np.asarray(ec._targets_list), np.asarray(targets.keys()))
+    subset_ec = ec_file.select_targets(ec, keep_targets)
+    profiling.end_phase(len(ec._alignments))
+
+    LOG.info("# Targets: {:,} of {:,} ({:,} listed targets not in the file)".format(
+        keep_targets.sum(), len(keep_targets), len(targets) - keep_targets.sum()))
+    LOG.info("# Equivalence Classes: {:,} of {:,}".format(len(subset_ec._ec_counts_list), len(ec._ec_counts_list)))
+    LOG.info("# Alignment Rows: {:,} of {:,}".format(len(subset_ec._alignments), len(ec._alignments)))
+    LOG.info("# Reads: {:,} of {:,}".format(np.sum(subset_ec._ec_counts_list, dtype=np.int64),
+                                            np.sum(ec._ec_counts_list, dtype=np.int64)))
+
+    if emase:
+        subset_ec.to_emase(file_out)
+    else:
+        subset_ec.to_file(file_out)
+
+    return subset_ec
+
+
+def collapse(file_in, file_out, mapping_file, emase=False):
+    """
+    Replace the targets by groups, i.e. transcripts by genes, see ec_file.collapse_targets.
+
+    Targets that are not in the mapping file are kept as their own group.
+    Groups are numbered in the order of their first target.
+
+    :param file_in: EC file (version 1)
+    :param file_out: output file
+    :param mapping_file: target and group per line, see parse_mapping_file
+    :param emase: write the output in EMASE format
+    :return: the new EC object
+    """
+    mapping = parse_mapping_file(mapping_file)
+    if len(mapping) == 0:
+        raise ValueError("Unable to parse mapping file")
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be collapsed")
+
+    groups = OrderedDict()
+    target_groups = []
+    unmapped = 0
+    for target in ec._targets_list:
+        group = mapping.get(target)
+        if group is None:
+            group = target
+            unmapped += 1
+        target_groups.append(groups.setdefault(group, len(groups)))
+
+    if unmapped:
+        LOG.info("{:,} targets are not in the mapping file and are kept as they are".format(unmapped))
+
+    profiling.start_phase('Collapsing targets')
+    collapsed = ec_file.collapse_targets(ec, target_groups, groups.keys())
+    profiling.end_phase(len(ec._alignments))
+
+    LOG.info("# Targets: {:,} groups from {:,} targets".format(len(groups), len(target_groups)))
+    LOG.info("# Equivalence Classes: {:,} of {:,}".format(len(collapsed._ec_counts_list), len(ec._ec_counts_list)))
+    LOG.info("# Alignment Rows: {:,} of {:,}".format(len(collapsed._alignments), len(ec._alignments)))
+
+    if emase:
+        collapsed.to_emase(file_out)
+    else:
+        collapsed.to_file(file_out)
+
+    return collapsed
+
+
+def remap(file_in, file_out, mapping_file, emase=False):
+    """
+    Replace the haplotypes by groups, see ec_file.remap_haplotypes.
+
+    Haplotypes mapped to the group '-' are dropped, haplotypes that are not
+    in the mapping file are kept as their own group.  Groups are sorted by
+    name, like the haplotypes of convert.
+
+    :param file_in: EC file (version 1)
+    :param file_out: output file
+    :param mapping_file: haplotype and group per line, see parse_mapping_file
+    :param emase: write the output in EMASE format
+    :return: the new EC object
+    """
+    mapping = parse_mapping_file(mapping_file)
+    if len(mapping) == 0:
+        raise ValueError("Unable to parse mapping file")
+
+    ec = ec_file.parse(file_in)
+
+    if ec.version != 1:
+        raise ValueError("Only equivalence class (version 1) files can be remapped")
+
+    for haplotype in mapping:
+        if haplotype not in ec._haplotypes_dict:
+            LOG.info("Haplotype {} is not in {}".format(haplotype, file_in))
+
+    haplotype_to_group = [mapping.get(h, h) for h in ec._haplotypes_list]
+    group_names = sorted(set(g for g in haplotype_to_group if g != '-'))
+    group_idx = {g: i for i, g in enumerate(group_names)}
+    haplotype_groups = [group_idx.get(g, -1) for g in haplotype_to_group]
+
+    for haplotype, group in zip(ec._haplotypes_list, haplotype_to_group):
+        LOG.debug("{} -> {}".format(haplotype, 'dropped' if group == '-' else group))
+
+    profiling.start_phase('Remapping haplotypes')
+    remapped = ec_file.remap_haplotypes(ec, haplotype_groups, group_names)
+    profiling.end_phase(len(ec._alignments))
+
+    total_reads = np.sum(ec._ec_counts_list, dtype=np.int64)
+    kept_reads = np.sum(remapped._ec_counts_list, dtype=np.int64)
+
+    LOG.info("# Haplotypes: {:,} groups from {:,} haplotypes".format(len(group_names), len(haplotype_groups)))
+    LOG.info("# Equivalence Classes: {:,} of {:,}".format(len(remapped._ec_counts_list), len(ec._ec_counts_list)))
+    LOG.info("# Alignment Rows: {:,} of {:,}".format(len(remapped._alignments), len(ec._alignments)))
+    LOG.info("# Reads: {:,} of {:,}".format(kept_reads, total_reads))
+
+    if emase:
+        remapped.to_emase(file_out)
+    else:
+        remapped.to_file(file_out)
+
+    return remapped
 
 
 def emase2ec(file_in, file_out):
+    from . import emase_file
+
     emasef = emase_file.parse(file_in)
 
     try:
         LOG.info("Generating BIN file...")
+        profiling.start_phase('Generating BIN file')
 
         f = open(file_out, "wb")
 
+        tracer = get_tracer()
+        tracing = bool(tracer)
+
         # version
         f.write(pack('<i', 1))
-        LOG.verbose("1\t# VERSION")
+        if tracing:
+            tracer.write("1\t# VERSION")
 
         # targets
-        LOG.verbose("{:,}\t# NUMBER OF TARGETS".format(len(emasef._target_list)))
+        if tracing:
+            tracer.write("{:,}\t# NUMBER OF TARGETS".format(len(emasef._target_list)))
         f.write(pack('<i', len(emasef._target_list)))
         for main_target, idx in emasef._target_dict.iteritems():
-            LOG.verbose("{:,}\t{}\t# {:,}".format(len(main_target), main_target, idx))
+            if tracing:
+                tracer.write("{:,}\t{}\t# {:,}".format(len(main_target), main_target, idx))
             f.write(pack('<i', len(main_target)))
             f.write(pack('<{}s'.format(len(main_target)), main_target))
 
         # haplotypes
-        LOG.verbose("{:,}\t# NUMBER OF HAPLOTYPES".format(len(emasef._haplotypes_list)))
+        if tracing:
+            tracer.write("{:,}\t# NUMBER OF HAPLOTYPES".format(len(emasef._haplotypes_list)))
         f.write(pack('<i', len(emasef._haplotypes_list)))
         for idx, hap in enumerate(emasef._haplotypes_list):
-            LOG.verbose("{:,}\t{}\t# {:,}".format(len(hap), hap, idx))
+            if tracing:
+                tracer.write("{:,}\t{}\t# {:,}".format(len(hap), hap, idx))
             f.write(pack('<i', len(hap)))
             f.write(pack('<{}s'.format(len(hap)), hap))
 
         # equivalence classes
-        LOG.verbose("{:,}\t# NUMBER OF EQUIVALANCE CLASSES".format(len(emasef._ec_list)))
+        if tracing:
+            tracer.write("{:,}\t# NUMBER OF EQUIVALANCE CLASSES".format(len(emasef._ec_list)))
         f.write(pack('<i', len(emasef._ec_list)))
         for idx, k in enumerate(emasef._ec_counts_list):
             # k is the count
-            LOG.verbose("{:,}\t# {:,}".format(k, idx))
+            if tracing:
+                tracer.write("{:,}\t# {:,}".format(k, idx))
             f.write(pack('<i', k))
 
+        tracer.flush()
+
         LOG.info("Determining mappings...")
+        profiling.start_phase('Determining mappings')
 
         # equivalence class mappings
-        LOG.verbose("{:,}\t# NUMBER OF EQUIVALANCE CLASS MAPPINGS".format(len(emasef._alignments)))
+        if tracing:
+            tracer.write("{:,}\t# NUMBER OF EQUIVALANCE CLASS MAPPINGS".format(len(emasef._alignments)))
         f.write(pack('<i', len(emasef._alignments)))
 
-        for idx, alignment in enumerate(emasef._alignments):
-            LOG.verbose("{}\t{}\t{}\t# {}\t{}".format(alignment[0], alignment[1], alignment[2], emasef._target_list[alignment[1]], int_to_list(alignment[2], len(emasef._haplotypes_list))))
-            f.write(pack('<i', alignment[0]))
-            f.write(pack('<i', alignment[1]))
-            f.write(pack('<i', alignment[2]))
+        num_haplotypes = len(emasef._haplotypes_list)
+
+        if tracing:
+            for alignment in emasef._alignments:
+                tracer.write("{}\t{}\t{}\t# {}\t{}".format(alignment[0], alignment[1], alignment[2],
+                                                            emasef._target_list[alignment[1]],
+                                                            bitfield.to_list(alignment[2], num_haplotypes)))
+
+        np.ascontiguousarray(emasef._alignments, dtype='<i4').tofile(f)
 
         f.close()
+        tracer.flush()
+        profiling.end_phase(len(emasef._alignments))
     except:
         _show_error()
 
@@ -538,186 +1148,77 @@ that are "turned on" for a target
 """
 
 
-def convert(file_in, file_out, target_file=None, emase=False):
+def tid_bitfields(target_idx_to_main_target, haplotypes, header_lookup):
     """
-
-    :param file_in: Input BAM/SAM file.
-    :param file_out: Output file name.
-    :param target_file: The target file is a list of main targets that will be used as main targets,
-                        not to limit the main targets.  Useful for comparison purposes between BAM files.
-    :param emase: Emase output or normal.
-    :return:
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param haplotypes: sorted list of haplotypes
+    :param header_lookup: transcriptome.Transcriptome of the BAM header
+    :return: lookup of tid (as a string) -> bitfield of its haplotype
     """
-    LOG.info('Input File: {}'.format(file_in))
-    LOG.info('Output File: {}'.format(file_out))
+    haplotype_bits = dict(zip(haplotypes, bitfield.bits(np.arange(len(haplotypes))).tolist()))
+    return {idx: haplotype_bits[header_lookup.haplotype(int(idx))] for idx in target_idx_to_main_target}
 
-    if target_file:
-        LOG.info('Target File: {}'.format(target_file))
 
-    if emase:
-        LOG.info('Emase format requested')
+def ec_target_bitfields(ec_key, main_targets, target_idx_to_main_target, tid_bits, sort_targets=False):
+    """
+    The alignment rows of an equivalence class built by convert.
+
+    :param ec_key: comma separated string of tids
+    :param main_targets: OrderedDict of main target -> index
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param tid_bits: lookup of tid (as a string) -> bitfield of its haplotype, see tid_bitfields
+    :param sort_targets: return the rows in main target order
+    :return: list of (main target, bitfield)
+    """
+    arr_target_idx = ec_key.split(",")
 
-    main_targets = OrderedDict()
+    # get the main targets by name, OR'ing the haplotypes of their tids
+    temp_main_targets = set()
+    bits = {}
+    for idx in arr_target_idx:
+        main_target = target_idx_to_main_target[idx]
+        temp_main_targets.add(main_target)
+        bits[main_target] = bits.get(main_target, 0) | tid_bits[idx]
 
-    if target_file:
-        main_targets = parse_target_file(target_file)
-        if len(main_targets) == 0:
-            LOG.error("Unable to parse target file")
-            sys.exit(-1)
+    if sort_targets:
+        temp_main_targets = sorted(temp_main_targets, key=main_targets.get)
 
-    # ec = equivalence class
-    #      the KEY is a comma separated string of tids
-    #      the VALUE is the number of times this equivalence class has appeared
-    ec = OrderedDict()
+    return [(main_target, bits[main_target]) for main_target in temp_main_targets]
 
-    # ec_idx = lookup to ec
-    #          the KEY is a comma separated string of tids
-    #          the VALUE is a number specifying the insertion order of the KEY value in ec
-    ec_idx = {}
 
-    # all the haplotypes
-    haplotypes = set()
+def write_ec_table(file_out, emase, ec, ec_idx, main_targets, haplotypes, target_idx_to_main_target,
+                   header_lookup, sort_targets=False):
+    """
+    Write an equivalence class table built by convert.
 
-    # a lookup of tids to main_targets (Ensembl IDs)
-    target_idx_to_main_target = {}
+    :param file_out: Output file name.
+    :param emase: Emase output or normal.
+    :param ec: OrderedDict of ec key (comma separated tids) -> count
+    :param ec_idx: ec key -> index of the equivalence class
+    :param main_targets: OrderedDict of main target -> index
+    :param haplotypes: sorted list of haplotypes
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param header_lookup: transcriptome.Transcriptome of the BAM header
+    :param sort_targets: write the alignment rows of each equivalence class in main target order
+    """
+    _remove_file(file_out)
 
-    # unique number of tids encountered and the count
-    unique_tids = {}
+    if emase:
+        from emase import AlignmentPropertyMatrix as APM
 
-    # unique reads
-    unique_reads = {}
+        try:
+            LOG.info('Creating APM...')
+            profiling.start_phase('Creating APM')
 
-    # times encountering new read id
-    read_id_switch_counter = 0
-
-    same_read_target_counter = 0
-
-    try:
-        sam_file = pysam.Samfile(file_in, 'rb')
-        if len(sam_file.header) == 0:
-            raise Exception("BAM File has no header information")
-    except:
-        sam_file = pysam.Samfile(file_in, 'r')
-        if len(sam_file.header) == 0:
-            raise Exception("SAM File has no header information")
-
-    line_no = 0
-    ec_key = None
-    tid = None
-
-    target_ids = []
-    try:
-        read_id = None
-
-        while True:
-            alignment = sam_file.next()
-            line_no += 1
-
-            # reference_sequence_name = Column 3 from file, the Reference NAME (EnsemblID_Haplotype)
-            # tid = the target id, which is 0 or a positive integer mapping to entries
-            #       within the sequence dictionary in the header section of a BAM file
-            # main_target = the Ensembl id of the transcript
-
-            if alignment.flag == 4:
-                continue
-
-            reference_sequence_name = sam_file.getrname(alignment.tid)
-            tid = str(alignment.tid)
-            main_target = reference_sequence_name.split('_')[0]
-
-            try:
-                unique_tids[tid] += 1
-            except KeyError:
-                unique_tids[tid] = 1
-
-            #LOG.verbose("{}\t{}\t{}".format(main_target, reference_sequence_name, tid))
-
-            if target_file:
-                if main_target not in main_targets:
-                    LOG.error("Unexpected target found in BAM file: {}".format(main_target))
-                    sys.exit(-1)
-            else:
-                if main_target not in main_targets:
-                    main_targets[main_target] = len(main_targets)
-
-            target_idx_to_main_target[tid] = main_target
-
-            try:
-                haplotypes.add(reference_sequence_name.split('_')[1])
-            except:
-                LOG.info('Unable to parse Haplotype from {}'.format(reference_sequence_name))
-                return
-
-            # read_id = Column 1 from file, the Query template NAME
-            if read_id is None:
-                read_id = alignment.qname
-
-            try:
-                unique_reads[read_id] += 1
-            except KeyError:
-                unique_reads[read_id] = 1
-
-            if read_id != alignment.qname:
-                ec_key = ','.join(sorted(target_ids))
-
-                try:
-                    ec[ec_key] += 1
-                except KeyError:
-                    ec[ec_key] = 1
-                    ec_idx[ec_key] = len(ec_idx)
-
-                read_id = alignment.qname
-                target_ids = [tid]
-                read_id_switch_counter += 1
-            else:
-                if tid not in target_ids:
-                    target_ids.append(tid)
-                else:
-                    same_read_target_counter += 1
-
-            if line_no % 1000000 == 0:
-                LOG.info("{0:,} alignments processed, with {1:,} equivalence classes".format(line_no, len(ec)))
-
-    except StopIteration:
-        LOG.info("{0:,} alignments processed, with {1:,} equivalence classes".format(line_no, len(ec)))
-
-    if tid not in target_ids:
-        target_ids.append(tid)
-    else:
-        same_read_target_counter += 1
-
-    ec_key = ','.join(sorted(target_ids))
-
-    try:
-        ec[ec_key] += 1
-    except KeyError:
-        ec[ec_key] = 1
-        ec_idx[ec_key] = len(ec_idx)
-
-    haplotypes = sorted(list(haplotypes))
-
-    LOG.info("# Unique Reads: {:,}".format(len(unique_reads)))
-    LOG.info("# Reads/Target Duplications: {:,}".format(same_read_target_counter))
-    LOG.info("# Main Targets: {:,}".format(len(main_targets)))
-    LOG.info("# Haplotypes: {:,}".format(len(haplotypes)))
-    LOG.info("# Unique Targets: {:,}".format(len(unique_tids)))
-    LOG.info("# Equivalence Classes: {:,}".format(len(ec)))
-
-    try:
-        os.remove(file_out)
-    except OSError:
-        pass
-
-    if emase:
-        try:
-            LOG.info('Creating APM...')
-            if LOG.isEnabledFor(VERBOSE_LEVELV_NUM):
-                LOG.verbose("HAPLOTYPES")
-                for h in haplotypes:
-                    LOG.verbose(h)
-                LOG.verbose("MAIN TARGETS")
-                for m in main_targets:
-                    LOG.verbose(m)
+            tracer = get_tracer()
+            if tracer:
+                tracer.write("HAPLOTYPES")
+                for h in haplotypes:
+                    tracer.write(h)
+                tracer.write("MAIN TARGETS")
+                for m in main_targets:
+                    tracer.write(m)
+                tracer.flush()
 
             new_shape = (len(main_targets), len(haplotypes), len(ec))
 
@@ -730,120 +1231,1299 @@ def convert(file_in, file_out, target_file=None, emase=False):
             # ec.values -> the number of times this equivalence class has appeared
             apm.count = ec.values()
 
+            # one row per value set, only at debug level (-d)
+            tracer = get_tracer(logging.DEBUG)
+            tracing = bool(tracer)
+
+            tid_bits = tid_bitfields(target_idx_to_main_target, haplotypes, header_lookup)
+            mappings = array.array('i')
+
             # k = comma seperated string of tids
             # v = the count
             for k, v in ec.iteritems():
-                arr_target_idx = k.split(",")
-
-                # get the main targets by name
-                temp_main_targets = set()
-                for idx in arr_target_idx:
-                    temp_main_targets.add(target_idx_to_main_target[idx])
-
-                # loop through the targets and haplotypes to get the bits
-                for main_target in temp_main_targets:
-                    # main_target is not an index, but a value like 'ENMUST..001'
+                for main_target, bits in ec_target_bitfields(k, main_targets, target_idx_to_main_target, tid_bits,
+                                                             sort_targets):
+                    # ec_idx[k] = index of ec
+                    # main_targets[main_target] = idx of main target
+                    mappings.extend((ec_idx[k], main_targets[main_target], bits))
 
-                    for i, hap in enumerate(haplotypes):
-                        read_transcript = '{}_{}'.format(main_target, hap) # now 'ENMUST..001_A'
-                        # get the numerical tid corresponding to read_transcript
-                        read_transcript_idx = str(sam_file.gettid(read_transcript))
+                    if tracing:
+                        for i, bit in enumerate(bitfield.to_list(bits, len(haplotypes))):
+                            if bit:
+                                tracer.write("{}\t{}\t{}".format(ec_idx[k], main_targets[main_target], i))
 
-                        if read_transcript_idx in arr_target_idx:
-                            LOG.debug("{}\t{}\t{}".format(ec_idx[k], main_targets[main_target], i))
+            ec_file.fill_apm(apm, np.frombuffer(mappings, dtype=np.dtype('i')))
 
-                            # main_targets[main_target] = idx of main target
-                            # i = the haplotype
-                            # ec_idx[k] = index of ec
-                            apm.set_value(main_targets[main_target], i, ec_idx[k], 1)
+            tracer.flush()
+            profiling.end_phase(len(ec))
 
             LOG.info("Finalizing...")
+            profiling.start_phase('Finalizing')
             apm.finalize()
             apm.save(file_out, title='bam2ec')
+            profiling.end_phase()
         except:
             _show_error()
+            # no partial output that looks like a result
+            _remove_file(file_out)
     else:
         try:
             LOG.info("Generating BIN file...")
+            profiling.start_phase('Generating BIN file')
 
             f = open(file_out, "wb")
 
+            tracer = get_tracer()
+            tracing = bool(tracer)
+
             # version
             f.write(pack('<i', 1))
-            LOG.verbose("1\t# VERSION")
+            if tracing:
+                tracer.write("1\t# VERSION")
 
             # targets
-            LOG.verbose("{:,}\t# NUMBER OF TARGETS".format(len(main_targets)))
+            if tracing:
+                tracer.write("{:,}\t# NUMBER OF TARGETS".format(len(main_targets)))
             f.write(pack('<i', len(main_targets)))
             for main_target, idx in main_targets.iteritems():
-                LOG.verbose("{:,}\t{}\t# {:,}".format(len(main_target), main_target, idx))
+                if tracing:
+                    tracer.write("{:,}\t{}\t# {:,}".format(len(main_target), main_target, idx))
                 f.write(pack('<i', len(main_target)))
                 f.write(pack('<{}s'.format(len(main_target)), main_target))
 
             # haplotypes
-            LOG.verbose("{:,}\t# NUMBER OF HAPLOTYPES".format(len(haplotypes)))
+            if tracing:
+                tracer.write("{:,}\t# NUMBER OF HAPLOTYPES".format(len(haplotypes)))
             f.write(pack('<i', len(haplotypes)))
             for idx, hap in enumerate(haplotypes):
-                LOG.verbose("{:,}\t{}\t# {:,}".format(len(hap), hap, idx))
+                if tracing:
+                    tracer.write("{:,}\t{}\t# {:,}".format(len(hap), hap, idx))
                 f.write(pack('<i', len(hap)))
                 f.write(pack('<{}s'.format(len(hap)), hap))
 
             # equivalence classes
-            LOG.verbose("{:,}\t# NUMBER OF EQUIVALANCE CLASSES".format(len(ec)))
+            if tracing:
+                tracer.write("{:,}\t# NUMBER OF EQUIVALANCE CLASSES".format(len(ec)))
             f.write(pack('<i', len(ec)))
             for idx, k in enumerate(ec.keys()):
                 # ec[k] is the count
-                LOG.verbose("{:,}\t# {}\t{:,}".format(ec[k], k, idx))
+                if tracing:
+                    tracer.write("{:,}\t# {}\t{:,}".format(ec[k], k, idx))
                 f.write(pack('<i', ec[k]))
 
+            tracer.flush()
+            profiling.end_phase(len(ec))
+
             LOG.info("Determining mappings...")
+            profiling.start_phase('Determining mappings')
+
+            # equivalence class mappings, (ec index, main target index, bitfield) rows
+            tid_bits = tid_bitfields(target_idx_to_main_target, haplotypes, header_lookup)
+            mappings = array.array('i')
 
-            # equivalence class mappings
-            counter = 0
             for k, v in ec.iteritems():
-                arr_target_idx = k.split(",")
+                for main_target, bits in ec_target_bitfields(k, main_targets, target_idx_to_main_target, tid_bits,
+                                                             sort_targets):
+                    mappings.extend((ec_idx[k], main_targets[main_target], bits))
+
+            counter = len(mappings) // 3
+
+            if tracing:
+                tracer.write("{:,}\t# NUMBER OF EQUIVALANCE CLASS MAPPINGS".format(counter))
+                main_target_names = main_targets.keys()
+                for i in xrange(0, len(mappings), 3):
+                    tracer.write("{}\t{}\t{}\t# {}\t{}".format(mappings[i], mappings[i + 1], mappings[i + 2],
+                                                                main_target_names[mappings[i + 1]],
+                                                                bitfield.to_list(mappings[i + 2], len(haplotypes))))
+            f.write(pack('<i', counter))
+            np.frombuffer(mappings, dtype=np.dtype('i')).astype('<i4').tofile(f)
+
+            f.close()
+            tracer.flush()
+            profiling.end_phase(counter)
+        except:
+            _show_error()
+            # no partial output that looks like a result
+            _remove_file(file_out)
 
-                # get the main targets by name
-                temp_main_targets = set()
-                for idx in arr_target_idx:
-                    temp_main_targets.add(target_idx_to_main_target[idx])
 
-                counter += len(temp_main_targets)
+def write_ec_runs(file_out, ec_spill, main_targets, haplotypes, target_idx_to_main_target, header_lookup,
+                  min_count=None, max_targets=None, redistribute=False):
+    """
+    Write the equivalence class table merged by convert --max-memory, streaming
+    it from the merged run instead of holding it in memory.  The equivalence
+    classes are numbered in the order of their keys.
 
-            LOG.verbose("{:,}\t# NUMBER OF EQUIVALANCE CLASS MAPPINGS".format(counter))
-            f.write(pack('<i', counter))
+    With min_count or max_targets the table is pruned as by ec_file.filter_ecs
+    on the way: a first pass keeps the count and number of targets of every
+    equivalence class, and with redistribute the best surviving equivalence
+    class of every target, the second writes the survivors, renumbered.
 
-            for k, v in ec.iteritems():
-                arr_target_idx = k.split(",")
+    :param file_out: Output file name.
+    :param ec_spill: spill.ECSpill after merge
+    :param main_targets: OrderedDict of main target -> index
+    :param haplotypes: sorted list of haplotypes
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param header_lookup: transcriptome.Transcriptome of the BAM header
+    :param min_count: remove equivalence classes with fewer reads
+    :param max_targets: remove equivalence classes with more targets
+    :param redistribute: move the reads of removed equivalence classes, see ec_file.filter_ecs
+    """
+    LOG.info("Generating BIN file...")
+    profiling.start_phase('Generating BIN file')
+
+    tracer = get_tracer()
+    tracing = bool(tracer)
+
+    def ec_targets(k):
+        return set(main_targets[target_idx_to_main_target[idx]] for idx in k.split(","))
+
+    # count and number of targets of every equivalence class, the best survivor of every target
+    counts = array.array('i')
+    num_targets = array.array('i')
+    best_ec = [-1] * len(main_targets)
+    best_count = [-1] * len(main_targets)
+
+    for idx, (k, count) in enumerate(ec_spill):
+        targets = ec_targets(k)
+        counts.append(count)
+        num_targets.append(len(targets))
+
+        if redistribute and not (min_count and count < min_count) and not (max_targets and len(targets) > max_targets):
+            for target in targets:
+                # the most reads, lowest index on ties
+                if count > best_count[target]:
+                    best_count[target] = count
+                    best_ec[target] = idx
+
+    counts = np.frombuffer(counts, dtype=np.dtype('i')).astype(np.int64)
+    num_targets = np.frombuffer(num_targets, dtype=np.dtype('i'))
+
+    rare = counts < min_count if min_count else np.zeros(len(counts), dtype=bool)
+    oversized = num_targets > max_targets if max_targets else np.zeros(len(counts), dtype=bool)
+    keep = ~(rare | oversized)
+    new_index = np.cumsum(keep) - 1
+    new_counts = counts[keep]
+    counter = int(num_targets[keep].sum())
+
+    with open(file_out, "wb") as f:
+        # version
+        f.write(pack('<i', 1))
 
-                # get the main targets by name
-                temp_main_targets = set()
-                for idx in arr_target_idx:
-                    temp_main_targets.add(target_idx_to_main_target[idx])
+        # targets
+        f.write(pack('<i', len(main_targets)))
+        for main_target in main_targets:
+            f.write(pack('<i', len(main_target)))
+            f.write(pack('<{}s'.format(len(main_target)), main_target))
 
-                # loop through the haplotypes and targets to get the bits
-                for main_target in temp_main_targets:
-                    # main_target is not an index, but a value like 'ENMUST..001'
+        # haplotypes
+        f.write(pack('<i', len(haplotypes)))
+        for hap in haplotypes:
+            f.write(pack('<i', len(hap)))
+            f.write(pack('<{}s'.format(len(hap)), hap))
 
-                    bits = []
+        # equivalence classes, the counts are written once the reads are redistributed
+        f.write(pack('<i', len(new_counts)))
+        counts_offset = f.tell()
+        f.seek(4 * len(new_counts), os.SEEK_CUR)
 
-                    for hap in haplotypes:
-                        read_transcript = '{}_{}'.format(main_target, hap) # now 'ENMUST..001_A'
-                        read_transcript_idx = str(sam_file.gettid(read_transcript))
+        profiling.end_phase(len(counts))
 
-                        if read_transcript_idx in arr_target_idx:
-                            bits.append(1)
-                        else:
-                            bits.append(0)
+        LOG.info("Determining mappings...")
+        profiling.start_phase('Determining mappings')
 
-                    LOG.verbose("{}\t{}\t{}\t# {}\t{}".format(ec_idx[k], main_targets[main_target], list_to_int(bits), main_target, bits))
-                    f.write(pack('<i', ec_idx[k]))
-                    f.write(pack('<i', main_targets[main_target]))
-                    f.write(pack('<i', list_to_int(bits)))
+        # equivalence class mappings
+        f.write(pack('<i', counter))
+        tid_bits = tid_bitfields(target_idx_to_main_target, haplotypes, header_lookup)
+        redistributed = 0
+
+        for idx, (k, count) in enumerate(ec_spill):
+            if keep[idx]:
+                new_idx = int(new_index[idx])
+                for main_target, bits in ec_target_bitfields(k, main_targets, target_idx_to_main_target, tid_bits):
+                    if tracing:
+                        tracer.write("{}\t{}\t{}\t# {}\t{}".format(new_idx, main_targets[main_target], bits,
+                                                                    main_target,
+                                                                    bitfield.to_list(bits, len(haplotypes))))
+                    f.write(pack('<iii', new_idx, main_targets[main_target], bits))
+            elif redistribute:
+                candidates = [best_ec[target] for target in ec_targets(k) if best_ec[target] >= 0]
+                if candidates:
+                    # the candidate with the most reads, lowest index on ties
+                    best = max(candidates, key=lambda c: (counts[c], -c))
+                    new_counts[new_index[best]] += count
+                    redistributed += count
+
+        f.seek(counts_offset)
+        new_counts.astype('<i4').tofile(f)
+
+    tracer.flush()
+    profiling.end_phase(counter)
+
+    if min_count or max_targets:
+        LOG.info("# Equivalence Classes Removed: {:,} of {:,}".format(int((~keep).sum()), len(counts)))
+        if min_count:
+            LOG.info("# Fewer than {:,} reads: {:,}".format(min_count, rare.sum()))
+        if max_targets:
+            LOG.info("# More than {:,} targets: {:,}".format(max_targets, oversized.sum()))
+        LOG.info("# Alignment Rows Removed: {:,}".format(int(num_targets.sum()) - counter))
+        LOG.info("# Reads Redistributed: {:,}".format(redistributed))
+        LOG.info("# Reads Removed: {:,}".format(int(counts[~keep].sum()) - redistributed))
+
+
+def table_to_ec(table, main_targets, haplotypes, target_idx_to_main_target, header_lookup, sort_targets=False):
+    """
+    An equivalence class table built by convert as an EC object, with the
+    equivalence classes and alignment rows write_ec_table writes.
+
+    :param table: iterable of (ec key, count) in equivalence class order, i.e. ec.iteritems() or a merged ECSpill
+    :param main_targets: OrderedDict of main target -> index
+    :param haplotypes: sorted list of haplotypes
+    :param target_idx_to_main_target: lookup of tid (as a string) -> main target
+    :param header_lookup: transcriptome.Transcriptome of the BAM header
+    :param sort_targets: the alignment rows of each equivalence class in main target order
+    :return: ec_file.EC object (version 1)
+    """
+    tid_bits = tid_bitfields(target_idx_to_main_target, haplotypes, header_lookup)
+    counts = array.array('i')
+    mappings = array.array('i')
+
+    for idx, (k, count) in enumerate(table):
+        counts.append(count)
+        for main_target, bits in ec_target_bitfields(k, main_targets, target_idx_to_main_target, tid_bits,
+                                                     sort_targets):
+            mappings.extend((idx, main_targets[main_target], bits))
+
+    ec = ec_file.EC()
+    ec.version = 1
+    ec._targets_list = list(main_targets)
+    ec._targets_dict = OrderedDict((t, i) for i, t in enumerate(ec._targets_list))
+    ec._haplotypes_list = list(haplotypes)
+    ec._haplotypes_dict = OrderedDict((h, i) for i, h in enumerate(ec._haplotypes_list))
+    ec._ec_list = range(len(counts))
+    ec._ec_counts_list = np.frombuffer(counts, dtype=np.dtype('i'))
+    ec._alignments = np.frombuffer(mappings, dtype=np.dtype('i')).reshape(-1, 3)
+
+    return ec
+
+
+def group_file_name(file_out, group):
+    """
+    Name of the output file for one group, <name>.<group><extension>
 
-            f.close()
+    :param file_out: Output file name.
+    :param group: the tag value of the group
+    :return: file name
+    """
+    base, ext = os.path.splitext(file_out)
+    safe_group = re.sub(r'[^A-Za-z0-9_.-]', '_', str(group))
+    return '{}.{}{}'.format(base, safe_group, ext)
+
+
+def group_file_names(file_out, groups):
+    """
+    Names of the output files of all the groups, see group_file_name.
+
+    Groups that only differ in the characters group_file_name replaces, i.e.
+    A/B and A_B, would share a file, so their names get the first 8 hex
+    digits of the SHA-1 of the group appended: <name>.<group>_<sha1><extension>
+
+    :param file_out: Output file name.
+    :param groups: the tag values of the groups
+    :return: OrderedDict of group -> file name
+    """
+    names = OrderedDict((group, group_file_name(file_out, group)) for group in groups)
+
+    groups_per_name = {}
+    for name in names.itervalues():
+        groups_per_name[name] = groups_per_name.get(name, 0) + 1
+
+    for group, name in names.items():
+        if groups_per_name[name] > 1:
+            base, ext = os.path.splitext(name)
+            names[group] = '{}_{}{}'.format(base, hashlib.sha1(str(group)).hexdigest()[:8], ext)
+
+    if len(set(names.itervalues())) != len(names):
+        raise ValueError("Groups of {} cannot be given distinct file names".format(file_out))
+
+    return names
+
+
+# estimated bytes convert holds per read on top of the read name, the entry
+# in the dictionary of unique reads; measured with CPython 2.7 on 64 bit Linux
+READ_ENTRY_BYTES = 110
+
+# a sample of fewer bytes (after the header) gives rough estimates, about 4 BGZF blocks
+PLAN_MIN_SAMPLE_BYTES = 1 << 18
+
+
+def _bgzf_offset(file_in, virtual_offset):
+    """
+    :return: the compressed offset of a BGZF virtual offset, interpolated within its block
+    """
+    block_offset = virtual_offset >> 16
+    within = virtual_offset & 0xffff
+    if not within:
+        return block_offset
+
+    with open(file_in, 'rb') as f:
+        # gzip header with the BC extra subfield holding the block size
+        f.seek(block_offset)
+        header = f.read(18)
+        if len(header) < 18 or header[12:14] != 'BC':
+            return block_offset
+        block_size = unpack('<H', header[16:18])[0] + 1
+
+        # ISIZE, the uncompressed size, ends the block
+        f.seek(block_offset + block_size - 4)
+        uncompressed = unpack('<I', f.read(4))[0]
+
+    return block_offset + block_size * within // max(uncompressed, 1)
+
+
+def _memory_bytes():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+
+def plan(file_in, sample_reads=200000, exclude_flags=EXCLUDE_FLAGS, memory_limit=None, report_file=None):
+    """
+    Estimate the size of the equivalence class table of a BAM/SAM file and
+    the resources convert needs, from the header and the first reads.
+
+    The distinct equivalence classes of the sample are counted at several
+    prefixes and extrapolated with a power law, the other sizes scale with
+    the input file size.  The estimates assume the reads that follow look
+    like the first ones.
+
+    :param file_in: BAM/SAM file, grouped by read name
+    :param sample_reads: number of reads to sample
+    :param exclude_flags: skip records with any of these flag bits, like convert
+    :param memory_limit: memory of a node in MB, default the physical memory of this machine
+    :param report_file: file for the JSON report, '-' for standard output, None for no file
+    :return: report dictionary
+    """
+    import json
+    import multiprocessing
+    import pysam
+
+    base_rss_kb = telemetry.current_rss_kb()
+
+    try:
+        sam_file = pysam.AlignmentFile(file_in, 'rb')
+    except ValueError:
+        sam_file = pysam.AlignmentFile(file_in, 'r')
+
+    if len(sam_file.references) == 0:
+        raise ValueError("{} has no header information".format(file_in))
+
+    is_bam = getattr(sam_file, 'is_bam', True)
+    input_bytes = os.path.getsize(file_in)
+
+    profiling.start_phase('Sampling reads')
+
+    read_ids = []
+    tids = []
+    qname_bytes = 0
+    num_records = 0
+    read_id = -1
+    qname = None
+    done = False
+
+    # offsets of the first record and of the end of the sample
+    header_offset = offset = sam_file.tell()
+
+    for alignment in sam_file:
+        excluded = alignment.flag & exclude_flags
+
+        if not excluded and alignment.query_name != qname and read_id + 1 == sample_reads:
+            done = True
+            break
+
+        num_records += 1
+        offset = sam_file.tell()
+
+        if excluded:
+            continue
+
+        if alignment.query_name != qname:
+            qname = alignment.query_name
+            qname_bytes += len(qname)
+            read_id += 1
+
+        read_ids.append(read_id)
+        tids.append(alignment.reference_id)
+
+    if is_bam:
+        header_bytes = _bgzf_offset(file_in, header_offset)
+        sample_bytes = _bgzf_offset(file_in, offset) if done else input_bytes
+    else:
+        header_bytes = header_offset
+        sample_bytes = offset if done else input_bytes
+    references = sam_file.references
+    sam_file.close()
+
+    profiling.end_phase(num_records)
+
+    num_reads = read_id + 1
+    if num_reads == 0:
+        raise ValueError("{} has no reads to sample".format(file_in))
+
+    read_ids = np.array(read_ids, dtype=np.int64)
+    tids = np.array(tids, dtype=np.int64)
+    lookup = transcriptome.build(references)
+
+    # distinct equivalence classes in growing prefixes of the sample
+    profiling.start_phase('Building equivalence classes')
+    prefix_reads = sorted(set(max(1, num_reads >> shift) for shift in xrange(4)))
+    prefix_ecs = []
+    for reads in prefix_reads:
+        rows = read_ids < reads
+        prefix_ecs.append(len(builder.from_arrays(read_ids[rows], tids[rows], references, None, lookup).counts))
+    ec = builder.from_arrays(read_ids, tids, references, None, lookup)
+    profiling.end_phase(len(tids))
+
+    if done and sample_bytes - header_bytes < PLAN_MIN_SAMPLE_BYTES:
+        LOG.info("Only {:,} bytes of alignments sampled, the estimates are rough, "
+                 "sample more reads".format(sample_bytes - header_bytes))
+
+    # the header is not part of the reads
+    scale = float(input_bytes - header_bytes) / max(sample_bytes - header_bytes, 1)
+    est_reads = int(num_reads * scale)
+    est_alignments = int(num_records * scale)
+
+    if len(prefix_reads) > 1 and prefix_ecs[0] > 0:
+        growth = float(np.polyfit(np.log(prefix_reads), np.log(prefix_ecs), 1)[0])
+    else:
+        growth = 1.0
+    growth = min(max(growth, 0.0), 1.0)
+
+    num_ecs = len(ec.counts)
+    est_ecs = int(min(num_ecs * scale ** growth, est_reads))
+    rows_per_ec = float(len(ec.alignments)) / max(num_ecs, 1)
+    est_rows = int(est_ecs * rows_per_ec)
+
+    # average length of an ec key, comma separated tids
+    tid_digits = len(str(max(len(references) - 1, 0)))
+    key_bytes = (tid_digits + 1) * float(len(tids)) / num_reads
+
+    names_bytes = sum(len(t) + 4 for t in ec.targets) + sum(len(h) + 4 for h in ec.haplotypes)
+    # version and the four counts, then names, ec counts and rows
+    est_output_bytes = 20 + names_bytes + 4 * est_ecs + 12 * est_rows
+
+    table_bytes = est_ecs * (spill.EC_ENTRY_BYTES + key_bytes)
+    reads_bytes = est_reads * (READ_ENTRY_BYTES + float(qname_bytes) / num_reads)
+    est_peak_mb = int(base_rss_kb / 1024.0 + (table_bytes + reads_bytes) / (1024 * 1024)) + 1
+
+    if memory_limit is None:
+        memory = _memory_bytes()
+        memory_limit = memory / (1024 * 1024) if memory else None
+
+    # leave a quarter for the process, the spill buffers and estimate error
+    recommended = {
+        'memory_mb': int(est_peak_mb * 1.25) + 1,
+        'max_memory_mb': None,
+        'processes': 1,
+        'min_count': None,
+    }
+
+    if memory_limit and recommended['memory_mb'] > memory_limit:
+        # with a budget only the equivalence class table is held, not the read names
+        max_memory_mb = max(64, int(memory_limit * 0.5 - base_rss_kb / 1024.0))
+        recommended['max_memory_mb'] = max_memory_mb
+        recommended['memory_mb'] = int((base_rss_kb / 1024.0 + max_memory_mb) * 1.25) + 1
+
+    if memory_limit:
+        recommended['processes'] = max(1, min(multiprocessing.cpu_count(),
+                                              int(memory_limit // recommended['memory_mb'])))
+
+    singletons = float((ec.counts == 1).sum()) / max(num_ecs, 1)
+    if singletons > 0.5:
+        # most of the table, and of the output, are equivalence classes seen once
+        recommended['min_count'] = 2
+
+    report = {
+        'input': file_in,
+        'input_bytes': input_bytes,
+        'header_bytes': header_bytes,
+        'references': len(references),
+        'sample': {
+            'reads': num_reads,
+            'records': num_records,
+            'bytes': sample_bytes,
+            'equivalence_classes': num_ecs,
+            'alignment_rows': len(ec.alignments),
+            'singleton_fraction': round(singletons, 4),
+            'prefix_reads': prefix_reads,
+            'prefix_equivalence_classes': prefix_ecs,
+        },
+        'estimate': {
+            'reads': est_reads,
+            'records': est_alignments,
+            'equivalence_classes': est_ecs,
+            'alignment_rows': est_rows,
+            'ec_growth_exponent': round(growth, 4),
+            'peak_memory_mb': est_peak_mb,
+            'output_bytes': est_output_bytes,
+        },
+        'memory_limit_mb': memory_limit,
+        'recommended': recommended,
+    }
+
+    LOG.info("Sampled {:,} reads in {:,} of {:,} bytes".format(num_reads, sample_bytes, input_bytes))
+    LOG.info("# Estimated Reads: {:,}".format(est_reads))
+    LOG.info("# Estimated Equivalence Classes: {:,}".format(est_ecs))
+    LOG.info("# Estimated Alignment Rows: {:,}".format(est_rows))
+    LOG.info("# Estimated Peak Memory: {:,} MB".format(est_peak_mb))
+    LOG.info("# Estimated Output Size: {:,} bytes".format(est_output_bytes))
+
+    if report_file:
+        out = sys.stdout if report_file == '-' else open(report_file, 'w')
+        try:
+            json.dump(report, out, indent=2, sort_keys=True, separators=(',', ': '))
+            out.write('\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    return report
+
+
+def convert_sam_text(file_in, file_out, target_file=None, emase=False, exclude_flags=EXCLUDE_FLAGS,
+                     telemetry_file=None, telemetry_interval=10.0, index_dir=None, min_count=None,
+                     max_targets=None, redistribute=False):
+    """
+    The convert of uncompressed SAM text without pysam, see sam_text.SAMText.
+
+    Only QNAME, FLAG and RNAME are parsed, a buffer at a time, and the
+    equivalence classes are counted as the buffers are read, see builder.ECBuilder.  The output has
+    the same targets, haplotypes, equivalence classes and counts as convert,
+    the alignment rows of an equivalence class are in main target order.
+    The parameters are those of convert.
+    """
+    profiling.start_phase('Reading header')
+
+    sam = sam_text.SAMText(file_in)
+    if len(sam.references) == 0:
+        raise Exception("SAM File has no header information")
+
+    header_lookup = transcriptome.from_header(sam, target_file, index_dir)
+
+    main_targets = None
+    if target_file:
+        main_targets = header_lookup.targets.keys()
+        if len(main_targets) == 0:
+            LOG.error("Unable to parse target file")
+            sys.exit(-1)
+
+    progress = telemetry.open_telemetry(telemetry_file, telemetry_interval, file_in) if telemetry_file else None
+
+    profiling.start_phase('Reading alignments')
+
+    table = builder.ECBuilder(sam.references, main_targets, header_lookup)
+    num_records = 0
+    num_filtered = 0
+    num_reads = 0
+
+    try:
+        for block_read_ids, block_tids, block_filtered in sam.blocks(exclude_flags):
+            table.add(block_read_ids, block_tids)
+
+            num_records += len(block_tids) + block_filtered
+            num_filtered += block_filtered
+            if len(block_read_ids):
+                num_reads = int(block_read_ids[-1]) + 1
+
+            LOG.debug("{0:,} alignments processed".format(num_records))
+            if progress:
+                progress.check(num_records, num_reads, table.num_ecs(), sam.position)
+
+        if progress:
+            progress.done(num_records, num_reads, table.num_ecs())
+    finally:
+        sam.close()
+        if progress:
+            progress.close()
+
+    LOG.info("{0:,} alignments processed".format(num_records))
+    profiling.end_phase(num_records)
+
+    profiling.start_phase('Building equivalence classes')
+    ec = table.ec()
+    profiling.end_phase(num_records - num_filtered)
+
+    LOG.info("# Unique Reads: {:,}".format(num_reads))
+    LOG.info("# Main Targets: {:,}".format(len(ec._targets_list)))
+    LOG.info("# Haplotypes: {:,}".format(len(ec._haplotypes_list)))
+    LOG.info("# Equivalence Classes: {:,}".format(len(ec._ec_counts_list)))
+    LOG.info("# Records Filtered: {:,}".format(num_filtered))
+
+    if min_count or max_targets:
+        ec, _ = _prune_ec(ec, min_count, max_targets, redistribute)
+
+    if emase:
+        ec.to_emase(file_out)
+    else:
+        ec.to_file(file_out)
+
+    LOG.info("Done with converting SAM file!")
+
+
+# arguments of convert that are not part of the result cache key: the input and
+# target file are keyed by content, the others do not change the output
+CACHE_IGNORED_ARGUMENTS = ('file_in', 'file_out', 'target_file', 'telemetry_file', 'telemetry_interval',
+                           'temp_dir', 'index_dir', 'cache_dir', 'cache_size', 'cell_sorted')
+
+
+def convert(file_in, file_out, target_file=None, emase=False, order=None, group_tag=None,
+            umi_tag=None, cell_tag='CB', umi_mismatch=False, telemetry_file=None, telemetry_interval=10.0,
+            max_memory=None, temp_dir=None, paired=False, exclude_flags=None, min_mapq=None, max_nm=None,
+            index_dir=None, min_count=None, max_targets=None, redistribute=False, cache_dir=None, cache_size=None,
+            cell_sorted=False):
+    """
+
+    :param file_in: Input BAM/SAM file, '-' for SAM on standard input.  Uncompressed SAM is read by
+                    convert_sam_text when order, group_tag, umi_tag, max_memory, paired, min_mapq and
+                    max_nm are not used.
+    :param file_out: Output file name.  With group_tag, the name the group files are derived from
+                     (see group_file_names) and <name>.groups.tsv lists the groups.
+    :param target_file: The target file is a list of main targets that will be used as main targets,
+                        not to limit the main targets.  Useful for comparison purposes between BAM files.
+    :param emase: Emase output or normal.
+    :param order: None to number equivalence classes as first seen, otherwise 'count' or 'target'
+                  to write them in a canonical order (see order_equivalence_classes).
+    :param group_tag: None for one output file, otherwise a tag such as RG or CB; reads are split by
+                      the value of the tag and one output file is written per group.
+    :param umi_tag: None to count every read, otherwise the UMI tag such as UB; a read is only counted
+                    the first time its (UMI, equivalence class) is seen within its cell.
+    :param cell_tag: the cell barcode tag used with umi_tag, reads without it are treated as one cell.
+    :param umi_mismatch: with umi_tag, also collapse UMIs one mismatch away from a UMI already seen.
+    :param telemetry_file: None for no telemetry, otherwise a file ('-' for stderr) for JSON lines with
+                           the progress of the conversion.
+    :param telemetry_interval: seconds between telemetry lines.
+    :param max_memory: None to hold the equivalence class table in memory, otherwise a budget in MB for
+                       the table; sorted runs are spilled to temp_dir when it is reached and merged at
+                       the end (see spill.ECSpill).  Only for the binary format without order, group_tag
+                       or umi_tag; equivalence classes are numbered in key order.  min_count and
+                       max_targets prune the merged table while it is written, see write_ec_runs.
+    :param temp_dir: directory for the spilled runs, default the system temporary directory.
+    :param paired: the equivalence class of a template is the intersection of the tids of read 1 and
+                   read 2, or the tids of the one mate that has alignments; templates whose mates share
+                   no tid are not counted.
+    :param exclude_flags: skip records with any of these flag bits, default EXCLUDE_FLAGS, or
+                          EXCLUDE_FLAGS_PAIRED with paired.  Secondary alignments (FLAG_SECONDARY) are
+                          the multimapping alignments of many aligners, so they are kept by default.
+    :param min_mapq: skip records with a lower mapping quality.
+    :param max_nm: skip records with a larger NM (edit distance) tag, records without NM are kept.
+    :param index_dir: directory of transcriptome index files, the lookups of the header and target file
+                      are loaded from there when an earlier run wrote them (see transcriptome.from_header).
+    :param min_count: remove equivalence classes with fewer reads before writing, see prune.
+    :param max_targets: remove equivalence classes with more main targets before writing, see prune.
+    :param redistribute: with min_count or max_targets, move the reads of removed equivalence classes.
+    :param cache_dir: None to always convert, otherwise a result cache directory; the output is linked
+                      from there when the same input and target file were converted with the same
+                      options before (see result_cache).  Not used with group_tag or standard input.
+    :param cache_size: size limit of the result cache in MB, default result_cache.DEFAULT_MAX_MB.
+    :param cell_sorted: with umi_tag, the reads of a cell are consecutive (sorted by cell, then grouped by
+                        name), so only the UMIs of the current cell are kept; fails when a cell reappears.
+    :return:
+    """
+    arguments = dict(locals())
+
+    if cache_dir and not group_tag and file_in != '-':
+        options = {name: value for name, value in arguments.iteritems() if name not in CACHE_IGNORED_ARGUMENTS}
+        return _run_cached(cache_dir, cache_size, 'convert', [file_in, target_file], options, file_out,
+                           lambda: convert(**dict(arguments, cache_dir=None)))
+
+    if max_memory and (emase or order or group_tag or umi_tag):
+        raise ValueError("max_memory cannot be combined with emase, order, group_tag or umi_tag")
+
+    LOG.info('Input File: {}'.format(file_in))
+    LOG.info('Output File: {}'.format(file_out))
+
+    if target_file:
+        LOG.info('Target File: {}'.format(target_file))
+
+    if emase:
+        LOG.info('Emase format requested')
+
+    if order:
+        LOG.info('Equivalence class order: {}'.format(order))
+
+    if group_tag:
+        LOG.info('Group tag: {}'.format(group_tag))
+
+    if umi_tag:
+        LOG.info('UMI tag: {}, cell tag: {}'.format(umi_tag, cell_tag))
+
+    if max_memory:
+        LOG.info('Equivalence class table budget: {:,} MB'.format(max_memory))
+
+    if exclude_flags is None:
+        exclude_flags = EXCLUDE_FLAGS_PAIRED if paired else EXCLUDE_FLAGS
+
+    if paired:
+        LOG.info('Paired-end, intersecting the targets of read 1 and read 2')
+
+    LOG.info('Excluded flags: {:#x}'.format(exclude_flags))
+
+    if min_mapq:
+        LOG.info('Minimum MAPQ: {}'.format(min_mapq))
+
+    if max_nm is not None:
+        LOG.info('Maximum NM: {}'.format(max_nm))
+
+    # uncompressed SAM only needs three columns when nothing looks at tags, mates or MAPQ
+    if not (order or group_tag or umi_tag or max_memory or paired or min_mapq or max_nm is not None) and \
+            sam_text.is_sam_text(file_in):
+        LOG.info('Reading SAM text')
+        return convert_sam_text(file_in, file_out, target_file, emase, exclude_flags, telemetry_file,
+                                telemetry_interval, index_dir, min_count, max_targets, redistribute)
+
+    import pysam
+
+    profiling.start_phase('Reading header')
+
+    main_targets = OrderedDict()
+
+    # ec = equivalence class
+    #      the KEY is a comma separated string of tids
+    #      the VALUE is the number of times this equivalence class has appeared
+    ec = OrderedDict()
+
+    # ec_idx = lookup to ec
+    #          the KEY is a comma separated string of tids
+    #          the VALUE is a number specifying the insertion order of the KEY value in ec
+    ec_idx = {}
+
+    # groups = one ec table per group, only used with group_tag
+    #          the KEY is the value of group_tag
+    #          the VALUE is an OrderedDict like ec, sharing the interned ec keys
+    groups = OrderedDict()
+
+    # reads without group_tag, records filtered out, templates whose mates share no target
+    counters = {'untagged': 0, 'filtered': 0, 'discordant': 0}
+
+    # tids of read 1 and read 2 of the current template, only used with paired
+    mates = (set(), set())
+
+    # (UMI, ec) pairs seen per cell, only used with umi_tag
+    umi_collapser = umi.UMICollapser(umi_mismatch, cell_sorted) if umi_tag else None
+
+    # sorted runs of ec spilled to disk, only used with max_memory
+    ec_spill = spill.ECSpill(int(max_memory * 1024 * 1024), temp_dir) if max_memory else None
+
+    # JSON lines of the progress, only used with telemetry_file
+    progress = None
+
+    try:
+        # all the haplotypes
+        haplotypes = set()
+
+        # a lookup of tids to main_targets (Ensembl IDs)
+        target_idx_to_main_target = {}
+
+        # unique reads
+        unique_reads = {}
+
+        # times encountering new read id
+        read_id_switch_counter = 0
+
+        same_read_target_counter = 0
+
+        try:
+            sam_file = pysam.Samfile(file_in, 'rb')
+            if len(sam_file.header) == 0:
+                raise Exception("BAM File has no header information")
         except:
-            _show_error()
+            sam_file = pysam.Samfile(file_in, 'r')
+            if len(sam_file.header) == 0:
+                raise Exception("SAM File has no header information")
+
+        # tid -> main target and haplotype, (main target, haplotype) -> tid
+        header_lookup = transcriptome.from_header(sam_file, target_file, index_dir)
+
+        if target_file:
+            main_targets = OrderedDict(header_lookup.targets)
+            if len(main_targets) == 0:
+                LOG.error("Unable to parse target file")
+                sys.exit(-1)
+
+        # main target and haplotype are only looked up the first time a tid is seen
+        tid_strings = header_lookup.tid_strings
+        seen_tids = bytearray(len(header_lookup))
+
+        if telemetry_file:
+            progress = telemetry.open_telemetry(telemetry_file, telemetry_interval, file_in)
+            is_bam = getattr(sam_file, 'is_bam', True)
+
+        def input_position():
+            try:
+                offset = sam_file.tell()
+            except (IOError, OSError, ValueError, NotImplementedError):
+                return None
+            # BAM files give a virtual offset, the compressed offset is in the upper 48 bits
+            return offset >> 16 if is_bam else offset
+
+        def get_tag(alignment, tag):
+            if not tag:
+                return None
+            try:
+                return alignment.get_tag(tag)
+            except KeyError:
+                return None
+
+        def read_tags(alignment):
+            # (group, cell, umi) of the read
+            return get_tag(alignment, group_tag), get_tag(alignment, cell_tag), get_tag(alignment, umi_tag)
+
+        def count_read(target_ids, tags):
+            ec_key = ','.join(sorted(target_ids))
+            group, cell, umi_seq = tags
+
+            if ec_spill and ec_spill.full():
+                ec_spill.write_run(ec)
+                ec_idx.clear()
+
+            if group_tag:
+                ec_key = intern(ec_key)
+
+            # with group_tag only the group tables are written, ec is not kept and
+            # ec_idx only numbers the equivalence classes for umi_collapser
+            if umi_collapser or not group_tag:
+                try:
+                    ec_id = ec_idx[ec_key]
+                except KeyError:
+                    ec_id = ec_idx[ec_key] = len(ec_idx)
+                    if not group_tag:
+                        ec[ec_key] = 0
+                    if ec_spill:
+                        ec_spill.add(ec_key)
+
+                if umi_collapser and not umi_collapser.add(cell, umi_seq, ec_id):
+                    return
+
+            if not group_tag:
+                ec[ec_key] += 1
+                return
+
+            if group is None:
+                counters['untagged'] += 1
+                return
+
+            try:
+                group_ec = groups[group]
+            except KeyError:
+                group_ec = groups[group] = OrderedDict()
+
+            group_ec[ec_key] = group_ec.get(ec_key, 0) + 1
+
+        def num_ecs():
+            # equivalence classes so far, with group_tag summed over the groups
+            if group_tag:
+                return sum(len(group_ec) for group_ec in groups.itervalues())
+            return len(ec)
+
+        def count_template(target_ids, tags):
+            if paired:
+                read1, read2 = mates
+                target_ids = read1 & read2 if read1 and read2 else read1 | read2
+                read1.clear()
+                read2.clear()
+
+                if not target_ids:
+                    counters['discordant'] += 1
+                    return
+
+            count_read(target_ids, tags)
+
+        tagged = group_tag or umi_tag
+        tags = (None, None, None)
+
+        profiling.start_phase('Reading alignments')
+
+        line_no = 0
+        tid = None
+
+        target_ids = []
+        try:
+            read_id = None
+
+            while True:
+                alignment = sam_file.next()
+                line_no += 1
+
+                # reference_sequence_name = Column 3 from file, the Reference NAME (EnsemblID_Haplotype)
+                # tid = the target id, which is 0 or a positive integer mapping to entries
+                #       within the sequence dictionary in the header section of a BAM file
+                # main_target = the Ensembl id of the transcript
+
+                if alignment.flag & exclude_flags:
+                    counters['filtered'] += 1
+                    continue
+
+                if min_mapq and alignment.mapping_quality < min_mapq:
+                    counters['filtered'] += 1
+                    continue
+
+                if max_nm is not None:
+                    nm = get_tag(alignment, 'NM')
+                    if nm is not None and nm > max_nm:
+                        counters['filtered'] += 1
+                        continue
+
+                tid = tid_strings[alignment.tid]
+
+                if not seen_tids[alignment.tid]:
+                    seen_tids[alignment.tid] = 1
+                    main_target = header_lookup.main_target(alignment.tid)
+
+                    if target_file:
+                        if main_target not in main_targets:
+                            LOG.error("Unexpected target found in BAM file: {}".format(main_target))
+                            sys.exit(-1)
+                    else:
+                        if main_target not in main_targets:
+                            main_targets[main_target] = len(main_targets)
+
+                    target_idx_to_main_target[tid] = main_target
+
+                    haplotype = header_lookup.haplotype(alignment.tid)
+                    if haplotype is None:
+                        LOG.info('Unable to parse Haplotype from {}'.format(sam_file.getrname(alignment.tid)))
+                        return
+
+                    haplotypes.add(haplotype)
+
+                # read_id = Column 1 from file, the Query template NAME
+                if read_id is None:
+                    read_id = alignment.qname
+                    if tagged:
+                        tags = read_tags(alignment)
+
+                if not ec_spill:
+                    try:
+                        unique_reads[read_id] += 1
+                    except KeyError:
+                        unique_reads[read_id] = 1
+
+                if read_id != alignment.qname:
+                    count_template(target_ids, tags)
+
+                    read_id = alignment.qname
+                    if tagged:
+                        tags = read_tags(alignment)
+                    target_ids = [tid]
+                    read_id_switch_counter += 1
+                else:
+                    if tid not in target_ids:
+                        target_ids.append(tid)
+                    else:
+                        same_read_target_counter += 1
+
+                if paired:
+                    mates[1 if alignment.flag & FLAG_READ2 else 0].add(tid)
+
+                if progress and not line_no & telemetry.CHECK_EVERY:
+                    progress.check(line_no, read_id_switch_counter + 1, num_ecs(), input_position())
+
+                if line_no % 1000000 == 0:
+                    LOG.info("{0:,} alignments processed, with {1:,} equivalence classes".format(line_no, num_ecs()))
+
+        except StopIteration:
+            LOG.info("{0:,} alignments processed, with {1:,} equivalence classes".format(line_no, num_ecs()))
+
+        if tid is not None:
+            if tid not in target_ids:
+                target_ids.append(tid)
+            else:
+                same_read_target_counter += 1
+
+            count_template(target_ids, tags)
+
+        profiling.end_phase(line_no)
+
+        if progress:
+            progress.done(line_no, read_id_switch_counter + 1, num_ecs())
+
+        if umi_tag:
+            # reads without a valid UMI can leave equivalence classes that were never counted
+            ec = OrderedDict((k, v) for k, v in ec.iteritems() if v > 0)
+            ec_idx = {k: idx for idx, k in enumerate(ec)}
+
+        haplotypes = sorted(list(haplotypes))
+
+        pruning = min_count or max_targets
+
+        def prune_table(file_name, table, sort_targets):
+            # the table as an EC object, pruned in memory and written in the requested format
+            pruned, _ = _prune_ec(table_to_ec(table, main_targets, haplotypes, target_idx_to_main_target,
+                                              header_lookup, sort_targets), min_count, max_targets, redistribute)
+            if emase:
+                pruned.to_emase(file_name)
+            else:
+                pruned.to_file(file_name)
+
+        def write_table(file_name, table, table_idx):
+            if not pruning:
+                write_ec_table(file_name, emase, table, table_idx, main_targets, haplotypes,
+                               target_idx_to_main_target, header_lookup, bool(order))
+                return
+
+            prune_table(file_name, table.iteritems(), bool(order))
+
+        if ec_spill:
+            profiling.start_phase('Merging spilled runs')
+            num_ec = ec_spill.merge(ec)
+            profiling.end_phase(num_ec)
+
+            # read names are not kept with a budget, the input is grouped by name
+            LOG.info("# Reads: {:,}".format(read_id_switch_counter + 1))
+            LOG.info("# Reads/Target Duplications: {:,}".format(same_read_target_counter))
+            LOG.info("# Main Targets: {:,}".format(len(main_targets)))
+            LOG.info("# Haplotypes: {:,}".format(len(haplotypes)))
+            LOG.info("# Unique Targets: {:,}".format(len(target_idx_to_main_target)))
+            LOG.info("# Equivalence Classes: {:,}".format(num_ec))
+            LOG.info("# Records Filtered: {:,}".format(counters['filtered']))
+
+            if paired:
+                LOG.info("# Templates without a common target: {:,}".format(counters['discordant']))
+
+            write_ec_runs(file_out, ec_spill, main_targets, haplotypes, target_idx_to_main_target, header_lookup,
+                          min_count, max_targets, redistribute)
+
+            LOG.info("Done with converting BAM file!")
+            return
+
+        if order:
+            if not target_file:
+                # first seen order depends on the order of the reads, names do not
+                main_targets = OrderedDict((t, idx) for idx, t in enumerate(sorted(main_targets)))
+
+            ec, ec_idx = order_equivalence_classes(ec, order, target_idx_to_main_target, main_targets)
+
+            for group, group_ec in groups.iteritems():
+                groups[group], _ = order_equivalence_classes(group_ec, order, target_idx_to_main_target, main_targets)
+
+        LOG.info("# Unique Reads: {:,}".format(len(unique_reads)))
+        LOG.info("# Reads/Target Duplications: {:,}".format(same_read_target_counter))
+        LOG.info("# Main Targets: {:,}".format(len(main_targets)))
+        LOG.info("# Haplotypes: {:,}".format(len(haplotypes)))
+        LOG.info("# Unique Targets: {:,}".format(len(target_idx_to_main_target)))
+        if not group_tag:
+            LOG.info("# Equivalence Classes: {:,}".format(len(ec)))
+        LOG.info("# Records Filtered: {:,}".format(counters['filtered']))
+
+        if paired:
+            LOG.info("# Templates without a common target: {:,}".format(counters['discordant']))
+
+        if umi_tag:
+            LOG.info("# Cells: {:,}".format(umi_collapser.num_cells()))
+            LOG.info("# Reads Collapsed by UMI: {:,}".format(umi_collapser.duplicates))
+            LOG.info("# Reads without a valid {} tag: {:,}".format(umi_tag, umi_collapser.invalid))
+
+        if group_tag:
+            LOG.info("# Groups: {:,}".format(len(groups)))
+            LOG.info("# Reads without {} tag: {:,}".format(group_tag, counters['untagged']))
+
+            group_files = group_file_names(file_out, groups)
+
+            groups_file = os.path.splitext(file_out)[0] + '.groups.tsv'
+            with open(groups_file, 'w') as f:
+                f.write('group\treads\tequivalence_classes\tfile\n')
+                for group, group_ec in groups.iteritems():
+                    group_file = group_files[group]
+                    f.write('{}\t{}\t{}\t{}\n'.format(group, sum(group_ec.itervalues()), len(group_ec), group_file))
+
+                    LOG.info("Group {}: {:,} equivalence classes".format(group, len(group_ec)))
+                    group_ec_idx = {k: idx for idx, k in enumerate(group_ec)}
+                    write_table(group_file, group_ec, group_ec_idx)
+        else:
+            write_table(file_out, ec, ec_idx)
+
+        LOG.info("Done with converting BAM file!")
+    finally:
+        # the spilled runs are removed and the telemetry closed however convert ends, also on sys.exit or ^C
+        if ec_spill:
+            ec_spill.cleanup()
+        if progress:
+            progress.close()
+
+
+def parse_manifest(manifest_file):
+    """
+    Parse a batch manifest, one job per line: <input file> <output file> [<target file>]
+
+    :param manifest_file: tab or space delimited manifest, lines starting with # are ignored
+    :return: list of (input file, output file, target file or None)
+    """
+    jobs = []
+    with open(manifest_file, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip() or line[0] == '#':
+                continue
+            parts = line.strip().split()
+            if len(parts) < 2:
+                raise ValueError("Manifest line {} needs an input and an output file".format(line_no))
+            jobs.append((parts[0], parts[1], parts[2] if len(parts) > 2 else None))
+    return jobs
+
+
+def _batch_job(job):
+    """
+    Run one conversion of a batch with its log written to <output file>.log
+
+    :param job: tuple of (input file, output file, target file, emase, order, index directory, cache directory)
+    :return: tuple of (input file, output file, status, seconds, message)
+    """
+    file_in, file_out, target_file, emase, order, index_dir, cache_dir = job
+
+    handler = logging.FileHandler(file_out + '.log', mode='w')
+    handler.setFormatter(BAM2ECFormatter())
+    saved_handlers = LOG.handlers
+    LOG.handlers = [handler]
+
+    status = 'OK'
+    message = ''
+    start = time.time()
+
+    # an output left by an earlier run is not a result of this one
+    _remove_file(file_out)
+
+    try:
+        convert(file_in, file_out, target_file, emase, order, index_dir=index_dir, cache_dir=cache_dir)
+        if not os.path.exists(file_out):
+            status = 'FAILED'
+            message = 'no output file created'
+    except SystemExit:
+        status = 'FAILED'
+        message = 'conversion exited'
+    except Exception, e:
+        status = 'FAILED'
+        message = str(e)
+        LOG.error(traceback.format_exc())
+    finally:
+        LOG.handlers = saved_handlers
+        handler.close()
+
+    return file_in, file_out, status, time.time() - start, message
+
+
+def batch(manifest_file, summary_file=None, num_processes=1, emase=False, order=None, index_dir=None,
+          cache_dir=None):
+    """
+    Convert many BAM/SAM files on a pool of worker processes.
+
+    The headers are parsed once up front, before the workers are started,
+    so the workers inherit the lookups of every distinct header instead of
+    rebuilding them for each job.
+
+    :param manifest_file: manifest of jobs, see parse_manifest
+    :param summary_file: tab delimited summary of the jobs, defaults to <manifest_file>.summary.tsv
+    :param num_processes: maximum number of conversions to run at once
+    :param emase: Emase output or normal.
+    :param order: canonical equivalence class order, see convert
+    :param index_dir: directory of transcriptome index files, see convert
+    :param cache_dir: result cache directory, see convert
+    :return: list of (input file, output file, status, seconds, message), in manifest order
+    """
+    import multiprocessing
+    import pysam
+
+    jobs = parse_manifest(manifest_file)
+    LOG.info("{:,} jobs in {}".format(len(jobs), manifest_file))
+
+    if not summary_file:
+        summary_file = manifest_file + '.summary.tsv'
+
+    profiling.start_phase('Reading headers')
+    header_keys = set()
+    for file_in, target_file in set((job[0], job[2]) for job in jobs):
+        try:
+            sam_file = pysam.AlignmentFile(file_in, 'rb', check_sq=False)
+        except (IOError, ValueError):
+            try:
+                sam_file = pysam.AlignmentFile(file_in, 'r', check_sq=False)
+            except (IOError, ValueError), e:
+                LOG.info("Unable to read header from {}: {}".format(file_in, e))
+                continue
+
+        try:
+            header_keys.add(transcriptome.from_header(sam_file, target_file, index_dir).key)
+        except (IOError, OSError), e:
+            LOG.info("Unable to read target file {}: {}".format(target_file, e))
+        sam_file.close()
+
+    LOG.info("{:,} distinct headers".format(len(header_keys)))
+
+    job_args = [(file_in, file_out, target_file, emase, order, index_dir, cache_dir)
+                for file_in, file_out, target_file in jobs]
+
+    profiling.start_phase('Converting')
+
+    results = []
+    pool = multiprocessing.Pool(processes=max(1, num_processes))
+    try:
+        # in manifest order, the summary lists the jobs as the manifest does
+        for result in pool.imap(_batch_job, job_args):
+            LOG.info("{}\t{}\t{:.2f}s\t{}".format(result[2], result[0], result[3], result[4]))
+            results.append(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    profiling.end_phase(len(results))
+
+    with open(summary_file, 'w') as f:
+        f.write('input\toutput\tstatus\tseconds\tmessage\n')
+        for file_in, file_out, status, seconds, message in results:
+            f.write('{}\t{}\t{}\t{:.2f}\t{}\n'.format(file_in, file_out, status, seconds, message))
+
+    num_failed = sum(1 for result in results if result[2] != 'OK')
+    LOG.info("{:,} jobs finished, {:,} failed, summary in {}".format(len(results), num_failed, summary_file))
+
+    return results
+
+
+def cache(cache_dir, max_size=None, clear=False, list_entries=False, verify=False):
+    """
+    Summarize and prune a result cache, see result_cache.
+
+    :param cache_dir: cache directory
+    :param max_size: remove the least recently used results past this size in MB
+    :param clear: remove every result
+    :param list_entries: log every result, least recently used first
+    :param verify: hash every result and remove those that changed
+    :return: list of (key, metadata) of the results left
+    """
+    cached_results = result_cache.ResultCache(cache_dir)
+
+    if clear:
+        max_size = 0
+
+    if verify and not clear:
+        LOG.info("Removed {:,} changed results".format(cached_results.verify()))
+
+    if max_size is not None:
+        num_removed, bytes_removed = cached_results.prune(int(max_size * 1024 * 1024))
+        LOG.info("Removed {:,} results, {:,} bytes".format(num_removed, bytes_removed))
+
+    entries = cached_results.entries()
+
+    if list_entries:
+        for key, meta in entries:
+            LOG.info("{}\t{}\t{:,}\t{}\t{}".format(key, meta['command'], meta['size'],
+                                                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                                                  time.localtime(meta['last_used'])),
+                                                    ','.join(f for f in meta['inputs'] if f)))
 
-    LOG.info("Done with converting BAM file!")
+    LOG.info("Cache Directory: {}".format(cache_dir))
+    LOG.info("# Results: {:,}".format(len(entries)))
+    LOG.info("# Bytes: {:,}".format(sum(meta['size'] for _, meta in entries)))
 
+    return entries
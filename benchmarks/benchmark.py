@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the bam2ec subcommands on synthetic data.
+
+Usage: python benchmarks/benchmark.py [-options]
+
+    -o, --output <JSON file>         results file, default benchmark_<version>.json
+    -s, --scales <reads,...>         comma separated read counts, default 10000,100000
+    -t, --targets <number>           number of main targets, default 1000
+    -H, --haplotypes <number>        number of haplotypes, default 8
+    -m, --multimap <rate>            fraction of multimapping reads, default 0.5
+    -c, --commands <name,...>        comma separated subcommands, default all
+    -w, --work <directory>           keep the generated files in directory
+
+Every subcommand runs in its own process, peak RSS is taken from the
+resource usage of that process.  ec2emase writes the input for emase2ec,
+so keep ec2emase when selecting emase2ec.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bam2ec import __version__ as version
+from bam2ec import synthetic
+
+
+def run(args):
+    """
+    Run bam2ec with args in a child process.
+
+    :return: tuple of (seconds, peak RSS in KB, exit status)
+    """
+    command = [sys.executable, '-m', 'bam2ec.app'] + args
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                                         env.get('PYTHONPATH', '')])
+
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+
+    # ru_maxrss is KB on Linux, bytes on OS X
+    max_rss = usage.ru_maxrss / 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+    return seconds, max_rss, os.WEXITSTATUS(status)
+
+
+COMMANDS = ['convert', 'convert-emase', 'dump', 'ec2emase', 'emase2ec', 'quantify']
+
+
+def benchmark_scale(work_dir, num_reads, num_targets, num_haplotypes, multimap_rate, selected=COMMANDS):
+    bam_file = os.path.join(work_dir, 'reads_{}.bam'.format(num_reads))
+    ec_out = os.path.join(work_dir, 'reads_{}.bin'.format(num_reads))
+    emase_out = os.path.join(work_dir, 'reads_{}.h5'.format(num_reads))
+    ec_from_emase = os.path.join(work_dir, 'reads_{}.emase.bin'.format(num_reads))
+    quant_out = os.path.join(work_dir, 'reads_{}.tsv'.format(num_reads))
+
+    num_alignments = synthetic.generate(bam_file, num_targets, num_haplotypes, num_reads, multimap_rate, seed=num_reads)
+
+    commands = [
+        ('convert', ['convert', '-i', bam_file, '-o', ec_out]),
+        ('convert-emase', ['convert', '-e', '-i', bam_file, '-o', emase_out + '.direct']),
+        ('dump', ['dump', '-i', ec_out]),
+        ('ec2emase', ['ec2emase', '-i', ec_out, '-o', emase_out]),
+        ('emase2ec', ['emase2ec', '-i', emase_out, '-o', ec_from_emase]),
+        ('quantify', ['quantify', '-i', ec_out, '-o', quant_out]),
+    ]
+
+    results = []
+    for name, args in commands:
+        if name not in selected:
+            continue
+
+        seconds, max_rss, status = run(args)
+        result = {
+            'command': name,
+            'reads': num_reads,
+            'alignments': num_alignments,
+            'targets': num_targets,
+            'haplotypes': num_haplotypes,
+            'multimap_rate': multimap_rate,
+            'seconds': round(seconds, 4),
+            'alignments_per_second': round(num_alignments / seconds, 1) if seconds else None,
+            'max_rss_kb': max_rss,
+            'status': status,
+        }
+        sys.stderr.write('{:>13}  {:>12,} reads  {:>10.3f}s  {:>14,.0f} aln/s  {:>10,} KB\n'.format(
+            name, num_reads, seconds, result['alignments_per_second'] or 0, max_rss))
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bam2ec subcommands on synthetic data')
+    parser.add_argument("-o", "--output", dest="output", default='benchmark_{}.json'.format(version))
+    parser.add_argument("-s", "--scales", dest="scales", default='10000,100000')
+    parser.add_argument("-t", "--targets", dest="targets", type=int, default=1000)
+    parser.add_argument("-H", "--haplotypes", dest="haplotypes", type=int, default=8)
+    parser.add_argument("-m", "--multimap", dest="multimap", type=float, default=0.5)
+    parser.add_argument("-c", "--commands", dest="commands", default=','.join(COMMANDS))
+    parser.add_argument("-w", "--work", dest="work")
+    args = parser.parse_args()
+
+    work_dir = args.work or tempfile.mkdtemp(prefix='bam2ec_benchmark_')
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    try:
+        for num_reads in [int(x) for x in args.scales.split(',')]:
+            results.extend(benchmark_scale(work_dir, num_reads, args.targets, args.haplotypes, args.multimap,
+                                           args.commands.split(',')))
+    finally:
+        if not args.work:
+            shutil.rmtree(work_dir)
+
+    report = {
+        'version': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    sys.stderr.write('Results written to {}\n'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark the bitfield codec against the per-row Python loops it replaced.
+
+Usage: python benchmarks/bitfield_benchmark.py [-options]
+
+    -o, --output <JSON file>         results file, default bitfield_<version>.json
+    -n, --rows <number>              number of bitfields, default 10,000,000
+    -H, --haplotypes <number,...>    comma separated haplotype counts, default 8,32
+    -l, --loop-rows <number>         rows timed for the per-row loops, default 100,000
+    -r, --repeats <number>           best of repeats, default 3
+
+The per-row loops are timed on fewer rows, their cost per row does not
+depend on the number of rows.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bam2ec import __version__ as version
+from bam2ec import bitfield
+
+
+def best_of(repeats, function, *args):
+    """
+    :return: the shortest of repeats runs of function in seconds
+    """
+    seconds = []
+    for _ in xrange(repeats):
+        start = time.time()
+        function(*args)
+        seconds.append(time.time() - start)
+    return min(seconds)
+
+
+def loop_decode(bitfields, num_haplotypes):
+    return [bitfield.to_list(value, num_haplotypes) for value in bitfields.tolist()]
+
+
+def loop_encode(lists):
+    return [bitfield.from_list(bits) for bits in lists]
+
+
+def benchmark_haplotypes(num_rows, num_haplotypes, loop_rows, repeats):
+    rng = np.random.RandomState(num_haplotypes)
+    bitfields = rng.randint(0, 1 << num_haplotypes, size=num_rows, dtype=np.int64).astype(np.uint32).view(np.int32)
+    on = bitfield.decode(bitfields, num_haplotypes)
+    groups = np.arange(num_haplotypes) // 2
+
+    loop_bitfields = bitfields[:loop_rows]
+    loop_lists = loop_decode(loop_bitfields, num_haplotypes)
+
+    timings = [
+        ('decode', num_rows, best_of(repeats, bitfield.decode, bitfields, num_haplotypes)),
+        ('encode', num_rows, best_of(repeats, bitfield.encode, on)),
+        ('popcount', num_rows, best_of(repeats, bitfield.popcount, bitfields)),
+        ('remap', num_rows, best_of(repeats, bitfield.remap, bitfields, groups)),
+        ('loop decode (int_to_list)', loop_rows, best_of(repeats, loop_decode, loop_bitfields, num_haplotypes)),
+        ('loop encode (list_to_int)', loop_rows, best_of(repeats, loop_encode, loop_lists)),
+    ]
+
+    results = []
+    for name, rows, seconds in timings:
+        result = {
+            'operation': name,
+            'haplotypes': num_haplotypes,
+            'rows': rows,
+            'seconds': round(seconds, 4),
+            'ns_per_row': round(seconds * 1e9 / rows, 1),
+        }
+        sys.stderr.write('{:>26}  {:>2} haplotypes  {:>12,} rows  {:>8.3f}s  {:>10,.1f} ns/row\n'.format(
+            name, num_haplotypes, rows, seconds, result['ns_per_row']))
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark the bitfield codec')
+    parser.add_argument("-o", "--output", dest="output", default='bitfield_{}.json'.format(version))
+    parser.add_argument("-n", "--rows", dest="rows", type=int, default=10 ** 7)
+    parser.add_argument("-H", "--haplotypes", dest="haplotypes", default='8,32')
+    parser.add_argument("-l", "--loop-rows", dest="loop_rows", type=int, default=10 ** 5)
+    parser.add_argument("-r", "--repeats", dest="repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for num_haplotypes in [int(x) for x in args.haplotypes.split(',')]:
+        results.extend(benchmark_haplotypes(args.rows, num_haplotypes, min(args.loop_rows, args.rows), args.repeats))
+
+    report = {
+        'version': version,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    sys.stderr.write('Results written to {}\n'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
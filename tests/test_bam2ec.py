@@ -8,21 +8,851 @@ test_bam2ec
 Tests for `bam2ec` module.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from bam2ec import bam2ec
+import numpy as np
+
+from bam2ec import bitfield
+from bam2ec import builder
+from bam2ec import ec_file
+from bam2ec import result_cache
+from bam2ec import sam_text
+from bam2ec import synthetic
+from bam2ec import transcriptome
+from bam2ec import util
 
 
 class TestBam2ec(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.work_dir = tempfile.mkdtemp(prefix='bam2ec_test_')
+        self.bam_file = os.path.join(self.work_dir, 'reads.bam')
+        self.num_reads = 500
+        synthetic.generate(self.bam_file, num_targets=20, num_haplotypes=4, num_reads=self.num_reads,
+                           multimap_rate=0.5, seed=1)
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.work_dir)
+
+    def test_000_convert(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+
+        ec = ec_file.parse(ec_out)
+        self.assertEqual(ec.version, 1)
+        self.assertEqual(len(ec._haplotypes_list), 4)
+        self.assertEqual(sum(ec._ec_counts_list), self.num_reads)
+        self.assertTrue((ec._alignments[:, 2] > 0).all())
+
+    def test_001_sorted_convert_is_canonical(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out, order=util.ORDER_COUNT)
+
+        ec = ec_file.parse(ec_out)
+        counts = list(ec._ec_counts_list)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_002_write_round_trip(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        ec_copy = os.path.join(self.work_dir, 'copy.bin')
+        util.convert(self.bam_file, ec_out)
+
+        ec_file.write(ec_file.parse(ec_out), ec_copy)
+
+        with open(ec_out, 'rb') as f1, open(ec_copy, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_003_max_memory_spills_same_table(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        ec_spilled = os.path.join(self.work_dir, 'spilled.bin')
+        util.convert(self.bam_file, ec_out)
+        util.convert(self.bam_file, ec_spilled, max_memory=0.001, temp_dir=self.work_dir)
+
+        def table(file_name):
+            ec = ec_file.parse(file_name)
+            rows = {}
+            for ec_index, target_index, bits in ec._alignments:
+                rows.setdefault(ec_index, []).append((ec._targets_list[target_index], bits))
+            return sorted((ec._ec_counts_list[idx], sorted(r)) for idx, r in rows.iteritems())
+
+        self.assertEqual(table(ec_out), table(ec_spilled))
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['reads.bam', 'reads.bin', 'spilled.bin'])
+
+    def test_004_builder_matches_convert(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+        expected = ec_file.parse(ec_out)
+
+        ec = builder.from_file(self.bam_file)
+        self.assertEqual(list(ec.targets), list(expected._targets_list))
+        self.assertEqual(list(ec.counts), list(expected._ec_counts_list))
+
+        rows = expected._alignments[np.lexsort((expected._alignments[:, 1], expected._alignments[:, 0]))]
+        self.assertTrue((ec.alignments == rows).all())
+
+        # records skipped by flag, as convert does
+        import pysam
+
+        flagged_bam = os.path.join(self.work_dir, 'flagged.bam')
+        bam_in = pysam.AlignmentFile(self.bam_file, 'rb')
+        bam_out = pysam.AlignmentFile(flagged_bam, 'wb', template=bam_in)
+        for i, alignment in enumerate(bam_in):
+            if i % 3 == 0:
+                alignment.flag |= util.FLAG_QC_FAIL
+            bam_out.write(alignment)
+        bam_out.close()
+        bam_in.close()
+
+        exclude_flags = util.FLAG_UNMAPPED | util.FLAG_QC_FAIL
+        util.convert(flagged_bam, ec_out, exclude_flags=exclude_flags)
+        expected = ec_file.parse(ec_out)
+        ec = builder.from_file(flagged_bam, exclude_flags=exclude_flags)
+        self.assertLess(sum(ec.counts), self.num_reads)
+        self.assertEqual(list(ec.counts), list(expected.counts))
+        rows = expected._alignments[np.lexsort((expected._alignments[:, 1], expected._alignments[:, 0]))]
+        self.assertTrue((ec.alignments == rows).all())
+
+    def test_005_paired_intersects_mates(self):
+        bam_file = os.path.join(self.work_dir, 'pairs.bam')
+        ec_single = os.path.join(self.work_dir, 'single.bin')
+        ec_paired = os.path.join(self.work_dir, 'paired.bin')
+        synthetic.generate(bam_file, num_targets=20, num_haplotypes=4, num_reads=self.num_reads,
+                           multimap_rate=0.5, seed=1, paired=True)
+
+        util.convert(bam_file, ec_single)
+        util.convert(bam_file, ec_paired, paired=True)
+
+        single = ec_file.parse(ec_single)
+        paired = ec_file.parse(ec_paired)
+        self.assertEqual(sum(paired._ec_counts_list), self.num_reads)
+        self.assertLess(len(paired._alignments), len(single._alignments))
+
+    def test_006_transcriptome_index_round_trip(self):
+        references = ['T1_A', 'T1_B', 'T2_A', 'T3']
+        index_file = os.path.join(self.work_dir, 'header.b2ei')
+
+        built = transcriptome.build(references)
+        transcriptome.save(built, index_file)
+        loaded = transcriptome.load(index_file)
+
+        for tid in xrange(len(references)):
+            self.assertEqual(loaded.main_target(tid), built.main_target(tid))
+            self.assertEqual(loaded.haplotype(tid), built.haplotype(tid))
+        self.assertEqual(loaded.get_tid('T2', 'A'), 2)
+        self.assertEqual(loaded.get_tid('T2', 'B'), -1)
+        self.assertIsNone(loaded.targets)
+
+    def test_007_prune_redistributes_reads(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        pruned_out = os.path.join(self.work_dir, 'pruned.bin')
+        util.convert(self.bam_file, ec_out)
+
+        report = util.prune(ec_out, pruned_out, min_count=2, max_targets=2, redistribute=True)
+
+        ec = ec_file.parse(ec_out)
+        pruned = ec_file.parse(pruned_out)
+        self.assertEqual(len(pruned._ec_counts_list), len(ec._ec_counts_list) - len(report['ec']))
+        self.assertTrue((np.bincount(pruned._alignments[:, 0]) <= 2).all())
+
+        dropped = report['count'][report['redistributed_to'] < 0].sum()
+        self.assertEqual(sum(pruned._ec_counts_list), self.num_reads - dropped)
+
+        # convert prunes the table in memory, without an intermediate file
+        convert_out = os.path.join(self.work_dir, 'convert.bin')
+        util.convert(self.bam_file, convert_out, min_count=2, max_targets=2, redistribute=True)
+        with open(pruned_out, 'rb') as f1, open(convert_out, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['convert.bin', 'pruned.bin', 'reads.bam', 'reads.bin'])
+
+        # with a budget the merged runs are pruned as they are written, as prune does in memory
+        spilled_out = os.path.join(self.work_dir, 'spilled.bin')
+        util.convert(self.bam_file, spilled_out, max_memory=0.001, temp_dir=self.work_dir)
+        for redistribute in (False, True):
+            util.prune(spilled_out, pruned_out, min_count=2, max_targets=2, redistribute=redistribute)
+            util.convert(self.bam_file, convert_out, min_count=2, max_targets=2, redistribute=redistribute,
+                         max_memory=0.001, temp_dir=self.work_dir)
+            with open(pruned_out, 'rb') as f1, open(convert_out, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_008_subset_keeps_listed_targets(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        subset_out = os.path.join(self.work_dir, 'subset.bin')
+        target_file = os.path.join(self.work_dir, 'panel.txt')
+        util.convert(self.bam_file, ec_out)
+
+        ec = ec_file.parse(ec_out)
+        panel = ec._targets_list[::2]
+        with open(target_file, 'w') as f:
+            f.write('\n'.join(panel) + '\n')
+
+        util.subset(ec_out, subset_out, target_file)
+        subset = ec_file.parse(subset_out)
+
+        self.assertEqual(subset._targets_list, panel)
+        self.assertTrue((np.bincount(subset._alignments[:, 0]) > 0).all())
+
+        kept = np.in1d(ec._alignments[:, 1], np.arange(0, len(ec._targets_list), 2))
+        self.assertEqual(len(subset._alignments), kept.sum())
+        self.assertEqual(sum(subset._ec_counts_list),
+                         np.asarray(ec._ec_counts_list)[np.unique(ec._alignments[kept, 0])].sum())
+
+    def test_009_collapse_merges_identical_ecs(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        collapsed_out = os.path.join(self.work_dir, 'genes.bin')
+        mapping_file = os.path.join(self.work_dir, 'genes.tsv')
+        util.convert(self.bam_file, ec_out)
+
+        ec = ec_file.parse(ec_out)
+        with open(mapping_file, 'w') as f:
+            for i, target in enumerate(ec._targets_list):
+                f.write('{}\tG{}\n'.format(target, i // 3))
+
+        util.collapse(ec_out, collapsed_out, mapping_file)
+        collapsed = ec_file.parse(collapsed_out)
+
+        self.assertEqual(len(collapsed._targets_list), (len(ec._targets_list) + 2) // 3)
+        self.assertEqual(sum(collapsed._ec_counts_list), self.num_reads)
+
+        signatures = set(tuple(map(tuple, collapsed._alignments[collapsed._alignments[:, 0] == i, 1:]))
+                         for i in xrange(len(collapsed._ec_counts_list)))
+        self.assertEqual(len(signatures), len(collapsed._ec_counts_list))
+
+    def test_010_remap_haplotypes_to_one_group(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        remapped_out = os.path.join(self.work_dir, 'remapped.bin')
+        mapping_file = os.path.join(self.work_dir, 'haplotypes.tsv')
+        util.convert(self.bam_file, ec_out)
+
+        ec = ec_file.parse(ec_out)
+        with open(mapping_file, 'w') as f:
+            for haplotype in ec._haplotypes_list:
+                f.write('{}\tALL\n'.format(haplotype))
+
+        util.remap(ec_out, remapped_out, mapping_file)
+        remapped = ec_file.parse(remapped_out)
+
+        self.assertEqual(remapped._haplotypes_list, ['ALL'])
+        self.assertTrue((remapped._alignments[:, 2] == 1).all())
+        self.assertEqual(sum(remapped._ec_counts_list), self.num_reads)
+        self.assertEqual(len(np.unique(ec._alignments[:, 1])), len(np.unique(remapped._alignments[:, 1])))
+
+    def test_011_salmon_and_kallisto_round_trip(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+        ec = ec_file.parse(ec_out)
+
+        def rows(e):
+            signatures = [[] for _ in e._ec_counts_list]
+            for i, t, b in e._alignments.tolist():
+                signatures[i].append((e._targets_list[t], b))
+            return sorted((tuple(sorted(s)), c) for s, c in zip(signatures, e._ec_counts_list))
+
+        salmon_out = os.path.join(self.work_dir, 'eq_classes.txt')
+        util.ec2salmon(ec_out, salmon_out)
+        salmon = util.salmon2ec(salmon_out, os.path.join(self.work_dir, 'salmon.bin'))
+        self.assertEqual(rows(salmon), rows(ec))
+
+        kallisto_out = [os.path.join(self.work_dir, name) for name in ('matrix.ec', 'transcripts.txt', 'counts.tsv')]
+        util.ec2kallisto(ec_out, *kallisto_out)
+        kallisto = util.kallisto2ec(*(kallisto_out + [os.path.join(self.work_dir, 'kallisto.bin')]))
+        self.assertEqual(rows(kallisto), rows(ec))
+
+    def test_012_salmon_weights_are_ignored(self):
+        salmon_in = os.path.join(self.work_dir, 'weights.txt')
+        with open(salmon_in, 'w') as f:
+            f.write('3\n2\nT1_A\nT1_B\nT2_A\n2\t0\t2\t0.5\t0.5\t7\n1\t1\t1.0\t3\n')
+
+        ec = util.salmon2ec(salmon_in, os.path.join(self.work_dir, 'weights.bin'))
+
+        self.assertEqual(ec._targets_list, ['T1', 'T2'])
+        self.assertEqual(ec._haplotypes_list, ['A', 'B'])
+        self.assertEqual(list(ec._ec_counts_list), [7, 3])
+        self.assertEqual(ec._alignments.tolist(), [[0, 0, 1], [0, 1, 1], [1, 0, 2]])
+
+    def test_013_ec_file_cache(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+
+        ec_file.set_cache_size(2)
+        try:
+            first = ec_file.parse(ec_out)
+            self.assertIs(ec_file.parse(ec_out), first)
+            self.assertEqual(util.info(ec_out)['reads'], self.num_reads)
+
+            util.convert(self.bam_file, ec_out, order=util.ORDER_COUNT)
+            os.utime(ec_out, (0, 0))
+            self.assertIsNot(ec_file.parse(ec_out), first)
+        finally:
+            ec_file.set_cache_size(0)
+
+    def test_014_sam_text_matches_pysam(self):
+        import pysam
+
+        sam_file = os.path.join(self.work_dir, 'reads.sam')
+        bam_in = pysam.AlignmentFile(self.bam_file, 'rb')
+        sam_out = pysam.AlignmentFile(sam_file, 'w', template=bam_in)
+        for alignment in bam_in:
+            sam_out.write(alignment)
+        sam_out.close()
+        bam_in.close()
+
+        bam_ec_out = os.path.join(self.work_dir, 'bam.bin')
+        sam_ec_out = os.path.join(self.work_dir, 'sam.bin')
+        util.convert(self.bam_file, bam_ec_out)
+        util.convert(sam_file, sam_ec_out)
+
+        expected = ec_file.parse(bam_ec_out)
+        ec = ec_file.parse(sam_ec_out)
+        self.assertEqual(ec._targets_list, expected._targets_list)
+        self.assertEqual(list(ec._ec_counts_list), list(expected._ec_counts_list))
+
+        rows = expected._alignments[np.lexsort((expected._alignments[:, 1], expected._alignments[:, 0]))]
+        self.assertTrue((ec._alignments == rows).all())
+
+        # records split across small buffers
+        sam = sam_text.SAMText(sam_file, buffer_bytes=1000)
+        blocks = list(sam.blocks(util.EXCLUDE_FLAGS))
+        sam.close()
+        self.assertGreater(len(blocks), 10)
+        read_ids = np.concatenate([b[0] for b in blocks])
+        tids = np.concatenate([b[1] for b in blocks])
+        self.assertEqual(read_ids[-1] + 1, self.num_reads)
+        self.assertTrue((builder.from_arrays(read_ids, tids, sam.references).alignments == rows).all())
+
+    def test_015_plan(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+        expected = ec_file.parse(ec_out)
+
+        # the whole file sampled, the estimates are exact
+        report = util.plan(self.bam_file, sample_reads=self.num_reads * 2, memory_limit=1024)
+        self.assertEqual(report['estimate']['reads'], self.num_reads)
+        self.assertEqual(report['estimate']['equivalence_classes'], len(expected.counts))
+        self.assertEqual(report['estimate']['alignment_rows'], len(expected.alignments))
+        self.assertEqual(report['estimate']['output_bytes'], os.path.getsize(ec_out))
+        self.assertIsNone(report['recommended']['max_memory_mb'])
+
+        report = util.plan(self.bam_file, sample_reads=100, memory_limit=1)
+        self.assertEqual(report['sample']['reads'], 100)
+        self.assertGreater(report['estimate']['reads'], 100)
+        self.assertIsNotNone(report['recommended']['max_memory_mb'])
+
+        # a partial sample ends inside a BGZF block, the header is not scaled
+        bam_file = os.path.join(self.work_dir, 'more.bam')
+        synthetic.generate(bam_file, num_targets=20, num_haplotypes=4, num_reads=2000, multimap_rate=0.5, seed=2)
+        for sample_reads in (100, 500, 1000):
+            report = util.plan(bam_file, sample_reads=sample_reads, memory_limit=1024)
+            self.assertEqual(report['sample']['reads'], sample_reads)
+            self.assertAlmostEqual(report['estimate']['reads'], 2000, delta=2000 * 0.1)
+
+    def test_016_result_cache(self):
+        cache_dir = os.path.join(self.work_dir, 'cache')
+        expected_out = os.path.join(self.work_dir, 'expected.bin')
+        util.convert(self.bam_file, expected_out, order=util.ORDER_COUNT)
+
+        first_out = os.path.join(self.work_dir, 'first.bin')
+        second_out = os.path.join(self.work_dir, 'second.bin')
+        util.convert(self.bam_file, first_out, order=util.ORDER_COUNT, cache_dir=cache_dir)
+        util.convert(self.bam_file, second_out, order=util.ORDER_COUNT, cache_dir=cache_dir)
+        self.assertTrue(os.path.samefile(first_out, second_out))
+        with open(expected_out, 'rb') as f:
+            expected = f.read()
+        with open(second_out, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+        # a hit does not read the inputs or the cached result again
+        file_digest = result_cache.file_digest
+        result_cache.file_digest = None
+        try:
+            util.convert(self.bam_file, second_out, order=util.ORDER_COUNT, cache_dir=cache_dir)
+        finally:
+            result_cache.file_digest = file_digest
+
+        # other options are another result
+        util.convert(self.bam_file, second_out, order=util.ORDER_TARGET, cache_dir=cache_dir)
+        self.assertFalse(os.path.samefile(first_out, second_out))
+        self.assertEqual(len(util.cache(cache_dir)), 2)
+
+        # a cached result written over in place is not used
+        with open(first_out, 'r+b') as f:
+            f.write('\0' * 8)
+        util.convert(self.bam_file, first_out, order=util.ORDER_COUNT, cache_dir=cache_dir)
+        with open(first_out, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+        # unchanged size, mtime and inode are trusted, a hash is only checked when asked to verify
+        st = os.stat(first_out)
+        with open(first_out, 'r+b') as f:
+            f.write('\0' * 8)
+        os.utime(first_out, (st.st_atime, st.st_mtime))
+        self.assertEqual(len(util.cache(cache_dir)), 2)
+        self.assertEqual(len(util.cache(cache_dir, verify=True)), 1)
+
+        self.assertEqual(len(util.cache(cache_dir, max_size=0)), 0)
+
+    def test_017_bitfield(self):
+        rng = np.random.RandomState(1)
+        for num_haplotypes in (1, 8, 9, 32):
+            values = rng.randint(0, 1 << num_haplotypes, size=1000, dtype=np.int64)
+            lists = [util.int_to_list(v, num_haplotypes) for v in values.tolist()]
+
+            # negative int32, as read from an EC file, when bit 31 is set
+            on = bitfield.decode(values.astype(np.uint32).view(np.int32), num_haplotypes)
+            self.assertEqual(on.astype(int).tolist(), lists)
+            self.assertEqual(bitfield.encode(on).tolist(), values.tolist())
+            self.assertEqual(bitfield.popcount(values).tolist(), [sum(bits) for bits in lists])
+
+        groups = [1, -1, 0, 1]
+        self.assertEqual(bitfield.remap([0b0001, 0b0010, 0b1100, 0b1111], groups).tolist(), [0b10, 0, 0b11, 0b11])
+        self.assertEqual(bitfield.mask([0, 3]), 0b1001)
+        self.assertEqual(util.list_to_int([1, 0, 0, 1]), 0b1001)
+
+        # EMASE files are written and read a haplotype matrix at a time
+        from bam2ec import emase_file
+
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        emase_out = os.path.join(self.work_dir, 'reads.h5')
+        util.convert(self.bam_file, ec_out)
+        util.ec2emase(ec_out, emase_out)
+
+        ec = ec_file.parse(ec_out)
+        em = emase_file.parse(emase_out)
+        self.assertEqual(list(em._target_list), ec._targets_list)
+        self.assertEqual(sorted(map(tuple, em._alignments.tolist())), sorted(map(tuple, ec._alignments.tolist())))
+
+    def test_018_em_fixed_point(self):
+        from bam2ec import em
+
+        # 60 reads on T1_A, 40 on T2_B and 100 on both: T1_A gets 60 + 100 * 0.6 at the fixed point
+        references = ['T1_A', 'T1_B', 'T2_A', 'T2_B']
+        read_ids = range(60) + range(60, 100) + range(100, 200) * 2
+        tids = [0] * 60 + [3] * 40 + [0] * 100 + [3] * 100
+        ec = builder.from_arrays(read_ids, tids, references)
+        self.assertEqual(list(ec.counts), [60, 40, 100])
+
+        for num_threads in (1, 2):
+            model = em.EM(ec, num_threads)
+            num_iters = model.run(tolerance=1e-8, max_iters=1000)
+            self.assertTrue(model.converged)
+            self.assertLess(num_iters, 1000)
+
+            expected = model.get_expected_counts()
+            np.testing.assert_allclose(expected, [[120, 0], [0, 80]], atol=1e-4)
+            np.testing.assert_allclose(expected.sum(axis=1), [120, 80], atol=1e-4)
+            np.testing.assert_allclose(expected.sum(axis=0), [120, 80], atol=1e-4)
+
+        # converging on the last allowed iteration
+        model = em.EM(ec)
+        self.assertEqual(model.run(tolerance=1e-8, max_iters=num_iters), num_iters)
+        self.assertTrue(model.converged)
+        model.run(tolerance=1e-8, max_iters=num_iters - 1)
+        self.assertFalse(model.converged)
+
+        ec_out = os.path.join(self.work_dir, 'fixed.bin')
+        quantify_out = os.path.join(self.work_dir, 'fixed.tsv')
+        ec.to_file(ec_out)
+        util.quantify(ec_out, quantify_out, tolerance=1e-8, num_threads=2)
+        with open(quantify_out) as f:
+            lines = [line.rstrip('\n').split('\t') for line in f]
+        self.assertEqual(lines, [['locus', 'A', 'B', 'total'],
+                                 ['T1', '120.00', '0.00', '120.00'],
+                                 ['T2', '0.00', '80.00', '80.00']])
+
+    def test_019_downsample_is_nested_thinning(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+        ec = ec_file.parse(ec_out)
+        fractions = [0.2, 0.5, 0.9]
+
+        def signatures(e):
+            return [tuple(map(tuple, e._alignments[e._alignments[:, 0] == i, 1:])) for i in xrange(len(e.counts))]
+
+        ec_index = {signature: i for i, signature in enumerate(signatures(ec))}
+
+        def sample(prefix, method, seed):
+            """
+            :return: the counts of every fraction, indexed by the equivalence classes of ec
+            """
+            counts = []
+            for file_name in util.downsample(ec_out, os.path.join(self.work_dir, prefix), fractions, method, seed):
+                sample_ec = ec_file.parse(file_name)
+                full = np.zeros(len(ec.counts), dtype=np.int64)
+                full[[ec_index[signature] for signature in signatures(sample_ec)]] = sample_ec.counts
+                counts.append(full)
+            return counts
+
+        for method in util.SAMPLE_METHODS:
+            counts = sample(method, method, 7)
+            self.assertEqual([c.tolist() for c in sample(method + '_again', method, 7)], [c.tolist() for c in counts])
+
+            original = np.asarray(ec.counts)
+            self.assertTrue((counts[2] <= original).all())
+            self.assertTrue((counts[1] <= counts[2]).all())
+            self.assertTrue((counts[0] <= counts[1]).all())
+
+            if method == util.SAMPLE_MULTINOMIAL:
+                self.assertEqual([c.sum() for c in counts], [int(round(f * self.num_reads)) for f in fractions])
+
+        # every read drawn exactly once without replacement
+        rng = np.random.RandomState(1)
+        self.assertEqual(util._draw_without_replacement(rng, [3, 0, 5, 1], 9).tolist(), [3, 0, 5, 1])
+
+    def test_020_batch(self):
+        import pysam
+
+        # convert gives up on references without a haplotype, without an output or an exception
+        no_haplotype_bam = os.path.join(self.work_dir, 'no_haplotype.bam')
+        out = pysam.AlignmentFile(no_haplotype_bam, 'wb', header={'SQ': [{'SN': 'T1', 'LN': 100}]})
+        alignment = pysam.AlignedSegment()
+        alignment.query_name = 'r1'
+        alignment.reference_id = 0
+        alignment.reference_start = 0
+        alignment.cigarstring = '10M'
+        alignment.query_sequence = 'A' * 10
+        out.write(alignment)
+        out.close()
+
+        outputs = [os.path.join(self.work_dir, name) for name in ('a.bin', 'no_haplotype.bin', 'b.bin')]
+        manifest_file = os.path.join(self.work_dir, 'manifest.tsv')
+        with open(manifest_file, 'w') as f:
+            f.write('# input\toutput\n\n')
+            f.write('{}\t{}\n{} {}\n{}\t{}\n'.format(self.bam_file, outputs[0], no_haplotype_bam, outputs[1],
+                                                      self.bam_file, outputs[2]))
+
+        self.assertEqual(util.parse_manifest(manifest_file),
+                         [(self.bam_file, outputs[0], None), (no_haplotype_bam, outputs[1], None),
+                          (self.bam_file, outputs[2], None)])
+
+        # a stale output of an earlier run is not taken for a result
+        with open(outputs[1], 'w') as f:
+            f.write('stale')
+
+        summary_file = os.path.join(self.work_dir, 'summary.tsv')
+        results = util.batch(manifest_file, summary_file, num_processes=2)
+
+        self.assertEqual([(r[1], r[2]) for r in results], zip(outputs, ['OK', 'FAILED', 'OK']))
+        self.assertFalse(os.path.exists(outputs[1]))
+        self.assertEqual(sum(ec_file.parse(outputs[2]).counts), self.num_reads)
+
+        with open(summary_file) as f:
+            self.assertEqual([line.split('\t')[1] for line in f.read().splitlines()[1:]], outputs)
+
+    def test_021_group_tag(self):
+        import pysam
+
+        # groups whose file names would collide, and reads without the tag
+        tagged_bam = os.path.join(self.work_dir, 'tagged.bam')
+        groups = ['A/B', 'A_B', None]
+        bam_in = pysam.AlignmentFile(self.bam_file, 'rb')
+        bam_out = pysam.AlignmentFile(tagged_bam, 'wb', template=bam_in)
+        read_groups = {}
+        for alignment in bam_in:
+            group = read_groups.setdefault(alignment.query_name, groups[len(read_groups) % 3])
+            if group:
+                alignment.set_tag('RG', group)
+            bam_out.write(alignment)
+        bam_out.close()
+        bam_in.close()
+
+        ec_out = os.path.join(self.work_dir, 'tagged.bin')
+        util.convert(tagged_bam, ec_out, group_tag='RG')
+        self.assertFalse(os.path.exists(ec_out))
+
+        with open(os.path.join(self.work_dir, 'tagged.groups.tsv')) as f:
+            rows = [line.split('\t') for line in f.read().splitlines()[1:]]
+        self.assertEqual([row[0] for row in rows], groups[:2])
+
+        files = [row[3] for row in rows]
+        self.assertEqual(len(set(files)), 2)
+        for group, reads, num_ecs, file_name in rows:
+            ec = ec_file.parse(file_name)
+            self.assertEqual(sum(ec.counts), int(reads))
+            self.assertEqual(len(ec.counts), int(num_ecs))
+            self.assertEqual(int(reads), sum(1 for g in read_groups.itervalues() if g == group))
+
+    def test_022_umi_collapse(self):
+        import pysam
+        from bam2ec import umi
+
+        # UMIs of different lengths never share a code
+        self.assertNotEqual(umi.encode_umi('A'), umi.encode_umi('AA'))
+        self.assertIsNone(umi.encode_umi('ACNT'))
+
+        exact = umi.UMICollapser()
+        self.assertEqual([exact.add('C1', 'ACGT', 0), exact.add('C1', 'ACGT', 0), exact.add('C1', 'ACGT', 1),
+                          exact.add('C2', 'ACGT', 0), exact.add('C1', 'ACGA', 0), exact.add('C1', 'A', 0),
+                          exact.add('C1', 'AA', 0), exact.add('C1', 'ACNT', 0)],
+                         [True, False, True, True, True, True, True, False])
+        self.assertEqual((exact.duplicates, exact.invalid, exact.num_cells()), (1, 1, 2))
+
+        mismatch = umi.UMICollapser(mismatch=True)
+        self.assertEqual([mismatch.add('C1', 'ACGT', 0), mismatch.add('C1', 'ACGA', 0), mismatch.add('C1', 'AGGA', 0),
+                          mismatch.add('C1', 'ACGA', 1), mismatch.add('C2', 'ACGA', 0)],
+                         [True, False, True, True, True])
+
+        cell_sorted = umi.UMICollapser(cell_sorted=True)
+        self.assertEqual([cell_sorted.add('C1', 'ACGT', 0), cell_sorted.add('C2', 'ACGT', 0),
+                          cell_sorted.add('C2', 'ACGT', 0)], [True, True, False])
+        self.assertEqual(cell_sorted.num_cells(), 2)
+        self.assertRaises(ValueError, cell_sorted.add, 'C1', 'ACGT', 0)
+
+        # reads sorted by cell, each UMI used by several reads of a cell
+        umi_bam = os.path.join(self.work_dir, 'umi.bam')
+        bam_in = pysam.AlignmentFile(self.bam_file, 'rb')
+        bam_out = pysam.AlignmentFile(umi_bam, 'wb', template=bam_in)
+        read_numbers = {}
+        for alignment in bam_in:
+            n = read_numbers.setdefault(alignment.query_name, len(read_numbers))
+            alignment.set_tag('CB', 'C{}'.format(n * 3 // self.num_reads))
+            alignment.set_tag('UB', ['AAAA', 'CCCC', 'GGGG'][n % 3])
+            bam_out.write(alignment)
+        bam_out.close()
+        bam_in.close()
+
+        ec_out = os.path.join(self.work_dir, 'umi.bin')
+        sorted_out = os.path.join(self.work_dir, 'umi_sorted.bin')
+        util.convert(umi_bam, ec_out, umi_tag='UB')
+        util.convert(umi_bam, sorted_out, umi_tag='UB', cell_sorted=True)
+
+        with open(ec_out, 'rb') as f1, open(sorted_out, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertLess(sum(ec_file.parse(ec_out).counts), self.num_reads)
+
+        # UMIs as cells are not consecutive
+        self.assertRaises(ValueError, util.convert, umi_bam, ec_out, umi_tag='UB', cell_tag='UB', cell_sorted=True)
+
+    def test_023_spill_is_removed_on_exit(self):
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        temp_dir = os.path.join(self.work_dir, 'spill')
+        target_file = os.path.join(self.work_dir, 'targets.txt')
+        os.mkdir(temp_dir)
+
+        # convert exits at the first target missing from the target file
+        with open(target_file, 'w') as f:
+            f.write('\n'.join(synthetic.target_names(20)[:10]) + '\n')
+
+        self.assertRaises(SystemExit, util.convert, self.bam_file, ec_out, target_file, max_memory=0.001,
+                          temp_dir=temp_dir)
+        self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_024_profiler_report(self):
+        import json
+        from bam2ec import profiling
+
+        report_file = os.path.join(self.work_dir, 'profile.json')
+
+        # nothing is recorded before the profiler is enabled
+        profiler = profiling.Profiler()
+        profiler.start_phase('ignored')
+        profiler.end_phase(10)
+        self.assertEqual(profiler.phases, [])
+
+        profiler.enable(report_file, 'test')
+        profiler.start_phase('first')
+        profiler.add_records(2)
+        profiler.start_phase('second')
+        profiler.add_records(3)
+        profiler.end_phase(4)
+        profiler.start_phase('unfinished')
+        profiler.write()
+
+        with open(report_file) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['command'], 'test')
+        self.assertEqual([(p['name'], p['records']) for p in report['phases']],
+                         [('first', 2), ('second', 7), ('unfinished', 0)])
+        for key in ('wall_seconds', 'cpu_seconds', 'max_rss_kb'):
+            self.assertIn(key, report)
+            for phase in report['phases']:
+                self.assertGreaterEqual(phase[key], 0)
+        self.assertGreaterEqual(report['wall_seconds'], sum(p['wall_seconds'] for p in report['phases']))
+
+        # written once, at exit the report is left alone
+        os.remove(report_file)
+        profiler.write()
+        self.assertFalse(os.path.exists(report_file))
+
+    def test_025_telemetry(self):
+        import json
+        from bam2ec import telemetry
+
+        lines_file = os.path.join(self.work_dir, 'telemetry.jsonl')
+
+        # no line before the interval has passed
+        progress = telemetry.Telemetry(open(lines_file, 'w'), interval=3600, file_size=1000)
+        progress.check(100, 10, 5, 250)
+        progress.done(400, 40, 20)
+        self.assertTrue(progress.out.closed)
+        progress.close()
+
+        with open(lines_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['event'] for r in records], ['done'])
+        self.assertEqual((records[0]['alignments'], records[0]['reads'], records[0]['equivalence_classes'],
+                          records[0]['fraction_done']), (400, 40, 20, 1.0))
+
+        # a line on every check once the interval has passed
+        progress = telemetry.Telemetry(open(lines_file, 'w'), interval=0, file_size=1000)
+        progress.check(100, 10, 5, 250)
+        progress.check(200, 20, 8, 500)
+        progress.done(400, 40, 20)
+
+        with open(lines_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['event'] for r in records], ['progress', 'progress', 'done'])
+        self.assertEqual([r['alignments'] for r in records], [100, 200, 400])
+        self.assertEqual([r['fraction_done'] for r in records], [0.25, 0.5, 1.0])
+        self.assertIn('eta_seconds', records[0])
+        for key in ('alignments_per_second', 'reads_per_second', 'rss_kb', 'elapsed_seconds'):
+            self.assertIn(key, records[-1])
+
+        util.convert(self.bam_file, os.path.join(self.work_dir, 'reads.bin'), telemetry_file=lines_file,
+                     telemetry_interval=0)
+        with open(lines_file) as f:
+            self.assertEqual(json.loads(f.read().splitlines()[-1])['reads'], self.num_reads)
+
+        # the file of a convert that exits part way through is closed
+        target_file = os.path.join(self.work_dir, 'targets.txt')
+        with open(target_file, 'w') as f:
+            f.write(synthetic.target_names(20)[0] + '\n')
+        opened = []
+        open_telemetry = telemetry.open_telemetry
+
+        def recording_open(*args):
+            opened.append(open_telemetry(*args))
+            return opened[-1]
+
+        telemetry.open_telemetry = recording_open
+        try:
+            self.assertRaises(SystemExit, util.convert, self.bam_file, os.path.join(self.work_dir, 'reads.bin'),
+                              target_file, telemetry_file=lines_file)
+        finally:
+            telemetry.open_telemetry = open_telemetry
+        self.assertTrue(opened[0].out.closed)
+
+    def test_026_trace_rows_go_through_the_handlers(self):
+        import logging
+        import re
+        import StringIO
+
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+
+        stream = StringIO.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(util.BAM2ECFormatter())
+        log = util.get_logger()
+        saved = log.handlers, log.level, log.propagate
+        log.handlers = [handler]
+        log.propagate = False
+        log.setLevel(util.VERBOSE_LEVELV_NUM)
+        try:
+            # the same text as a record per row
+            tracer = util.get_tracer()
+            self.assertTrue(tracer)
+            tracer.write('0\t1\t2')
+            tracer.write('3\t4\t5')
+            tracer.flush()
+            log.verbose('0\t1\t2')
+            log.verbose('3\t4\t5')
+
+            util.dump(ec_out, detail=True)
+        finally:
+            log.handlers, log.level, log.propagate = saved
+
+        lines = re.sub(r'\]\[[^]]+\] ', '][time] ', stream.getvalue()).splitlines()
+        self.assertEqual(lines[0:2], ['[bam2ec][time] 0\t1\t2', '[bam2ec][time] 3\t4\t5'])
+        self.assertEqual(lines[0:2], lines[2:4])
+
+        ec = ec_file.parse(ec_out)
+        self.assertIn('[bam2ec] 0\t{}'.format(ec._targets_list[0]), lines)
+        self.assertFalse(util.get_tracer())
+
+    def test_027_server(self):
+        import signal
+        import subprocess
+        import sys
+        import time
+        from bam2ec import server
+
+        ec_out = os.path.join(self.work_dir, 'reads.bin')
+        util.convert(self.bam_file, ec_out)
+        report_file = os.path.join(self.work_dir, 'profile.json')
+        socket_file = os.path.join(self.work_dir, 'bam2ec.sock')
+
+        process = subprocess.Popen([sys.executable, '-c',
+                                    'import sys; from bam2ec import server; server.serve(sys.argv[1], 1)',
+                                    socket_file])
+        try:
+            for _ in xrange(300):
+                if server._socket_in_use(socket_file):
+                    break
+                time.sleep(0.1)
+
+            status, stdout, stderr = server.request(['info', '-i', ec_out, '--profile', report_file], socket_file)
+            self.assertEqual(status, 0)
+            self.assertIn('reads: {:,}'.format(self.num_reads), stderr)
+            self.assertTrue(os.path.exists(report_file))
+
+            # handlers restored and profiler reset between requests
+            os.remove(report_file)
+            status, stdout, stderr = server.request(['info', '-i', ec_out], socket_file)
+            self.assertEqual(status, 0)
+            self.assertEqual(stderr.count('reads: {:,}'.format(self.num_reads)), 1)
+            self.assertNotIn('Profile written', stderr)
+            self.assertFalse(os.path.exists(report_file))
+
+            status, stdout, stderr = server.request(['info'], socket_file)
+            self.assertEqual(status, 1)
+            self.assertIn('No input file was specified.', stderr)
+            self.assertEqual(server.request(['dump', '-i', ec_out], socket_file)[0], 2)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+        self.assertFalse(os.path.exists(socket_file))
+
+    def test_028_sam_text_blocks(self):
+        import pysam
+
+        # read names of mixed lengths, so the QNAME rows of a buffer are zero padded
+        sam_file = os.path.join(self.work_dir, 'reads.sam')
+        bam_in = pysam.AlignmentFile(self.bam_file, 'rb')
+        sam_out = pysam.AlignmentFile(sam_file, 'w', template=bam_in)
+        qname = None
+        read = -1
+        for alignment in bam_in:
+            if alignment.query_name != qname:
+                qname = alignment.query_name
+                read += 1
+            alignment.query_name = 'r' * (1 + read % 7) + str(read)
+            sam_out.write(alignment)
+        sam_out.close()
+        bam_in.close()
+
+        expected = builder.from_file(sam_file)
+        self.assertEqual(sum(expected._ec_counts_list), self.num_reads)
+
+        for buffer_bytes in (40, 97, 256, 399, 1000):
+            sam = sam_text.SAMText(sam_file, buffer_bytes=buffer_bytes)
+            table = builder.ECBuilder(sam.references)
+            num_reads = 0
+            for read_ids, tids, num_skipped in sam.blocks(util.EXCLUDE_FLAGS):
+                table.add(read_ids, tids)
+                if len(read_ids):
+                    num_reads = read_ids[-1] + 1
+            sam.close()
+            self.assertEqual(num_reads, self.num_reads)
 
-    def test_000_something(self):
-        pass
+            ec = table.ec()
+            self.assertEqual(ec._targets_list, expected._targets_list)
+            self.assertEqual(ec._haplotypes_list, expected._haplotypes_list)
+            self.assertEqual(list(ec._ec_counts_list), list(expected._ec_counts_list))
+            self.assertTrue((ec._alignments == expected._alignments).all())
 
 
 if __name__ == '__main__':